@@ -32,7 +32,8 @@ template< typename array_t >
 void check_contiguity(array_t &obj_ptr, int i) {
   if (!is_contiguous(obj_ptr)) {
     keops_error("[Keops] Arg at position " + std::to_string(i) + ": is not contiguous. "
-                + "Please provide 'contiguous' dara array, as KeOps does not support strides. "
+                + "Please provide 'contiguous' dara array, as KeOps only supports strides for the 2d variables "
+                + "of the Cpu engine, without ranges. "
                 + "If you're getting this error in the 'backward' pass of a code using torch.sum() "
                 + "on the output of a KeOps routine, you should consider replacing 'a.sum()' with "
                 + "'torch.dot(a.view(-1), torch.ones_like(a).view(-1))'. ");
@@ -40,6 +41,53 @@ void check_contiguity(array_t &obj_ptr, int i) {
 }
 
 
+template< typename array_t >
+void check_output(array_t &out, int* shape_out, int nbatchdims) {
+  // checks an output array given by the user, which must have the shape of the output of the formula
+  int ndim = get_ndim(out);
+  bool valid_shape = (ndim == nbatchdims + 2);
+  for (int k = 0; valid_shape && (k < ndim); k++)
+    valid_shape = (get_size(out, k) == shape_out[k]);
+  if (!valid_shape) {
+    std::string expected_shape = "";
+    for (int k = 0; k < nbatchdims + 2; k++)
+      expected_shape += (k ? ", " : "") + std::to_string(shape_out[k]);
+    keops_error("[KeOps] Wrong shape for the output array: it should be (" + expected_shape + ").");
+  }
+  if (!is_contiguous(out))
+    keops_error("[KeOps] The output array is not contiguous.");
+}
+
+template< typename array_t >
+std::vector< int > get_strides(int nargs, array_t* args, int nbatchdims) {
+  // strides[2*i] and strides[2*i+1] are the strides (in number of elements) of the lines and of the columns
+  // of the arg i, as read by load_strided. The vector is empty if all the args are contiguous, so that the
+  // usual loaders are used; strides are only supported without batch dimensions.
+  std::vector< int > strides;
+#if C_CONTIGUOUS
+  if (nbatchdims > 0)
+    return strides;
+  for (int i = 0; i < nargs; i++) {
+    if (!is_contiguous(args[i])) {
+      strides.resize(2 * nargs);
+      break;
+    }
+  }
+  if (strides.empty())
+    return strides;
+  for (int i = 0; i < nargs; i++) {
+    if (get_ndim(args[i]) == 2) {
+      strides[2 * i] = get_stride(args[i], 0);
+      strides[2 * i + 1] = get_stride(args[i], 1);
+    } else {  // parameters are loaded with the usual loader
+      strides[2 * i] = 0;
+      strides[2 * i + 1] = 1;
+    }
+  }
+#endif
+  return strides;
+}
+
 template< typename array_t >
 // This class contains get the sizes of the input args of a formula.
 class Sizes {
@@ -76,6 +124,15 @@ public:
     _shape_out.erase(_shape_out.begin() + 1 + keops_tagIJ);
     #endif
 
+    // a full reduction returns a single line
+    if (keops_full_reduction) {
+      #if C_CONTIGUOUS
+      _shape_out[nbatchdims] = 1;
+      #else
+      _shape_out[1] = 1;
+      #endif
+    }
+
     shape_out = &_shape_out[0];
 
     // fill nx and ny
@@ -241,7 +298,9 @@ void Sizes< array_t >::check_ranges(int nargs, array_t* args) {
                     + " but should be " + std::to_string(keops_dimsX[k]));
       }
   
-      check_contiguity(args[i], i);
+      // without batch dimensions, the Cpu engine reads strided arrays (see get_strides)
+      if ((nbatchdims > 0) || !C_CONTIGUOUS)
+        check_contiguity(args[i], i);
     }
       
     // Checks args in all the positions that correspond to "j" variables:
@@ -305,7 +364,9 @@ void Sizes< array_t >::check_ranges(int nargs, array_t* args) {
                     + " but should be " + std::to_string(keops_dimsY[k]));
       }
   
-      check_contiguity(args[i], i);
+      // without batch dimensions, the Cpu engine reads strided arrays (see get_strides)
+      if ((nbatchdims > 0) || !C_CONTIGUOUS)
+        check_contiguity(args[i], i);
     }
     
     for (int k = 0; k < keops_nvarsP; k++) {
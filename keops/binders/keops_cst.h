@@ -3,6 +3,7 @@
 extern "C" {
 int GetFormulaString(std::string&);
 int GetFormulaConstants(int*);
+int GetFullReduction(int*);
 int GetIndsI(int*);
 int GetIndsJ(int*);
 int GetIndsP(int*);
@@ -28,6 +29,10 @@ int keops_nvarsJ = formula_constants[5];
 int keops_nvarsP = formula_constants[6];
 int keops_dimout = formula_constants[7];
 
+// if 1, the output is also reduced over its index: a single line is returned (see FULL_REDUCTION in keops_includes.h)
+int keops_full_reduction;
+int dummy9 = GetFullReduction(&keops_full_reduction);
+
 
 std::vector<int> keops_indsI(keops_nvarsI), keops_indsJ(keops_nvarsJ), keops_indsP(keops_nvarsP);
 int dummy2 = GetIndsI(keops_indsI.data());
@@ -17,7 +17,10 @@ int GetDimsP(int*);
 #if !USE_HALF
 extern "C" {
 int CpuReduc(int, int, __TYPE__*, __TYPE__**);
+int CpuReduc_strided(int, int, __TYPE__*, __TYPE__**, int*);
 int CpuReduc_ranges(int, int, int, int*, int, int, __INDEX__**, __TYPE__*, __TYPE__**);
+void CpuSetOptions(int, int, int);
+void CpuSetAccumulate(int);
 };
 #endif
 
@@ -34,6 +37,15 @@ extern "C" {
 
 namespace keops_binders {
 
+#if !USE_HALF
+// Sets the accumulate option of the Cpu engine for the calls of the calling thread in the scope of an instance:
+// the output of the reduction is then added to the output array (see FinalizeOutput_ in CpuOptions.h).
+struct CpuAccumulate {
+  CpuAccumulate(bool accumulate) { CpuSetAccumulate(accumulate); }
+  ~CpuAccumulate() { CpuSetAccumulate(0); }
+};
+#endif
+
 
 template< typename array_t, typename index_t >
 class Ranges {
@@ -151,7 +163,9 @@ array_t_out launch_keops(int tag1D2D,
                          int nargs,
                          array_t* args,
                          int nranges = 0,
-                         index_t* ranges = {}) {
+                         index_t* ranges = {},
+                         array_t_out* out = nullptr,
+                         bool accumulate = false) {  // if true, the output of the reduction is added to *out
 							 
   keops_binders::check_tag(tag1D2D, "1D2D");
   keops_binders::check_tag(tagCpuGpu, "CpuGpu");
@@ -162,8 +176,17 @@ array_t_out launch_keops(int tag1D2D,
 
   Sizes< array_t > SS(nargs, args, nx, ny);
   
-  array_t_out result = (tagHostDevice == 0) ? allocate_result_array< array_t_out, __TYPE__ >(SS.shape_out, SS.nbatchdims)
-                                            : allocate_result_array_gpu< array_t_out, __TYPE__ >(SS.shape_out, SS.nbatchdims, deviceId_casted);
+  // the output of the Cpu engine may be added to the array given by the user, which needs no temporary copy
+  if (accumulate && ((out == nullptr) || (tagCpuGpu != 0) || USE_HALF))
+    keops_error("[KeOps] The output of a reduction can only be added to an output array by the Cpu engine.");
+#if !USE_HALF
+  CpuAccumulate cpu_accumulate(accumulate);
+#endif
+
+  // the output is written in the array given by the user, if any (see check_output)
+  array_t_out result = (out != nullptr) ? *out
+                       : (tagHostDevice == 0) ? allocate_result_array< array_t_out, __TYPE__ >(SS.shape_out, SS.nbatchdims)
+                                              : allocate_result_array_gpu< array_t_out, __TYPE__ >(SS.shape_out, SS.nbatchdims, deviceId_casted);
 
   __TYPE__* result_ptr = get_data< array_t_out, __TYPE__ >(result);
 
@@ -178,14 +201,28 @@ array_t_out launch_keops(int tag1D2D,
   for (int i = 0; i < nargs; i++)
     args_ptr[i] = get_data< array_t, __TYPE__ >(args[i]);
 
+  // strides of the args, if some of them are not contiguous (see get_strides)
+  std::vector< int > strides = get_strides(nargs, args, SS.nbatchdims);
+
   // Create a decimal word to avoid nested conditional below
   int decision = 1000 * RR.tagRanges + 100 * tagHostDevice + 10 * tagCpuGpu + tag1D2D;
 
+  if (keops_full_reduction && (decision != 0))
+    keops_error("[KeOps] Full reductions are only implemented on the Cpu, without ranges or batch dimensions.");
+
+  // only the Cpu engine (without ranges) reads strided arrays
+  if (!strides.empty() && (decision != 0))
+    for (int i = 0; i < nargs; i++)
+      check_contiguity(args[i], i);
+
   switch (decision) {
 
 #if !USE_HALF
     case 0: {
-      CpuReduc(SS.nx, SS.ny, result_ptr, args_ptr.data());
+      if (strides.empty())
+        CpuReduc(SS.nx, SS.ny, result_ptr, args_ptr.data());
+      else
+        CpuReduc_strided(SS.nx, SS.ny, result_ptr, args_ptr.data(), strides.data());
       return result;
     }
 #endif
@@ -20,7 +20,10 @@ _T* get_data(array_t obj_ptri);   // raw pointer to "a.data"
 template< typename array_t >
 __INDEX__* get_rangedata(array_t obj_ptri);  // raw pointer to "a.data", casted as integer
 template< typename array_t >
-bool is_contiguous(array_t obj_ptri);  // is "a" ordered properly? KeOps does *not* support strides!
+bool is_contiguous(array_t obj_ptri);  // is "a" ordered properly? Strides are only supported by the Cpu engine.
+
+template< typename array_t >
+int get_stride(array_t obj_ptri, int l);  // a.stride(l), in number of elements
 
 
 template< typename array_t, typename _T >
@@ -34,6 +37,13 @@ void keops_error(std::string);
 
 void keops_error(std::basic_string< char >);
 
+// binders whose arrays are always contiguous do not need to specialize get_stride
+template< typename array_t >
+int get_stride(array_t obj_ptri, int l) {
+  keops_error("[KeOps] This binder does not support non contiguous arrays.");
+  return 0;
+}
+
 
 
 // the following macro force the compiler to change MODULE_NAME to its value
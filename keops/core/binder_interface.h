@@ -29,6 +29,11 @@ extern "C" int GetFormulaConstants(int *out) {
 	return 0;
 }
 
+extern "C" int GetFullReduction(int *out) {
+	out[0] = FULL_REDUCTION;
+	return 0;
+}
+
 extern "C" int GetIndsI(int *out) {
 	if(F::tagI==0)
 		for (int k=0; k<F::NVARSI; k++)
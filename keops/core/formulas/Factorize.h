@@ -128,7 +128,7 @@ struct Factorize_Alias< F, univpack< G, GS...>> {
 //template < class F >
 //using AutoFactorize = Factorize< F, typename F::AllTypes >;
 
-#define Factorize(F, G) KeopsNS<Factorize<decltype(InvKeopsNS(F)),decltype(InvKeopsNS(G))>()
+#define Factorize(F, G) KeopsNS<Factorize<decltype(InvKeopsNS(F)),decltype(InvKeopsNS(G))>>()
 //#define AutoFactorize(F) KeopsNS<AutoFactorize<decltype(InvKeopsNS(F))>>()
 
 }
@@ -6,6 +6,7 @@
 #include "core/autodiff/UnaryOp.h"
 
 #include "core/pre_headers.h"
+#include "core/utils/Packet.h"
 namespace keops {
 
 //////////////////////////////////////////////////////////////
@@ -48,6 +49,12 @@ struct ArgMax : UnaryOp<ArgMax, F> {
   }
 #endif
 
+  // on packets (see Packet.h), the scalar operation is applied lane by lane
+  template < typename TYPE, int W >
+  static DEVICE INLINE void Operation(Packet< TYPE, W > *out, Packet< TYPE, W > *outF) {
+    PacketOperation< ArgMax, DIM, F::DIM >(out, outF);
+  }
+
   template<class V, class GRADIN>
   using DiffT = Zero<V::DIM>;
 
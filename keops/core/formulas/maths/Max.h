@@ -8,6 +8,7 @@
 #include "core/formulas/maths/OneHot.h"
 
 #include "core/pre_headers.h"
+#include "core/utils/Packet.h"
 namespace keops {
 
 //////////////////////////////////////////////////////////////
@@ -44,6 +45,12 @@ struct Max : UnaryOp<Max, F> {
   }
 #endif
 
+  // on packets (see Packet.h), the scalar operation is applied lane by lane
+  template < typename TYPE, int W >
+  static DEVICE INLINE void Operation(Packet< TYPE, W > *out, Packet< TYPE, W > *outF) {
+    PacketOperation< Max, DIM, F::DIM >(out, outF);
+  }
+
   template<class V, class GRADIN>
   using DiffT = typename F::template DiffT<V, Scal<GRADIN,OneHot<ArgMax<F>,F::DIM>>>;
 
@@ -7,6 +7,7 @@
 #include "core/formulas/constants/Zero.h"
 #include "core/autodiff/UnaryOp.h"
 #include "core/pre_headers.h"
+#include "core/utils/Packet.h"
 
 namespace keops {
 
@@ -37,6 +38,12 @@ struct OneHot : UnaryOp< OneHot, F, DIM_ > {
   }
 #endif
 
+  // on packets (see Packet.h), the scalar operation is applied lane by lane
+  template < typename TYPE, int W >
+  static DEVICE INLINE void Operation(Packet< TYPE, W > *out, Packet< TYPE, W > *outF) {
+    PacketOperation< OneHot, DIM, F::DIM >(out, outF);
+  }
+
   // There is no gradient to accumulate on V, whatever V.
   template < class V, class GRADIN >
   using DiffT = Zero<V::DIM>;
@@ -11,6 +11,7 @@
 #include "core/formulas/maths/Pow.h"
 #include "core/formulas/maths/Inv.h"
 #include "core/formulas/maths/IntInv.h"
+#include "core/utils/Packet.h"
 
 namespace keops {
 
@@ -47,6 +48,12 @@ struct Rsqrt_Impl : VectorizedScalarUnaryOp<Rsqrt_Impl, F> {
   }
 #endif
 
+  // on packets (see Packet.h), the scalar operation is applied lane by lane
+  template < typename TYPE, int W >
+  static DEVICE INLINE void Operation(Packet< TYPE, W > *out, Packet< TYPE, W > *outF) {
+    PacketOperation< Rsqrt_Impl, F::DIM, F::DIM >(out, outF);
+  }
+
   template<class V, class GRADIN>
   using DiffTF = typename F::template DiffT<V, GRADIN>;
 
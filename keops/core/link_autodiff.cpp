@@ -15,6 +15,11 @@ extern "C" int CpuReduc(int nx, int ny, __TYPE__* gamma, __TYPE__** args) {
   return Eval< F, CpuConv >::Run(nx, ny, gamma, args);
 }
 
+// Same, with the strides of the (non contiguous) args: see load_strided
+extern "C" int CpuReduc_strided(int nx, int ny, __TYPE__* gamma, __TYPE__** args, int* strides) {
+  return Eval< F, CpuConv >::Run(nx, ny, gamma, args, strides);
+}
+
 
 //////////////////////////////////////
 // Convolutions on Cpu, with ranges //
@@ -26,4 +31,20 @@ extern "C" int CpuReduc_ranges(int nx, int ny, int nbatchdims, int *shapes, int
   return Eval< F, CpuConv_ranges >::Run(nx, ny, nbatchdims, shapes, nranges_x, nranges_y, castedranges, gamma, args);
 }
 
+
+// Sets the options of the Cpu engine (number of threads, schedule and chunk size of the loops) for the next
+// calls of the calling thread: see CpuOptions.h
+extern "C" void CpuSetOptions(int num_threads, int schedule, int chunk) {
+  CpuOptions &options = CpuOptions::current();
+  options.num_threads = num_threads;
+  options.schedule = schedule;
+  options.chunk = chunk;
+}
+
+// Sets the accumulate option of the Cpu engine for the next calls of the calling thread: the output of the
+// reductions is then added to the output array (see FinalizeOutput_ in CpuOptions.h)
+extern "C" void CpuSetAccumulate(int accumulate) {
+  CpuOptions::current().accumulate = accumulate;
+}
+
 #endif
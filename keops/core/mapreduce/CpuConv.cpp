@@ -13,68 +13,384 @@
 #include "core/pack/GetInds.h"
 #include "core/pack/Load.h"
 #include "core/pack/Call.h"
+#include "core/utils/Packet.h"
+#include "core/mapreduce/CpuOptions.h"
 
 // Host implementation of the convolution, for comparison
 
 namespace keops {
 
 struct CpuConv {
-  template < typename TYPE, class FUN >
-  static int CpuConv_(FUN fun, int nx, int ny, TYPE *out, TYPE **args) {
+  // Loads the values of the variables of index INDS for the line i, using the strides of the arrays if STRIDED.
+  template < bool STRIDED, class DIMS, class INDS, typename TYPE >
+  static INLINE void load_(int i, TYPE *xi, TYPE **args, int *strides) {
+    if (STRIDED)
+      load_strided< DIMS, INDS >(i, xi, args, strides);
+    else
+      load< DIMS, INDS >(i, xi, args);
+  }
+
+  // Computes the (non finalized) reduction of the line i over the lines j = jbegin, ..., jend-1 into acc.
+  template < bool STRIDED, typename TYPE, class FUN >
+  static INLINE void CpuConvLine_(FUN fun, int i, int jbegin, int jend, __TYPEACC__ *acc, TYPE *pp, TYPE **args, int *strides) {
     typedef typename FUN::DIMSX DIMSX; // dimensions of "i" indexed variables
     typedef typename FUN::DIMSY DIMSY; // dimensions of "j" indexed variables
     typedef typename FUN::DIMSP DIMSP; // dimensions of parameters variables
     typedef typename FUN::INDSI INDSI;
     typedef typename FUN::INDSJ INDSJ;
-    typedef typename FUN::INDSP INDSP;
     const int DIMX = DIMSX::SUM; // total size of "i" indexed variables
     const int DIMY = DIMSY::SUM; // total size of "j" indexed variables
-    const int DIMP = DIMSP::SUM; // total size of parameters variables
-    const int DIMOUT = FUN::DIM; // dimension of output variable
-    const int DIMRED = FUN::DIMRED; // dimension of reduction operation
     const int DIMFOUT = FUN::F::DIM; // dimension of output variable of inner function
-    TYPE pp[DIMP];
-    load< DIMSP, INDSP >(0, pp, args);
-
-#pragma omp parallel for 
-    for (int i = 0; i < nx; i++) {
     TYPE fout[DIMFOUT], xi[DIMX], yj[DIMY];
-    __TYPEACC__ acc[DIMRED];
 #if SUM_SCHEME == BLOCK_SUM
     // additional tmp vector to store intermediate results from each block
-    TYPE tmp[DIMRED];
+    TYPE tmp[FUN::DIMRED];
 #elif SUM_SCHEME == KAHAN_SCHEME
     // additional tmp vector to accumulate errors
     const int DIM_KAHAN = FUN::template KahanScheme<__TYPEACC__,TYPE>::DIMACC;
     TYPE tmp[DIM_KAHAN];
 #endif
-      load< DIMSX, INDSI >(i, xi, args);
-      typename FUN::template InitializeReduction< __TYPEACC__, TYPE >()(acc);   // acc = 0
+    load_< STRIDED, DIMSX, INDSI >(i, xi, args, strides);
+    typename FUN::template InitializeReduction< __TYPEACC__, TYPE >()(acc);   // acc = 0
 #if SUM_SCHEME == BLOCK_SUM
-      typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp);   // tmp = 0
+    typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp);   // tmp = 0
 #elif SUM_SCHEME == KAHAN_SCHEME
-      VectAssign<DIM_KAHAN>(tmp,0.0f);
+    VectAssign<DIM_KAHAN>(tmp,0.0f);
 #endif
-      for (int j = 0; j < ny; j++) {
-        load< DIMSY, INDSJ >(j, yj, args);
-        call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, pp);
+    for (int j = jbegin; j < jend; j++) {
+      load_< STRIDED, DIMSY, INDSJ >(j, yj, args, strides);
+      call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, pp);
 #if SUM_SCHEME == BLOCK_SUM
-        typename FUN::template ReducePairShort< TYPE, TYPE >()(tmp, fout, j); // tmp += fout
-        if ((j+1)%200) {
-            typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
-            typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp);   // tmp = 0
-        }
+      typename FUN::template ReducePairShort< TYPE, TYPE >()(tmp, fout, j); // tmp += fout
+      if ((j+1)%200) {
+          typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
+          typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp);   // tmp = 0
+      }
+#elif SUM_SCHEME == KAHAN_SCHEME
+      typename FUN::template KahanScheme<__TYPEACC__,TYPE>()(acc, fout, tmp);
+#else
+      typename FUN::template ReducePairShort< __TYPEACC__, TYPE >()(acc, fout, j); // acc += fout
+#endif
+    }
+#if SUM_SCHEME == BLOCK_SUM
+    typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
+#endif
+  }
+
+  // Sizes of the tiles of the tiled scheme (see CpuConvTile_), chosen from the dimensions of the formula
+  // unless the CPU_TILE_I and CPU_BLOCK_J flags are set: the TILE_I lines i of a tile (variables and
+  // accumulators) should fit in CPU_TILE_BYTES, and a block of BLOCK_J lines j in CPU_BLOCK_BYTES.
+  template < typename TYPE, class FUN >
+  struct Tiles {
+    static const int BYTES_I = (FUN::DIMSX::SUM + FUN::F::DIM) * sizeof(TYPE) + 2 * FUN::DIMRED * sizeof(__TYPEACC__);
+    static const int BYTES_J = FUN::DIMSY::SUM * sizeof(TYPE);
+    static const int MAX_TILE_I = 8; // we do not need more independent accumulators than that
+    static const int TILE_I = (CPU_TILE_I > 0) ? CPU_TILE_I
+                              : (CPU_TILE_BYTES < BYTES_I) ? 1
+                              : (CPU_TILE_BYTES / BYTES_I > MAX_TILE_I) ? MAX_TILE_I
+                              : CPU_TILE_BYTES / BYTES_I;
+    static const int BLOCK_J = (CPU_BLOCK_J > 0) ? CPU_BLOCK_J
+                               : (BYTES_J == 0) ? CPU_BLOCK_BYTES
+                               : (CPU_BLOCK_BYTES < BYTES_J) ? 1
+                               : CPU_BLOCK_BYTES / BYTES_J;
+    // packets of CPU_PACKET_WIDTH lines j are used if the packets of the variables of a tile fit in CPU_TILE_BYTES
+    static const int BYTES_PACKETS = (TILE_I * FUN::DIMSX::SUM + FUN::DIMSY::SUM + FUN::DIMSP::SUM + FUN::F::DIM)
+                                     * CPU_PACKET_WIDTH * sizeof(TYPE);
+    static const bool PACKETS = (CPU_PACKET_WIDTH > 1) && (BYTES_PACKETS <= CPU_TILE_BYTES);
+    // size of the tmp vector of a line, for the block sum and Kahan schemes
+#if SUM_SCHEME == BLOCK_SUM
+    static const int DIMTMP = FUN::DIMRED;
 #elif SUM_SCHEME == KAHAN_SCHEME
-        typename FUN::template KahanScheme<__TYPEACC__,TYPE>()(acc, fout, tmp);
+    static const int DIMTMP = FUN::template KahanScheme<__TYPEACC__,TYPE>::DIMACC;
 #else
-        typename FUN::template ReducePairShort< __TYPEACC__, TYPE >()(acc, fout, j); // acc += fout
+    static const int DIMTMP = 0;
 #endif
+  };
+
+  // Accumulates fout, the value of the formula for the pair (i,j), in the accumulator acc of the line i
+  // (and its tmp vector, for the block sum and Kahan schemes).
+  template < typename TYPE, class FUN >
+  static INLINE void ReducePair_(__TYPEACC__ *acc, TYPE *tmp, TYPE *fout, int j) {
+#if SUM_SCHEME == BLOCK_SUM
+    typename FUN::template ReducePairShort< TYPE, TYPE >()(tmp, fout, j); // tmp += fout
+    if ((j+1)%200) {
+        typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
+        typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp);   // tmp = 0
+    }
+#elif SUM_SCHEME == KAHAN_SCHEME
+    typename FUN::template KahanScheme<__TYPEACC__,TYPE>()(acc, fout, tmp);
+#else
+    typename FUN::template ReducePairShort< __TYPEACC__, TYPE >()(acc, fout, j); // acc += fout
+#endif
+  }
+
+#if CPU_PACKET_WIDTH > 1
+  // Evaluates the formula for the ni lines of a tile and the W = CPU_PACKET_WIDTH consecutive lines
+  // jstart, ..., jstart+W-1 of the block yjs, with packets of W values (see Packet.h): xpk and ppk hold the
+  // "i" variables and the parameters broadcasted to packets. The W values of each line are then reduced
+  // in the order of j, as with the scalar evaluation.
+  template < typename TYPE, class FUN >
+  static INLINE void CpuConvPacket_(FUN fun, int ni, int jstart, TYPE *yjs, Packet< TYPE, CPU_PACKET_WIDTH > *xpk,
+                                    Packet< TYPE, CPU_PACKET_WIDTH > *ppk, __TYPEACC__ *acc, TYPE *tmp) {
+    typedef typename FUN::DIMSX DIMSX; // dimensions of "i" indexed variables
+    typedef typename FUN::DIMSY DIMSY; // dimensions of "j" indexed variables
+    typedef typename FUN::DIMSP DIMSP; // dimensions of parameters variables
+    const int W = CPU_PACKET_WIDTH;
+    const int DIMX = DIMSX::SUM; // total size of "i" indexed variables
+    const int DIMY = DIMSY::SUM; // total size of "j" indexed variables
+    const int DIMRED = FUN::DIMRED; // dimension of reduction operation
+    const int DIMFOUT = FUN::F::DIM; // dimension of output variable of inner function
+    const int DIMTMP = Tiles< TYPE, FUN >::DIMTMP;
+    Packet< TYPE, W > ypk[DIMY], foutpk[DIMFOUT];
+    TYPE fout[DIMFOUT];
+    // "structure of arrays" transposition of the W lines j
+    for (int k = 0; k < DIMY; k++)
+      for (int w = 0; w < W; w++)
+        ypk[k].lane[w] = yjs[w * DIMY + k];
+    for (int r = 0; r < ni; r++) {
+      call< DIMSX, DIMSY, DIMSP >(fun, foutpk, xpk + r * DIMX, ypk, ppk);
+      for (int w = 0; w < W; w++) {
+        for (int k = 0; k < DIMFOUT; k++)
+          fout[k] = foutpk[k].lane[w];
+        ReducePair_< TYPE, FUN >(acc + r * DIMRED, tmp + r * DIMTMP, fout, jstart + w);
       }
+    }
+  }
+#endif
+
+  // Computes the (non finalized) reductions of the ni <= TILE_I lines i0, ..., i0+ni-1 over the lines
+  // j = jbegin, ..., jend-1 into acc. The "j" variables are
+  // loaded by blocks of BLOCK_J lines in the buffer yjs, and each y_j is used for all the lines of the tile
+  // before the next one: the "j" variables are read nx/TILE_I times instead of nx times, and the reductions
+  // of the lines of the tile are independent, which lets the processor pipeline them.
+  // If Tiles::PACKETS, the formula is evaluated for CPU_PACKET_WIDTH lines j at once (see CpuConvPacket_).
+  template < bool STRIDED, typename TYPE, class FUN >
+  static INLINE void CpuConvTile_(FUN fun, int i0, int ni, int jbegin, int jend, __TYPEACC__ *acc, TYPE *pp, TYPE **args,
+                                  int *strides, TYPE *yjs) {
+    typedef typename FUN::DIMSX DIMSX; // dimensions of "i" indexed variables
+    typedef typename FUN::DIMSY DIMSY; // dimensions of "j" indexed variables
+    typedef typename FUN::DIMSP DIMSP; // dimensions of parameters variables
+    typedef typename FUN::INDSI INDSI;
+    typedef typename FUN::INDSJ INDSJ;
+    const int TILE_I = Tiles< TYPE, FUN >::TILE_I;
+    const int BLOCK_J = Tiles< TYPE, FUN >::BLOCK_J;
+    const int DIMX = DIMSX::SUM; // total size of "i" indexed variables
+    const int DIMY = DIMSY::SUM; // total size of "j" indexed variables
+    const int DIMRED = FUN::DIMRED; // dimension of reduction operation
+    const int DIMFOUT = FUN::F::DIM; // dimension of output variable of inner function
+    const int DIMTMP = Tiles< TYPE, FUN >::DIMTMP;
+    TYPE fout[DIMFOUT], xi[TILE_I * DIMX];
+    TYPE tmp[TILE_I * DIMTMP + 1];
+    for (int r = 0; r < ni; r++) {
+      load_< STRIDED, DIMSX, INDSI >(i0 + r, xi + r * DIMX, args, strides);
+      typename FUN::template InitializeReduction< __TYPEACC__, TYPE >()(acc + r * DIMRED);   // acc = 0
+#if SUM_SCHEME == BLOCK_SUM
+      typename FUN::template InitializeReduction< TYPE, TYPE >()(tmp + r * DIMRED);   // tmp = 0
+#elif SUM_SCHEME == KAHAN_SCHEME
+      VectAssign<DIMTMP>(tmp + r * DIMTMP, 0.0f);
+#endif
+    }
+#if CPU_PACKET_WIDTH > 1
+    const int W = Tiles< TYPE, FUN >::PACKETS ? CPU_PACKET_WIDTH : BLOCK_J + 1;   // no packets if W > BLOCK_J
+    Packet< TYPE, CPU_PACKET_WIDTH > xpk[TILE_I * DIMX], ppk[DIMSP::SUM];
+    if (Tiles< TYPE, FUN >::PACKETS) {
+      for (int k = 0; k < ni * DIMX; k++)
+        xpk[k] = xi[k];
+      for (int k = 0; k < DIMSP::SUM; k++)
+        ppk[k] = pp[k];
+    }
+#endif
+    for (int jstart = jbegin; jstart < jend; jstart += BLOCK_J) {
+      const int nj = (jend - jstart < BLOCK_J) ? jend - jstart : BLOCK_J;
+      for (int jrel = 0; jrel < nj; jrel++)
+        load_< STRIDED, DIMSY, INDSJ >(jstart + jrel, yjs + jrel * DIMY, args, strides);
+      int jrel = 0;
+#if CPU_PACKET_WIDTH > 1
+      for (; jrel + W <= nj; jrel += W)
+        CpuConvPacket_< TYPE >(fun, ni, jstart + jrel, yjs + jrel * DIMY, xpk, ppk, acc, tmp);
+#endif
+      for (; jrel < nj; jrel++)
+        for (int r = 0; r < ni; r++) {
+          call< DIMSX, DIMSY, DIMSP >(fun, fout, xi + r * DIMX, yjs + jrel * DIMY, pp);
+          ReducePair_< TYPE, FUN >(acc + r * DIMRED, tmp + r * DIMTMP, fout, jstart + jrel);
+        }
+    }
 #if SUM_SCHEME == BLOCK_SUM
-      typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
-#endif          
-      typename FUN::template FinalizeOutput< __TYPEACC__, TYPE >()(acc, out + i * DIMOUT, i);
+    for (int r = 0; r < ni; r++)
+      typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc + r * DIMRED, tmp + r * DIMRED); // acc += tmp
+#endif
+  }
+
+  // Computes the (non finalized) reductions of the ni lines i0, ..., i0+ni-1 over the lines j = jbegin, ..., jend-1
+  // into acc, with the tiled scheme if CPU_TILED and line by line otherwise.
+  template < bool STRIDED, typename TYPE, class FUN >
+  static INLINE void CpuConvAcc_(FUN fun, int i0, int ni, int jbegin, int jend, __TYPEACC__ *acc, TYPE *pp, TYPE **args,
+                                 int *strides, TYPE *yjs) {
+#if CPU_TILED
+    CpuConvTile_< STRIDED >(fun, i0, ni, jbegin, jend, acc, pp, args, strides, yjs);
+#else
+    for (int r = 0; r < ni; r++)
+      CpuConvLine_< STRIDED >(fun, i0 + r, jbegin, jend, acc + r * FUN::DIMRED, pp, args, strides);
+#endif
+  }
+
+  // Computes the reductions of the ni <= TILE_I lines i0, ..., i0+ni-1 into out (see FinalizeOutput_ for accumulate).
+  template < bool STRIDED, typename TYPE, class FUN >
+  static INLINE void CpuConvRows_(FUN fun, int i0, int ni, int ny, TYPE *out, TYPE *pp, TYPE **args, int *strides, TYPE *yjs,
+                                  bool accumulate) {
+    const int DIMRED = FUN::DIMRED; // dimension of reduction operation
+    const int DIMOUT = FUN::DIM; // dimension of output variable
+    __TYPEACC__ acc[Tiles< TYPE, FUN >::TILE_I * DIMRED];
+    CpuConvAcc_< STRIDED >(fun, i0, ni, 0, ny, acc, pp, args, strides, yjs);
+    for (int r = 0; r < ni; r++)
+      FinalizeOutput_< TYPE, FUN >(acc + r * DIMRED, out + r * DIMOUT, i0 + r, accumulate);
+  }
+
+  // Number of chunks of lines j of the 2D scheme: with the 1D scheme, the threads share the ntiles tiles of
+  // lines i, and most of them are idle if there are few tiles (e.g. for a few queries against many points).
+  // The 2D scheme then also splits the reduction axis in chunks of at least CPU_MIN_CHUNK_J lines j, so that
+  // there are about 4 (tile, chunk) tasks per thread. 1 means that the 1D scheme is used.
+  static int NumChunks_(int ntiles, int ny, int nthreads) {
+    if (!CPU_2D || nthreads == 1 || ntiles >= 4 * nthreads)
+      return 1;
+    const int nchunks = (4 * nthreads + ntiles - 1) / ntiles;
+    const int maxchunks = ny / CPU_MIN_CHUNK_J;
+    return (nchunks < maxchunks) ? nchunks : (maxchunks > 1 ? maxchunks : 1);
+  }
+
+  // Computes the reduction of all the lines with the 2D scheme: each (tile, chunk) task computes the partial
+  // reductions of the lines of its tile over its chunk of lines j, and the nchunks partial reductions of each
+  // line are then merged with ReducePair, in the order of the chunks - as in the 2D scheme of the Gpu engine.
+  template < bool STRIDED, typename TYPE, class FUN >
+  static void CpuConvLines2D_(FUN fun, int nx, int ny, int nchunks, int nthreads, bool accumulate, TYPE *out, TYPE *pp,
+                              TYPE **args, int *strides) {
+    const int DIMOUT = FUN::DIM; // dimension of output variable
+    const int DIMRED = FUN::DIMRED; // dimension of reduction operation
+#if CPU_TILED
+    const int DIMY = FUN::DIMSY::SUM; // total size of "j" indexed variables
+    const int TILE_I = Tiles< TYPE, FUN >::TILE_I;
+    const int BLOCK_J = Tiles< TYPE, FUN >::BLOCK_J;
+#else
+    const int TILE_I = 1;
+#endif
+    const int ntiles = (nx + TILE_I - 1) / TILE_I;
+    const int chunk_j = (ny + nchunks - 1) / nchunks;
+#if CPU_TILED
+    const int BUFFER_J = ((chunk_j < BLOCK_J) ? chunk_j : BLOCK_J) * DIMY;
+#else
+    const int BUFFER_J = 0;
+#endif
+    // partial reductions of the lines i over the chunks c, in partials[(c * nx + i) * DIMRED]
+    std::vector< __TYPEACC__ > partials(nchunks * nx * DIMRED);
+#pragma omp parallel num_threads(nthreads)
+    {
+      std::vector< TYPE > yjs(BUFFER_J);
+#pragma omp for schedule(runtime)
+      for (int task = 0; task < ntiles * nchunks; task++) {
+        const int t = task / nchunks, c = task % nchunks;
+        const int i0 = t * TILE_I, ni = (nx - i0 < TILE_I) ? nx - i0 : TILE_I;
+        const int jbegin = c * chunk_j, jend = (ny - jbegin < chunk_j) ? ny : jbegin + chunk_j;
+        CpuConvAcc_< STRIDED >(fun, i0, ni, jbegin, jend, &partials[(c * nx + i0) * DIMRED], pp, args, strides, yjs.data());
+      }
+#pragma omp for
+      for (int i = 0; i < nx; i++) {
+        __TYPEACC__ *acc = &partials[i * DIMRED];
+        for (int c = 1; c < nchunks; c++)
+          typename FUN::template ReducePair< __TYPEACC__, __TYPEACC__ >()(acc, &partials[(c * nx + i) * DIMRED]); // acc += partial
+        FinalizeOutput_< TYPE, FUN >(acc, out + i * DIMOUT, i, accumulate);
+      }
     }
+  }
+
+  // Computes the reduction of all the lines, given the values pp of the parameters. The number of threads and
+  // the schedule of the loop over the tiles are given by the options of the calling thread (see CpuOptions.h).
+  template < bool STRIDED, typename TYPE, class FUN >
+  static void CpuConvLines_(FUN fun, int nx, int ny, TYPE *out, TYPE *pp, TYPE **args, int *strides) {
+    const int DIMOUT = FUN::DIM; // dimension of output variable
+    // the lines are processed by tiles of TILE_I lines ; the buffer of a block of lines j has size BUFFER_J
+#if CPU_TILED
+    const int DIMY = FUN::DIMSY::SUM; // total size of "j" indexed variables
+    const int TILE_I = Tiles< TYPE, FUN >::TILE_I;
+    const int BLOCK_J = Tiles< TYPE, FUN >::BLOCK_J;
+    const int BUFFER_J = ((ny < BLOCK_J) ? ny : BLOCK_J) * DIMY;
+#else
+    const int TILE_I = 1;
+    const int BUFFER_J = 0;
+#endif
+    const int ntiles = (nx + TILE_I - 1) / TILE_I;
+    CpuThreads threads;
+    threads.set_schedule(CPU_SCHEDULE_STATIC);
+    const int nthreads = threads.num_threads;
+
+#if FULL_REDUCTION
+    // The lines of the output are summed too (this is only used for sum reductions): each thread accumulates
+    // the lines of its block in a partial sum, and the partial sums are then merged by a binary tree, in a fixed
+    // order. The temporary memory is O(threads x DIMOUT) instead of O(nx x DIMOUT), and for a given number
+    // of threads the result does not depend on the scheduling of the threads: the schedule of the options is
+    // not used here.
+    std::vector< __TYPEACC__ > partials(nthreads * DIMOUT);
+    for (int t = 0; t < nthreads; t++)
+      typename FUN::template InitializeReduction< __TYPEACC__, TYPE >()(&partials[t * DIMOUT]);   // partial = 0
+#pragma omp parallel num_threads(nthreads)
+    {
+#ifdef USE_OPENMP
+      __TYPEACC__ *partial = &partials[omp_get_thread_num() * DIMOUT];
+#else
+      __TYPEACC__ *partial = &partials[0];
+#endif
+      TYPE outi[TILE_I * DIMOUT];
+      std::vector< TYPE > yjs(BUFFER_J);
+#pragma omp for schedule(static)
+      for (int t = 0; t < ntiles; t++) {
+        const int i0 = t * TILE_I, ni = (nx - i0 < TILE_I) ? nx - i0 : TILE_I;
+        CpuConvRows_< STRIDED >(fun, i0, ni, ny, outi, pp, args, strides, yjs.data(), false);
+        for (int r = 0; r < ni; r++)
+          typename FUN::template ReducePair< __TYPEACC__, TYPE >()(partial, outi + r * DIMOUT); // partial += outi
+      }
+    }
+    for (int step = 1; step < nthreads; step *= 2)
+      for (int t = 0; t + step < nthreads; t += 2 * step)
+        typename FUN::template ReducePair< __TYPEACC__, __TYPEACC__ >()(&partials[t * DIMOUT], &partials[(t + step) * DIMOUT]); // partials[t] += partials[t+step]
+    FinalizeOutput_< TYPE, FUN >(&partials[0], out, 0, threads.accumulate);
+#else
+    const int nchunks = NumChunks_(ntiles, ny, nthreads);
+    if (nchunks > 1) {
+      CpuConvLines2D_< STRIDED >(fun, nx, ny, nchunks, nthreads, threads.accumulate, out, pp, args, strides);
+      return;
+    }
+    auto tiles = [&]() {
+      std::vector< TYPE > yjs(BUFFER_J);
+#pragma omp for schedule(runtime)
+      for (int t = 0; t < ntiles; t++) {
+        const int i0 = t * TILE_I, ni = (nx - i0 < TILE_I) ? nx - i0 : TILE_I;
+        CpuConvRows_< STRIDED >(fun, i0, ni, ny, out + i0 * DIMOUT, pp, args, strides, yjs.data(), threads.accumulate);
+      }
+    };
+    if (threads.numa) {
+      // each thread computes a contiguous block of lines, and is the first one to write its block of the output:
+      // its memory pages are placed on the NUMA node of the thread
+#pragma omp parallel num_threads(nthreads) proc_bind(spread)
+      tiles();
+    } else {
+#pragma omp parallel num_threads(nthreads)
+      tiles();
+    }
+#endif
+  }
+
+  // strides is nullptr if all the arrays are contiguous (see load_strided)
+  template < typename TYPE, class FUN >
+  static int CpuConv_(FUN fun, int nx, int ny, TYPE *out, TYPE **args, int *strides = nullptr) {
+    typedef typename FUN::DIMSP DIMSP; // dimensions of parameters variables
+    typedef typename FUN::INDSP INDSP;
+    const int DIMP = DIMSP::SUM; // total size of parameters variables
+    TYPE pp[DIMP];
+    load< DIMSP, INDSP >(0, pp, args);
+
+    if (strides == nullptr)
+      CpuConvLines_< false >(fun, nx, ny, out, pp, args, strides);
+    else
+      CpuConvLines_< true >(fun, nx, ny, out, pp, args, strides);
 
     return 0;
   }
@@ -93,5 +409,11 @@ struct CpuConv {
   static int Eval(FUN fun, int nx, int ny, TYPE *out, TYPE **pargs) {
     return CpuConv_(fun, nx, ny, out, pargs);
   }
+
+// Idem, with the strides of the arrays.
+  template < typename TYPE, class FUN >
+  static int Eval(FUN fun, int nx, int ny, TYPE *out, TYPE **pargs, int *strides) {
+    return CpuConv_(fun, nx, ny, out, pargs, strides);
+  }
 };
 }
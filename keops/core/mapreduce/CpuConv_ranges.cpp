@@ -3,6 +3,7 @@
 #include <stdio.h>
 #include <assert.h>
 #include <vector>
+#include <algorithm>
 
 #ifdef USE_OPENMP
 #include <omp.h>
@@ -14,12 +15,58 @@
 #include "core/pack/Call.h"
 #include "core/pack/GetInds.h"
 #include "broadcast_batch_dimensions.h"
+#include "core/mapreduce/CpuOptions.h"
 
 // Host implementation of the convolution, for comparison
 
 namespace keops {
 
 struct CpuConv_ranges {
+
+  // A task of the block-sparse reduction: the lines [start, end) of the range range_index, whose cost is
+  // the number of pairs (i,j) that it reduces.
+  struct Task {
+    int range_index;
+    __INDEX__ start, end;
+    int64_t cost;
+  };
+
+  // Builds the work list of the block-sparse reduction, which is processed by a single parallel loop. The cost of
+  // a line of a range is the number of indices j of its slices: the ranges whose cost is above the average cost of
+  // 4 tasks per thread are cut into chunks of lines of about this cost, and the tasks are sorted by decreasing cost,
+  // so that with a dynamic schedule the threads end with the small tasks (e.g. the many small clusters of a
+  // grid_cluster). Each line belongs to a single task: the results do not depend on the work list.
+  static std::vector< Task > WorkList_(int nranges, __INDEX__ *ranges_x, __INDEX__ *slices_x, __INDEX__ *ranges_y,
+                                       int nthreads) {
+    std::vector< int64_t > costs(nranges); // cost of a line of each range
+    int64_t total = 0;
+    for (int range_index = 0; range_index < nranges; range_index++) {
+      __INDEX__ start_slice = (range_index < 1) ? 0 : slices_x[range_index - 1];
+      int64_t cost = 0;
+      for (__INDEX__ slice = start_slice; slice < slices_x[range_index]; slice++)
+        cost += ranges_y[2 * slice + 1] - ranges_y[2 * slice];
+      costs[range_index] = (cost > 0) ? cost : 1; // the lines without indices j are still finalized
+      total += costs[range_index] * (ranges_x[2 * range_index + 1] - ranges_x[2 * range_index]);
+    }
+
+    const int64_t target = (nthreads > 1) ? total / (4 * nthreads) : total; // cost of the chunks of lines
+    std::vector< Task > tasks;
+    tasks.reserve(nranges);
+    for (int range_index = 0; range_index < nranges; range_index++) {
+      __INDEX__ start_x = ranges_x[2 * range_index];
+      __INDEX__ end_x = ranges_x[2 * range_index + 1];
+      int64_t lines = target / costs[range_index];
+      __INDEX__ chunk = (lines < 1) ? 1 : ((lines < end_x - start_x) ? (__INDEX__) lines : end_x - start_x);
+      for (__INDEX__ start = start_x; start < end_x; start += chunk) {
+        __INDEX__ end = (end_x - start > chunk) ? start + chunk : end_x;
+        tasks.push_back({ range_index, start, end, costs[range_index] * (end - start) });
+      }
+    }
+    if (nthreads > 1)
+      std::stable_sort(tasks.begin(), tasks.end(), [](const Task &a, const Task &b) { return a.cost > b.cost; });
+    return tasks;
+  }
+
   template< typename TYPE, class FUN >
   static int CpuConv_ranges_(FUN fun, int nx, int ny,
                              int nbatchdims, int* shapes,
@@ -75,9 +122,14 @@ struct CpuConv_ranges {
     TYPE pp[DIMP];
     load< DIMSP, INDSP >(0, pp, args);  // If nbatchdims == 0, the parameters are fixed once and for all
         
+    // The number of threads and the schedule of the loops are given by the options of the calling thread
+    // (see CpuOptions.h).
+    CpuThreads threads;
+
     // Set the output to zero, as the ranges may not cover the full output -----
+    // (if the output of the reduction is added to out, the lines that are not covered are left unchanged)
     __TYPEACC__ acctmp[DIMRED];
-    for (int i = 0; i < nx; i++) {
+    for (int i = 0; i < nx && !threads.accumulate; i++) {
       typename FUN::template InitializeReduction< __TYPEACC__, TYPE >()(acctmp);
       typename FUN::template FinalizeOutput< __TYPEACC__, TYPE >()(acctmp, out + i * DIMOUT, i);
     }
@@ -94,18 +146,28 @@ struct CpuConv_ranges {
     __INDEX__* slices_x = FUN::tagJ ? ranges[1] : ranges[4];
     __INDEX__* ranges_y = FUN::tagJ ? ranges[2] : ranges[5];
 
-    int indices_i[SIZEI], indices_j[SIZEJ], indices_p[SIZEP];  // Buffers for the "broadcasted indices"
-    for (int k = 0; k < SIZEI; k++) { indices_i[k] = 0; }  // Fill the "offsets" with zeroes,
-    for (int k = 0; k < SIZEJ; k++) { indices_j[k] = 0; }  // the default value when nbatchdims == 0.
-    for (int k = 0; k < SIZEP; k++) { indices_p[k] = 0; }
-    
-    for (int range_index = 0; range_index < nranges; range_index++) {
+    // The (range, chunk of lines) tasks of the work list are processed by a single parallel loop (see WorkList_).
+    // By default, the tasks are scheduled dynamically.
+    const int nthreads = threads.num_threads;
+    threads.set_schedule(CPU_SCHEDULE_DYNAMIC);
+    const std::vector< Task > tasks = WorkList_(nranges, ranges_x, slices_x, ranges_y, nthreads);
+    const int ntasks = tasks.size();
+
+#pragma omp parallel for schedule(runtime) num_threads(nthreads)
+    for (int task = 0; task < ntasks; task++) {
 
+      const int range_index = tasks[task].range_index;
       __INDEX__ start_x = ranges_x[2 * range_index];
-      __INDEX__ end_x = ranges_x[2 * range_index + 1];
   
       __INDEX__ start_slice = (range_index < 1) ? 0 : slices_x[range_index - 1];
       __INDEX__ end_slice = slices_x[range_index];
+
+      int indices_i[SIZEI], indices_j[SIZEJ], indices_p[SIZEP];  // Buffers for the "broadcasted indices"
+      for (int k = 0; k < SIZEI; k++) { indices_i[k] = 0; }  // Fill the "offsets" with zeroes,
+      for (int k = 0; k < SIZEJ; k++) { indices_j[k] = 0; }  // the default value when nbatchdims == 0.
+      for (int k = 0; k < SIZEP; k++) { indices_p[k] = 0; }
+      TYPE ppb[DIMP];
+      TYPE *ppt = pp; // parameters of the range
   
       // If needed, compute the "true" start indices of the range, turning
       // the "abstract" index start_x into an array of actual "pointers/offsets" stored in indices_i:
@@ -113,11 +175,11 @@ struct CpuConv_ranges {
         vect_broadcast_index(start_x, nbatchdims, SIZEI, shapes, shapes_i, indices_i);
         // And for the parameters, too:
         vect_broadcast_index(range_index, nbatchdims, SIZEP, shapes, shapes_p, indices_p);
-        load< DIMSP, INDSP >(0, pp, args, indices_p); // Load the paramaters, once per tile
+        load< DIMSP, INDSP >(0, ppb, args, indices_p); // Load the paramaters, once per task
+        ppt = ppb;
       }
 
-#pragma omp parallel for   
-      for (__INDEX__ i = start_x; i < end_x; i++) {
+      for (__INDEX__ i = tasks[task].start; i < tasks[task].end; i++) {
         TYPE xi[DIMX], yj[DIMY], fout[DIMFOUT];
         __TYPEACC__ acc[DIMRED];
 #if SUM_SCHEME == BLOCK_SUM
@@ -152,7 +214,7 @@ struct CpuConv_ranges {
           if (nbatchdims == 0) {
             for (int j = start_y; j < end_y; j++) {
               load< DIMSY, INDSJ >(j, yj, args);
-              call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, pp);
+              call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, ppt);
 #if SUM_SCHEME == BLOCK_SUM
               typename FUN::template ReducePairShort< TYPE, TYPE >()(tmp, fout, j); // tmp += fout
               if ((j+1)%200) {
@@ -169,7 +231,7 @@ struct CpuConv_ranges {
           else {
             for (int j = start_y; j < end_y; j++) {
               load< DIMSY, INDSJ >(j - start_y, yj, args, indices_j);
-              call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, pp);
+              call< DIMSX, DIMSY, DIMSP >(fun, fout, xi, yj, ppt);
 #if SUM_SCHEME == BLOCK_SUM
               typename FUN::template ReducePairShort< TYPE, TYPE >()(tmp, fout, j - start_y); // tmp += fout
               if ((j+1)%200) {
@@ -187,7 +249,7 @@ struct CpuConv_ranges {
 #if SUM_SCHEME == BLOCK_SUM
         typename FUN::template ReducePair< __TYPEACC__, TYPE >()(acc, tmp); // acc += tmp
 #endif
-        typename FUN::template FinalizeOutput< __TYPEACC__, TYPE >()(acc, out + i * DIMOUT, i);
+        FinalizeOutput_< TYPE, FUN >(acc, out + i * DIMOUT, i, threads.accumulate);
       }
 
     }
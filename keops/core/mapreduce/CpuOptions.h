@@ -0,0 +1,93 @@
+#pragma once
+
+#include "core/pre_headers.h"
+
+#ifdef USE_OPENMP
+#include <omp.h>
+#endif
+
+namespace keops {
+
+// Options of the Cpu engine that are given at call time, without recompiling the formula (e.g. by the
+// num_threads and schedule arguments of Genred in pykeops): they are set by CpuSetOptions (see link_autodiff.cpp)
+// for the next calls of the calling thread, and read by CpuConv and CpuConv_ranges before their parallel regions.
+
+#define CPU_SCHEDULE_DEFAULT -1 // the default schedule of each loop
+#define CPU_SCHEDULE_STATIC 0
+#define CPU_SCHEDULE_DYNAMIC 1
+#define CPU_SCHEDULE_GUIDED 2
+#define CPU_SCHEDULE_NUMA 3 // static schedule with contiguous blocks of lines, and threads spread over the cores
+
+struct CpuOptions {
+  int num_threads = 0; // number of threads ; 0 means the default number of threads of OpenMP
+  int schedule = CPU_SCHEDULE_DEFAULT; // schedule of the loops over the lines
+  int chunk = 0; // chunk size of the schedule ; 0 means the default chunk size of OpenMP
+  bool accumulate = false; // true if the output of the reduction is added to the output array (see FinalizeOutput_)
+
+  // options of the calling thread
+  static CpuOptions &current() {
+    static thread_local CpuOptions options;
+    return options;
+  }
+};
+
+// Applies the options of the calling thread to the parallel regions that it starts: num_threads is the number of
+// threads of these regions, and set_schedule sets the schedule of their loops with a schedule(runtime) clause.
+// The previous schedule of the calling thread is restored at the end of the scope.
+struct CpuThreads {
+  int num_threads;
+  bool numa; // true if the threads should be spread over the cores (proc_bind(spread)), see CPU_SCHEDULE_NUMA
+  bool accumulate; // see CpuOptions::accumulate
+
+  CpuThreads() {
+    const CpuOptions &options = CpuOptions::current();
+#ifdef USE_OPENMP
+    num_threads = (options.num_threads > 0) ? options.num_threads : omp_get_max_threads();
+    omp_get_schedule(&saved_kind, &saved_chunk);
+#else
+    num_threads = 1;
+#endif
+    numa = (options.schedule == CPU_SCHEDULE_NUMA);
+    accumulate = options.accumulate;
+  }
+
+  // default_schedule is used if the options do not specify a schedule
+  void set_schedule(int default_schedule) {
+#ifdef USE_OPENMP
+    const CpuOptions &options = CpuOptions::current();
+    const omp_sched_t kinds[] = { omp_sched_static, omp_sched_dynamic, omp_sched_guided, omp_sched_static };
+    if (options.schedule == CPU_SCHEDULE_DEFAULT)
+      omp_set_schedule(kinds[default_schedule], 0);
+    else
+      omp_set_schedule(kinds[options.schedule], numa ? 0 : options.chunk); // blocks of lines are contiguous with numa
+#endif
+  }
+
+  ~CpuThreads() {
+#ifdef USE_OPENMP
+    omp_set_schedule(saved_kind, saved_chunk);
+#endif
+  }
+
+#ifdef USE_OPENMP
+ private:
+  omp_sched_t saved_kind;
+  int saved_chunk;
+#endif
+};
+
+// Writes the output of the line i, given its accumulator acc, in out - or adds it to out if accumulate is true
+// (e.g. with the accumulate option of Genred): the output array then needs no temporary copy.
+template < typename TYPE, class FUN >
+INLINE void FinalizeOutput_(__TYPEACC__ *acc, TYPE *out, int i, bool accumulate) {
+  if (accumulate) {
+    TYPE outi[FUN::DIM];
+    typename FUN::template FinalizeOutput< __TYPEACC__, TYPE >()(acc, outi, i);
+    for (int k = 0; k < FUN::DIM; k++)
+      out[k] += outi[k];
+  } else {
+    typename FUN::template FinalizeOutput< __TYPEACC__, TYPE >()(acc, out, i);
+  }
+}
+
+}
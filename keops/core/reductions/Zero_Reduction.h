@@ -5,6 +5,7 @@
 #include "core/reductions/Reduction.h"
 #include "core/formulas/constants/Zero.h"
 #include "core/utils/TypesUtils.h"
+#include "core/mapreduce/CpuOptions.h"
 
 namespace keops {
 
@@ -35,6 +36,8 @@ template < int DIM, int tagI, class MODE >
 struct Eval< Zero_Reduction < DIM, tagI >, MODE > {
 template < typename TYPE, typename... Args >
 static int Run(int nx, int ny, TYPE *out, Args... args) {
+  if (CpuOptions::current().accumulate)
+    return 0; // the output of the reduction is added to out (see FinalizeOutput_)
   for (int k = 0; k < (tagI == 0 ? nx : ny) * DIM; k++)
     out[k] = cast_to<TYPE>(0.0f);
   return 0;
@@ -53,6 +56,8 @@ static int Run(int nx, int ny,
                int nbatchdims, int *shapes,
                int nranges_x, int nranges_y, __INDEX__ **ranges,
                TYPE *out, Args... args) {
+  if (CpuOptions::current().accumulate)
+    return 0; // the output of the reduction is added to out (see FinalizeOutput_)
   for (int k = 0; k < (tagI == 0 ? nx : ny) * DIM; k++)
     out[k] = cast_to<TYPE>(0.0f);
   return 0;
@@ -0,0 +1,143 @@
+#pragma once
+
+#include "core/pre_headers.h"
+#include "core/utils/keops_math.h"
+
+namespace keops {
+
+//////////////////////////////////////////////////////////////
+////              PACKETS : Packet< TYPE, W >             ////
+//////////////////////////////////////////////////////////////
+
+// A Packet< TYPE, W > holds W values of type TYPE, e.g. the values of a variable for W consecutive
+// indices j, with element-wise arithmetic operations. The Cpu engine may evaluate formulas on packets
+// (see CPU_PACKET_WIDTH in CpuConv.cpp), in the same way as the Gpu engine evaluates them on pairs
+// of half floats (half2): each operation is applied to the W values at once, with loops over the
+// W lanes that the compiler turns into SIMD instructions.
+// The lanes are computed independently with the scalar operations, so that the results are the
+// same as with the scalar evaluation of the formula.
+
+template < typename TYPE, int W >
+struct Packet {
+  TYPE lane[W];
+
+  Packet() = default;
+
+  // a scalar is broadcasted to all the lanes
+  INLINE Packet(TYPE x) {
+#pragma omp simd
+    for (int w = 0; w < W; w++)
+      lane[w] = x;
+  }
+
+  INLINE Packet operator-() const {
+    Packet res;
+#pragma omp simd
+    for (int w = 0; w < W; w++)
+      res.lane[w] = -lane[w];
+    return res;
+  }
+
+#define KEOPS_PACKET_OPERATOR(OP)                                     \
+  INLINE Packet &operator OP##=(const Packet &b) {                    \
+    _Pragma("omp simd")                                               \
+    for (int w = 0; w < W; w++)                                       \
+      lane[w] OP##= b.lane[w];                                        \
+    return *this;                                                     \
+  }                                                                   \
+  friend INLINE Packet operator OP(Packet a, const Packet &b) {       \
+    return a OP##= b;                                                 \
+  }
+
+  KEOPS_PACKET_OPERATOR(+)
+  KEOPS_PACKET_OPERATOR(-)
+  KEOPS_PACKET_OPERATOR(*)
+  KEOPS_PACKET_OPERATOR(/)
+
+#undef KEOPS_PACKET_OPERATOR
+};
+
+// Lane-wise application of the scalar math functions of keops_math.h
+
+#define KEOPS_PACKET_MATH_1(FUN)                                      \
+template < typename TYPE, int W >                                     \
+INLINE Packet< TYPE, W > FUN(Packet< TYPE, W > x) {                   \
+  _Pragma("omp simd")                                                 \
+  for (int w = 0; w < W; w++)                                         \
+    x.lane[w] = FUN(x.lane[w]);                                       \
+  return x;                                                           \
+}
+
+KEOPS_PACKET_MATH_1(keops_log)
+KEOPS_PACKET_MATH_1(keops_xlogx)
+KEOPS_PACKET_MATH_1(keops_rcp)
+KEOPS_PACKET_MATH_1(keops_abs)
+KEOPS_PACKET_MATH_1(keops_exp)
+KEOPS_PACKET_MATH_1(keops_cos)
+KEOPS_PACKET_MATH_1(keops_sin)
+KEOPS_PACKET_MATH_1(keops_relu)
+KEOPS_PACKET_MATH_1(keops_step)
+KEOPS_PACKET_MATH_1(keops_sign)
+KEOPS_PACKET_MATH_1(keops_sqrt)
+KEOPS_PACKET_MATH_1(keops_rsqrt)
+KEOPS_PACKET_MATH_1(keops_acos)
+KEOPS_PACKET_MATH_1(keops_asin)
+KEOPS_PACKET_MATH_1(keops_atan)
+
+#undef KEOPS_PACKET_MATH_1
+
+template < typename TYPE, int W >
+INLINE Packet< TYPE, W > keops_pow(Packet< TYPE, W > x, int n) {
+#pragma omp simd
+  for (int w = 0; w < W; w++)
+    x.lane[w] = keops_pow(x.lane[w], n);
+  return x;
+}
+
+template < typename TYPE, int W >
+INLINE Packet< TYPE, W > keops_fma(Packet< TYPE, W > x, Packet< TYPE, W > y, Packet< TYPE, W > z) {
+#pragma omp simd
+  for (int w = 0; w < W; w++)
+    x.lane[w] = keops_fma(x.lane[w], y.lane[w], z.lane[w]);
+  return x;
+}
+
+template < typename TYPE, int W >
+INLINE Packet< TYPE, W > keops_clamp(Packet< TYPE, W > x, Packet< TYPE, W > a, Packet< TYPE, W > b) {
+#pragma omp simd
+  for (int w = 0; w < W; w++)
+    x.lane[w] = keops_clamp(x.lane[w], a.lane[w], b.lane[w]);
+  return x;
+}
+
+template < typename TYPE, int W >
+INLINE Packet< TYPE, W > keops_clampint(Packet< TYPE, W > x, int a, int b) {
+#pragma omp simd
+  for (int w = 0; w < W; w++)
+    x.lane[w] = keops_clampint(x.lane[w], a, b);
+  return x;
+}
+
+template < typename TYPE, int W >
+INLINE Packet< TYPE, W > keops_diffclampint(Packet< TYPE, W > x, int a, int b) {
+#pragma omp simd
+  for (int w = 0; w < W; w++)
+    x.lane[w] = keops_diffclampint(x.lane[w], a, b);
+  return x;
+}
+
+// Applies the scalar operation OP::Operation lane by lane: this is used by the operations
+// whose scalar implementation relies on comparisons, e.g. Min or OneHot.
+template < class OP, int DIMOUT, int DIMIN, typename TYPE, int W >
+INLINE void PacketOperation(Packet< TYPE, W > *out, Packet< TYPE, W > *in) {
+  for (int w = 0; w < W; w++) {
+    TYPE outw[DIMOUT], inw[DIMIN];
+    for (int k = 0; k < DIMIN; k++)
+      inw[k] = in[k].lane[w];
+    OP::Operation(outw, inw);
+    for (int k = 0; k < DIMOUT; k++)
+      out[k].lane[w] = outw[k];
+  }
+}
+
+}
@@ -1,3 +1,5 @@
+#pragma once
+
 
 // special computation scheme for dim>100
 #ifndef ENABLECHUNK
@@ -38,6 +40,39 @@
 	#define USE_FINAL_CHUNKS 0
 #endif
 
+// special mode for the gradients of sum reductions wrt. parameters: the output is also summed over its index,
+// so that a single line is returned (only on the Cpu, without ranges)
+#ifndef FULL_REDUCTION
+  #define FULL_REDUCTION 0
+#endif
+
+// tiled scheme of the Cpu engine: tiles of lines i are reduced against blocks of lines j (see CpuConv.cpp)
+#ifndef CPU_TILED
+  #define CPU_TILED 1
+#endif
+#ifndef CPU_TILE_I
+  #define CPU_TILE_I 0 // number of lines i per tile ; 0 means that it is chosen from the dimensions of the formula
+#endif
+#ifndef CPU_BLOCK_J
+  #define CPU_BLOCK_J 0 // number of lines j per block ; 0 means that it is chosen from the dimensions of the formula
+#endif
+#ifndef CPU_TILE_BYTES
+  #define CPU_TILE_BYTES 8192 // memory budget of a tile (lines i, accumulators), that should stay in the L1 cache
+#endif
+#ifndef CPU_BLOCK_BYTES
+  #define CPU_BLOCK_BYTES 65536 // memory budget of a block of lines j, that should stay in the L2 cache
+#endif
+#ifndef CPU_PACKET_WIDTH
+  #define CPU_PACKET_WIDTH 1 // number of lines j for which the formula is evaluated at once (see core/utils/Packet.h) ; 1 disables packets
+#endif
+// 2D scheme of the Cpu engine: the reduction axis is split between the threads if there are few lines i (see CpuConv.cpp)
+#ifndef CPU_2D
+  #define CPU_2D 1 // 0 means that the lines i only are split between the threads
+#endif
+#ifndef CPU_MIN_CHUNK_J
+  #define CPU_MIN_CHUNK_J 1024 // minimal number of lines j per chunk of the 2D scheme
+#endif
+
 #if USE_HALF
   #include <cuda_fp16.h>
 #endif
@@ -11,14 +11,34 @@ with open(
 
 ###########################################################
 # Utils
+#
+# "import pykeops" is kept cheap: the GPUs are detected and the build folder is created at their first use
+# (see pykeops.config), and the functions below are imported when they are first accessed.
 
 import pykeops.config
 from .common.set_path import set_bin_folder, clean_pykeops
 
-set_bin_folder()
+_lazy_functions = {
+    "precompile": ("pykeops.common.precompile", None),
+    "build_bundle": ("pykeops.common.bundle", None),
+    "cache_stats": ("pykeops.common.kernel_cache", None),
+    "set_num_threads": ("pykeops.common.cpu_options", None),
+    "test_numpy_bindings": ("pykeops.test.install", "numpy_found"),
+    "test_torch_bindings": ("pykeops.test.install", "torch_found"),
+}
 
-if pykeops.config.numpy_found:
-    from .test.install import test_numpy_bindings
 
-if pykeops.config.torch_found:
-    from .test.install import test_torch_bindings
+def __getattr__(name):
+    if name in _lazy_functions:
+        module, requirement = _lazy_functions[name]
+        if requirement is None or getattr(pykeops.config, requirement):
+            import importlib
+
+            function = getattr(importlib.import_module(module), name)
+            globals()[name] = function
+            return function
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_functions))
@@ -0,0 +1,79 @@
+"""
+Overhead of a Genred call
+=========================
+
+For small problems, the time spent in Python by a :class:`Genred <pykeops.numpy.Genred>` call (checking the
+inputs, choosing the backend...) may be larger than the time spent in the KeOps routine. This benchmark
+measures this per-call overhead:
+
+- for the parsing of the inputs only: the sizes of the inputs are read from the signature of the aliases, which
+  is parsed once when the Genred object is created,
+- for complete calls on tiny inputs, whose computation time is negligible.
+"""
+
+#####################################################################
+# Setup
+# -----
+# Standard imports:
+
+import timeit
+
+import numpy as np
+
+from pykeops.common.get_options import get_tag_backend
+from pykeops.common.parse_type import AliasSignature, get_sizes
+from pykeops.numpy import Genred
+
+######################################################################
+# Benchmark specifications:
+#
+
+N = 10  # Number of points x_i and y_j
+REPEAT = 10000  # Number of calls per test
+
+formula = "Exp(-p*SqDist(x,y))*b"
+aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)", "p=Pm(1)"]
+
+x = np.random.randn(N, 3)
+y = np.random.randn(N, 3)
+b = np.random.randn(N, 1)
+p = np.array([0.5])
+args = (x, y, b, p)
+
+######################################################################
+# Parsing of the inputs: parsing the aliases at every call, versus reading the signature of the aliases.
+#
+
+
+def per_call(f):
+    return timeit.timeit(f, number=REPEAT) / REPEAT
+
+
+signature = AliasSignature(aliases)
+print(
+    "Sizes of the inputs, from the aliases:   {:6.2f} us".format(
+        1e6 * per_call(lambda: get_sizes(aliases, *args))
+    )
+)
+print(
+    "Sizes of the inputs, from the signature: {:6.2f} us".format(
+        1e6 * per_call(lambda: signature.get_sizes(*args))
+    )
+)
+print(
+    "Choice of the backend:                   {:6.2f} us".format(
+        1e6 * per_call(lambda: get_tag_backend("auto", args))
+    )
+)
+
+######################################################################
+# Complete calls on tiny inputs:
+#
+
+my_conv = Genred(formula, aliases, axis=1)
+my_conv(*args)  # warm-up
+print(
+    "Genred call, N={}:                       {:6.2f} us".format(
+        N, 1e6 * per_call(lambda: my_conv(*args, backend="CPU"))
+    )
+)
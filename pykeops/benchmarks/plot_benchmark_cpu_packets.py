@@ -0,0 +1,99 @@
+"""
+Packets of lines j on the CPU
+=============================
+
+With the ``-DCPU_PACKET_WIDTH=W`` compiler flag, the CPU engine of KeOps evaluates
+the formula for **W** consecutive lines :math:`j` at once: the variables :math:`y_j` of a block are
+transposed into packets of :math:`W` values, and each operation of the formula is applied
+to the :math:`W` values of its arguments with a loop that the compiler may turn into SIMD instructions.
+
+The lanes of a packet are computed with the scalar operations and reduced in the order of
+the :math:`j`'s, so that the results are exactly the same as with the default, scalar evaluation.
+The speed-up thus depends on the formula and on the instruction set of the target: operations
+that are computed with calls to the math library (e.g. the exponential) are not vectorized.
+
+This benchmark compares packets of 4 and 8 values with the scalar evaluation (``W=1``)
+on a Gaussian convolution and on a (squared) distance matrix, in float32 and float64.
+"""
+
+#####################################################################
+# Setup
+# -----
+# Standard imports:
+
+import timeit
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+from pykeops.numpy import Genred
+
+######################################################################
+# Benchmark specifications:
+#
+
+M, N = 10000, 10000  # Number of points x_i and y_j
+D = 64  # Dimension of the points
+REPEAT = 3  # Number of calls per test
+WIDTHS = [1, 4, 8]  # Widths of the packets
+
+formulas = {
+    "Gaussian": "Exp(-SqDist(x,y))*b",
+    "distances": "Sum(Square(x-y))*b",
+}
+
+
+def generate_samples(dtype):
+    np.random.seed(1234)
+    x = (np.random.rand(M, D) / np.sqrt(D)).astype(dtype)
+    y = (np.random.rand(N, D) / np.sqrt(D)).astype(dtype)
+    b = np.random.randn(N, 1).astype(dtype)
+    return x, y, b
+
+
+######################################################################
+# Benchmark loop:
+#
+
+aliases = ["x=Vi({})".format(D), "y=Vj({})".format(D), "b=Vj(1)"]
+timings = {}
+
+for dtype in ["float32", "float64"]:
+    x, y, b = generate_samples(dtype)
+    for name, formula in formulas.items():
+        label = "{}, {}".format(name, dtype)
+        timings[label] = []
+        results = []
+        for W in WIDTHS:
+            my_conv = Genred(
+                formula,
+                aliases,
+                axis=1,
+                dtype=dtype,
+                optional_flags=["-DCPU_PACKET_WIDTH={}".format(W)],
+            )
+            results.append(my_conv(x, y, b, backend="CPU"))  # warm-up
+            elapsed = timeit.timeit(
+                lambda: my_conv(x, y, b, backend="CPU"), number=REPEAT
+            )
+            timings[label].append(elapsed / REPEAT)
+            print("{:20s}, W={}: {:.4f}s".format(label, W, timings[label][-1]))
+        for res in results[1:]:
+            assert np.array_equal(res, results[0])
+
+######################################################################
+# Display the timings:
+#
+
+plt.figure()
+for label in timings:
+    plt.plot(WIDTHS, timings[label], "o-", label=label)
+plt.xticks(WIDTHS)
+plt.yscale("log")
+plt.xlabel("Width W of the packets")
+plt.ylabel("Seconds")
+plt.title("Convolutions on the CPU, M=N={:,}, D={}".format(M, D))
+plt.legend(loc="upper left")
+plt.grid(True, which="major", linestyle="-")
+plt.tight_layout()
+plt.show()
@@ -0,0 +1,134 @@
+"""
+Block-sparse reductions on the CPU
+==================================
+
+With the **ranges** argument, the CPU engine of KeOps only computes the interactions between
+the clusters of points :math:`x_i` and :math:`y_j` that are close to each other.
+The work is cut into **tasks**, i.e. chunks of lines :math:`i` of the clusters, of about the same cost:
+the cost of a line is the number of indices :math:`j` with which it interacts.
+All the tasks are processed by a single parallel loop and, by default, handed to the threads
+dynamically from the largest to the smallest: a few large, dense clusters do not leave
+the other threads idle, and thousands of small clusters do not pay one fork/join each.
+
+This benchmark computes a block-sparse Gaussian convolution on clustered point clouds, whose
+clusters have very different sizes, with the bins of :func:`grid_cluster() <pykeops.numpy.cluster.grid_cluster>`
+ranging from a few large clusters to thousands of small ones. The default (dynamic) schedule of the tasks
+is compared with a static schedule (``schedule="static"``), with a single thread (``num_threads=1``),
+and with the dense reduction.
+"""
+
+#####################################################################
+# Setup
+# -----
+# Standard imports:
+
+import timeit
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+from pykeops.numpy import Genred
+from pykeops.numpy.cluster import (
+    cluster_ranges_centroids,
+    from_matrix,
+    grid_cluster,
+    sort_clusters,
+)
+
+######################################################################
+# Benchmark specifications:
+#
+
+M, N = 100000, 100000  # Number of points x_i and y_j
+D = 2  # Dimension of the points
+SIGMA = 0.01  # Radius of the Gaussian kernel
+EPS = [0.2, 0.1, 0.05, 0.025, 0.0125]  # Sizes of the bins of grid_cluster
+REPEAT = 3  # Number of calls per test
+
+
+def clustered_samples(n):
+    # a few dense blobs in a sparse background: the clusters have very different sizes
+    centers = np.random.rand(8, D)
+    blobs = centers[np.random.randint(8, size=n // 2)]
+    blobs += 0.02 * np.random.randn(n // 2, D)
+    background = np.random.rand(n - n // 2, D)
+    return np.concatenate((blobs, background)).astype("float32")
+
+
+np.random.seed(1234)
+x, y = clustered_samples(M), clustered_samples(N)
+b = np.random.randn(N, 1).astype("float32")
+
+formula = "Exp(-SqDist(x,y)*g)*b"
+aliases = ["x=Vi({})".format(D), "y=Vj({})".format(D), "b=Vj(1)", "g=Pm(1)"]
+g = np.array([0.5 / SIGMA ** 2], dtype="float32")
+
+routines = {
+    "dynamic (default)": Genred(formula, aliases, axis=1, dtype="float32"),
+    "static": Genred(formula, aliases, axis=1, dtype="float32", schedule="static"),
+    "1 thread": Genred(formula, aliases, axis=1, dtype="float32", num_threads=1),
+}
+
+
+def clusters(eps):
+    # sorted point clouds and ranges of the block-sparse reduction, for bins of size eps
+    x_labels, y_labels = grid_cluster(x, eps), grid_cluster(y, eps)
+    x_ranges, x_centroids, _ = cluster_ranges_centroids(x, x_labels)
+    y_ranges, y_centroids, _ = cluster_ranges_centroids(y, y_labels)
+    x_s, _ = sort_clusters(x, x_labels)
+    (y_s, b_s), _ = sort_clusters((y, b), y_labels)
+    dist = sum(
+        (x_centroids[:, None, k] - y_centroids[None, :, k]) ** 2 for k in range(D)
+    )
+    keep = np.sqrt(dist) < 4 * SIGMA + np.sqrt(D) * eps
+    return x_s, y_s, b_s, from_matrix(x_ranges, y_ranges, keep), len(x_ranges)
+
+
+######################################################################
+# Benchmark loop:
+#
+
+nclusters = []
+timings = {name: [] for name in routines}
+timings["dense"] = []
+
+for eps in EPS:
+    x_s, y_s, b_s, ranges, nc = clusters(eps)
+    nclusters.append(nc)
+    routines["dynamic (default)"](x_s, y_s, b_s, g, backend="CPU")  # warm-up
+    elapsed = timeit.timeit(
+        lambda: routines["dynamic (default)"](x_s, y_s, b_s, g, backend="CPU"),
+        number=REPEAT,
+    )
+    timings["dense"].append(elapsed / REPEAT)
+    results = []
+    for name, routine in routines.items():
+        results.append(routine(x_s, y_s, b_s, g, backend="CPU", ranges=ranges))
+        elapsed = timeit.timeit(
+            lambda: routine(x_s, y_s, b_s, g, backend="CPU", ranges=ranges),
+            number=REPEAT,
+        )
+        timings[name].append(elapsed / REPEAT)
+    for res in results[1:]:
+        assert np.array_equal(res, results[0])
+    print(
+        "{:5d} clusters: ".format(nc)
+        + ", ".join("{} {:.4f}s".format(name, timings[name][-1]) for name in timings)
+    )
+
+######################################################################
+# Display the timings:
+#
+
+plt.figure()
+for name in timings:
+    plt.plot(nclusters, timings[name], "o-", label=name)
+plt.xscale("log")
+plt.yscale("log")
+plt.xlabel("Number of clusters")
+plt.ylabel("Seconds")
+plt.title("Block-sparse Gaussian convolution on the CPU, M=N={:,}".format(M))
+plt.legend(loc="upper right")
+plt.grid(True, which="major", linestyle="-")
+plt.tight_layout()
+plt.show()
@@ -0,0 +1,89 @@
+"""
+Tiled map-reduce scheme on the CPU
+==================================
+
+By default, the CPU engine of KeOps processes the lines :math:`i` by **tiles**: the variables
+:math:`y_j` are loaded by blocks that fit in the cache, and each of them is used for all the lines
+of the tile before the next one. The :math:`y_j`'s are thus read :math:`M/\\text{TILE_I}` times
+instead of :math:`M` times, and the reductions of the lines of a tile are independent.
+
+This benchmark compares this scheme with the line-by-line loop, which may still be selected
+with the ``-DCPU_TILED=0`` compiler flag, on a Gaussian convolution
+in dimensions :math:`D = 1, 3, 64` and :math:`512`.
+The sizes of the tiles are chosen from the dimensions of the formula, and may be set with
+the ``-DCPU_TILE_I=...`` (lines :math:`i` per tile) and ``-DCPU_BLOCK_J=...``
+(lines :math:`j` per block) flags.
+"""
+
+#####################################################################
+# Setup
+# -----
+# Standard imports:
+
+import timeit
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+from pykeops.numpy import Genred
+
+######################################################################
+# Benchmark specifications:
+#
+
+M, N = 10000, 10000  # Number of points x_i and y_j
+DS = [1, 3, 64, 512]  # Dimensions to test
+REPEAT = 3  # Number of calls per test
+
+schemes = {
+    "line by line": ["-DCPU_TILED=0"],
+    "tiled": [],
+    "tiled, TILE_I=2": ["-DCPU_TILE_I=2"],
+}
+
+formula = "Exp(-SqDist(x,y))*b"
+
+
+def generate_samples(D):
+    np.random.seed(1234)
+    x = np.random.rand(M, D) / np.sqrt(D)
+    y = np.random.rand(N, D) / np.sqrt(D)
+    b = np.random.randn(N, 1)
+    return x, y, b
+
+
+######################################################################
+# Benchmark loop:
+#
+
+timings = {name: [] for name in schemes}
+
+for D in DS:
+    x, y, b = generate_samples(D)
+    aliases = ["x=Vi({})".format(D), "y=Vj({})".format(D), "b=Vj(1)"]
+    results = []
+    for name, flags in schemes.items():
+        my_conv = Genred(formula, aliases, axis=1, optional_flags=flags)
+        results.append(my_conv(x, y, b, backend="CPU"))  # warm-up
+        elapsed = timeit.timeit(lambda: my_conv(x, y, b, backend="CPU"), number=REPEAT)
+        timings[name].append(elapsed / REPEAT)
+        print("D={:4d}, {:16s}: {:.4f}s".format(D, name, timings[name][-1]))
+    for res in results[1:]:
+        assert np.allclose(res, results[0])
+
+######################################################################
+# Display the timings:
+#
+
+plt.figure()
+for name in schemes:
+    plt.plot(DS, timings[name], "o-", label=name)
+plt.xscale("log")
+plt.yscale("log")
+plt.xlabel("Dimension D")
+plt.ylabel("Seconds")
+plt.title("Gaussian convolution on the CPU, M=N={:,}".format(M))
+plt.legend(loc="upper left")
+plt.grid(True, which="major", linestyle="-")
+plt.tight_layout()
+plt.show()
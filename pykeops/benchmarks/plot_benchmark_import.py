@@ -0,0 +1,77 @@
+"""
+Import time
+===========
+
+This benchmark measures the time spent by ``import pykeops``, which matters for programs that start
+many worker processes. The import should neither detect the GPUs nor create the build folder: these
+actions are performed at the first use of ``pykeops.config.gpu_available`` and ``pykeops.config.bin_folder``.
+
+The import time budget of pykeops is **50 ms**, on top of the start-up of the interpreter.
+"""
+
+#####################################################################
+# Setup
+# -----
+# Standard imports:
+
+import re
+import subprocess
+import sys
+
+######################################################################
+# Benchmark specifications:
+#
+
+REPEAT = 20  # Number of fresh interpreters
+BUDGET = 0.05  # Import time budget of pykeops, in seconds
+
+######################################################################
+# The import time of pykeops (and of all the modules that it imports) is given by the ``-X importtime``
+# option of the interpreter, in a fresh process:
+#
+
+
+def import_time(module):
+    log = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    # last line: "import time: self [us] | cumulative [us] | module"
+    cumulative = re.findall(
+        r"\|\s*(\d+)\s*\|\s*" + re.escape(module) + r"\s*$", log, re.M
+    )
+    return int(cumulative[-1]) * 1e-6
+
+
+def heavy_imports():
+    # modules which should not be imported by "import pykeops"
+    code = (
+        "import sys, pykeops; "
+        "print(' '.join(m for m in ('ctypes', 'numpy', 'torch', 'pykeops.common.gpu_utils', 'pykeops.test.install') if m in sys.modules))"
+    )
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout.split()
+
+
+######################################################################
+# Benchmark:
+#
+
+times = sorted(import_time("pykeops") for _ in range(REPEAT))
+median = times[REPEAT // 2]
+
+print(
+    "import pykeops: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms (budget: {:.0f} ms)".format(
+        1000 * median, 1000 * times[0], 1000 * times[-1], 1000 * BUDGET
+    )
+)
+print("Heavy modules imported: {}".format(heavy_imports() or "none"))
+
+if median > BUDGET:
+    print("Warning: the import time of pykeops exceeds its budget.")
@@ -0,0 +1,142 @@
+import re
+from hashlib import sha256
+
+import pykeops.config
+from pykeops.common.compile_routines import (
+    build_formula_object_file,
+    check_or_prebuild,
+    compile_bundle,
+)
+from pykeops.common.keops_io import get_kernel_names, kernel_registry
+from pykeops.common.kernel_cache import register_bundle
+from pykeops.common.precompile import _normalize_spec, _signature_of
+from pykeops.common.set_path import set_build_folder
+from pykeops.common.utils import create_and_lock_build_folder
+
+
+def _collect_kernel(spec):
+    """
+    Return the (lang, formula, aliases, dtype, optional_flags) signature of the kernel described by a spec
+    (see precompile), without compiling it.
+    """
+    job = _normalize_spec(spec)
+    if job[0] == "genred":
+        _, lang, kwargs = job
+        if lang == "torch":
+            from pykeops.torch import Genred
+        else:
+            from pykeops.numpy import Genred
+        # numpy routines request their kernel at instantiation: record it instead of compiling it
+        with kernel_registry.record() as kernels:
+            routine = Genred(**dict(kwargs, background_compile=False))
+        return kernels[0] if kernels else _signature_of(routine)
+    return _signature_of(getattr(spec, "callfun", spec))
+
+
+class BundleMember:
+    """
+    A formula of a bundle: its object file is compiled in the build folder of the formula.
+    """
+
+    def __init__(self, formula, aliases, dtype, lang, optional_flags, include_dirs):
+        (
+            self.formula,
+            self.aliases,
+            self.optional_flags,
+            self.template_name,
+            self.dll_name,
+        ) = get_kernel_names(
+            formula, aliases, dtype, lang, optional_flags, include_dirs
+        )
+        self.dtype = dtype
+        self.lang = lang
+        self.include_dirs = include_dirs
+        self.build_folder = set_build_folder(pykeops.config.bin_folder, self.dll_name)
+        self.full_name = self.dll_name + "." + self.template_name
+
+    @create_and_lock_build_folder()
+    def build(self):
+        check_or_prebuild(
+            self.dtype, self.lang, self.include_dirs, build_folder=self.build_folder
+        )
+        formula_object = build_formula_object_file(
+            self.formula,
+            self.aliases,
+            self.dll_name,
+            self.dtype,
+            self.optional_flags,
+            self.build_folder,
+        )
+        if formula_object is None:
+            raise ValueError(
+                "[KeOps] The formula {} could not be compiled. Set the environment variable PYKEOPS_VERBOSE=1 "
+                "to display the compilation logs.".format(self.formula)
+            )
+        return self.dll_name, self.dtype, formula_object
+
+
+def build_bundle(specs, name=None):
+    r"""
+    Compile a list of KeOps kernels in a single shared object, the **bundle**.
+
+    A bundle is loaded with a single import, which spares the many file system accesses and ``dlopen`` calls of
+    programs that use hundreds of formulas. The bundle is recorded in the manifest of the build folder
+    ``pykeops.config.bin_folder``: the formulas of the bundle are then loaded from it rather than from their own
+    modules. Bundles are also found in the read-only cache folders listed in ``pykeops.config.cache_roots``.
+
+    Args:
+        specs (list): the kernels of the bundle, given as for :func:`precompile() <pykeops.precompile>`:
+          dicts of arguments for the :class:`Genred <pykeops.numpy.Genred>` constructor (with an additional key
+          ``"lang"``), Genred or KernelSolve objects, or reduced LazyTensors. All the kernels must use the same
+          ``lang`` (``"numpy"`` or ``"torch"``).
+
+    Keyword Args:
+        name (string, default None): name of the bundle, made of letters, digits and underscores. Defaults to a
+          hash of the kernels of the bundle.
+
+    Returns:
+        string: the path of the shared object of the bundle.
+    """
+    kernels = [_collect_kernel(spec) for spec in specs]
+
+    langs = set(kernel[0] for kernel in kernels)
+    if len(langs) != 1:
+        raise ValueError(
+            "[KeOps] A bundle should contain at least one kernel, and all its kernels should use the same lang "
+            "(numpy or torch)."
+        )
+    lang = langs.pop()
+    if lang == "torch":
+        from pykeops.torch import include_dirs
+    else:
+        include_dirs = []
+
+    members = {}
+    for (_, formula, aliases, dtype, optional_flags) in kernels:
+        member = BundleMember(
+            formula, aliases, dtype, lang, optional_flags, include_dirs
+        )
+        members.setdefault(member.full_name, member)
+
+    if name is None:
+        name = sha256("".join(sorted(members)).encode("utf-8")).hexdigest()[:10]
+    elif not re.fullmatch(r"[A-Za-z0-9_]+", name):
+        raise ValueError(
+            "[KeOps] The name of a bundle should be made of letters, digits and underscores."
+        )
+    bundle_name = "libKeOps" + lang + "_bundle_" + name
+
+    objects = [member.build() for member in members.values()]
+    path = compile_bundle(bundle_name, lang, include_dirs, objects)
+    if path is None:
+        raise ImportError(
+            "[pyKeOps]: The bundle {} could not be compiled. Set the environment variable PYKEOPS_VERBOSE=1 "
+            "to display the compilation logs.".format(bundle_name)
+        )
+
+    register_bundle(
+        bundle_name,
+        path,
+        {full_name: member.dll_name for (full_name, member) in members.items()},
+    )
+    return path
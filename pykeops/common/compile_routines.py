@@ -1,12 +1,39 @@
+import contextlib
+import json
 import os
 import pathlib
+import re
+import shlex
 import shutil
 import sys
+import time
 from hashlib import sha256
 
 import pykeops.config
 from pykeops.common.parse_type import check_aliases_list
-from pykeops.common.utils import c_type, replace_strings_in_file, run_and_display
+from pykeops.common.utils import (
+    c_type,
+    replace_strings_in_file,
+    run_and_display,
+    FileLock,
+)
+
+# Time spent (in seconds) by the current process in each phase of the compilations: "configure" (cmake),
+# "template" (first build of the pybind11 templates), "pch" (precompiled headers), "compile" (formulas), "link"
+# and "bundle".
+phase_timings = {}
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        phase_timings[phase] = phase_timings.get(phase, 0.0) + elapsed
+        if pykeops.config.verbose:
+            print("[pyKeOps] {} phase: {:.3f}s".format(phase, elapsed), flush=True)
 
 
 def get_pybind11_template_name_and_command(dtype, lang, include_dirs):
@@ -37,19 +64,28 @@ def get_pybind11_template_name(dtype, lang, include_dirs):
     return template_name
 
 
-def get_or_build_pybind11_template(
-    dtype, lang, include_dirs, use_prebuilt_formula=False
-):
-    template_name, command_line = get_pybind11_template_name_and_command(
-        dtype, lang, include_dirs
-    )
-    template_build_folder = (
+def get_pybind11_template_build_folder(template_name):
+    return (
         pykeops.config.bin_folder
         + os.path.sep
         + "build-pybind11_template-"
         + template_name
     )
 
+
+def get_or_build_pybind11_template(dtype, lang, include_dirs, formula_object=None):
+    """
+    Build the pybind11 template if needed. The template build folder is shared by all the formulas with the
+    same (dtype, lang, include_dirs): callers must hold the lock of this folder (see compile_generic_routine).
+
+    :param formula_object: path to the object file of the formula to link with the template. If None, an arbitrary
+        dummy formula is compiled.
+    """
+    template_name, command_line = get_pybind11_template_name_and_command(
+        dtype, lang, include_dirs
+    )
+    template_build_folder = get_pybind11_template_build_folder(template_name)
+
     is_rebuilt = False
     if not os.path.exists(template_build_folder + os.path.sep + "CMakeCache.txt"):
         is_rebuilt = True
@@ -64,41 +100,47 @@ def get_or_build_pybind11_template(
         )
         # print('(with dtype=',dtype,', lang=',lang,', include_dirs=',include_dirs,')', flush=True)
 
-        os.mkdir(template_build_folder)
+        os.makedirs(template_build_folder, exist_ok=True)
 
         command_line += ["-Dtemplate_name=" + "'{}'".format(template_name)]
         command_line += [
             "-Dkeops_formula_name=" + "'{}'".format(pykeops.config.shared_obj_name)
         ]
 
-        build_folder = check_or_prebuild(dtype, lang, include_dirs)
-
-        if not use_prebuilt_formula:
+        if formula_object is None:
             # here we build an arbitrary dummy formula to create a formula object file ; otherwise the initial cmake call would fail
+            build_folder = check_or_prebuild(dtype, lang, include_dirs)
             formula = "Sum_Reduction(Var(0,1,0)*Var(1,1,1),0)"
             alias_string = ""
             optional_flags = []
             build_keops_formula_object_file(
                 build_folder, dtype, formula, alias_string, optional_flags
             )
+            formula_object = (
+                pykeops.config.bin_folder
+                + os.path.sep
+                + pykeops.config.shared_obj_name
+                + ".o"
+            )
 
-        fname = pykeops.config.shared_obj_name + ".o"
-        os.rename(
-            pykeops.config.bin_folder + os.path.sep + fname,
-            template_build_folder + os.path.sep + fname,
+        os.replace(
+            formula_object,
+            template_build_folder + os.path.sep + pykeops.config.shared_obj_name + ".o",
         )
 
-        run_and_display(
-            command_line + ["-DcommandLine=" + " ".join(command_line)],
-            template_build_folder,
-            msg="CMAKE",
-        )
+        with timed_phase("configure"):
+            run_and_display(
+                command_line + ["-DcommandLine=" + " ".join(command_line)],
+                template_build_folder,
+                msg="CMAKE",
+            )
 
-        run_and_display(
-            ["cmake", "--build", ".", "--target", template_name, "--", "VERBOSE=1"],
-            template_build_folder,
-            msg="MAKE",
-        )
+        with timed_phase("template"):
+            run_and_display(
+                ["cmake", "--build", ".", "--target", template_name, "--", "VERBOSE=1"],
+                template_build_folder,
+                msg="MAKE",
+            )
 
         print("done.", flush=True)
 
@@ -157,55 +199,300 @@ def get_build_folder_name(dtype, lang, include_dirs):
     return build_folder
 
 
-def check_or_prebuild(dtype, lang, include_dirs):
-    build_folder, command_line = get_build_folder_name_and_command(
+def check_or_prebuild(dtype, lang, include_dirs, build_folder=None):
+    """
+    Run cmake in a build folder for the given (dtype, lang, include_dirs), if not done yet.
+
+    With the direct compilation backend (see pykeops.config.compile_backend), cmake is only run in the shared
+    folder: the compiler command line that it records there is adapted to the formula specific folder and written
+    in its compile_command.json file.
+
+    :param build_folder: If None, the folder shared by all the formulas with the same (dtype, lang, include_dirs) is
+        used and the formula object files are copied in pykeops.config.bin_folder. Otherwise, the given (formula
+        specific) folder is used and the object files stay in it, so that several formulas can be compiled at the
+        same time.
+    """
+    if pykeops.config.compile_backend not in ("direct", "cmake"):
+        raise ValueError(
+            '[KeOps] pykeops.config.compile_backend should be "direct" or "cmake".'
+        )
+    direct = pykeops.config.compile_backend == "direct"
+
+    shared_build_folder, command_line = get_build_folder_name_and_command(
         dtype, lang, include_dirs
     )
-    if not os.path.exists(build_folder + os.path.sep + "CMakeCache.txt"):
-        print(
-            "[pyKeOps] Initializing build folder for dtype="
-            + str(dtype)
-            + " and lang="
-            + lang
-            + " in "
-            + os.path.realpath(pykeops.config.bin_folder)
-            + " ... ",
-            end="",
-            flush=True,
+    if build_folder is None:
+        build_folder = shared_build_folder
+    else:
+        command_file = build_folder + os.path.sep + "compile_command.json"
+        compile_command = (
+            get_compile_command(dtype, lang, include_dirs) if direct else None
         )
-        run_and_display(
-            command_line + ["-DcommandLine=" + " ".join(command_line)],
-            build_folder,
-            msg="CMAKE",
-        )
-        print("done.", flush=True)
+        if compile_command is not None:
+            os.makedirs(build_folder, exist_ok=True)
+            with open(command_file, "w") as f:
+                json.dump(get_formula_compile_command(compile_command, build_folder), f)
+            return build_folder
+        if os.path.exists(command_file):
+            os.remove(command_file)
+        command_line += ["-DBIN_DIR=" + "'{}'".format(build_folder)]
+
+    os.makedirs(build_folder, exist_ok=True)
+    with open(os.path.join(build_folder, "pykeops_prebuild.lock"), "w") as lock:
+        with FileLock(lock):
+            configure_build_folder(
+                dtype,
+                lang,
+                build_folder,
+                command_line,
+                is_shared=build_folder == shared_build_folder,
+            )
     return build_folder
 
 
+def configure_build_folder(dtype, lang, build_folder, command_line, is_shared):
+    # the compiler command line is recorded by the latest versions of the cmake script only
+    is_configured = os.path.exists(build_folder + os.path.sep + "CMakeCache.txt") and (
+        not is_shared
+        or os.path.exists(build_folder + os.path.sep + "compiler_signature.txt")
+        and (
+            pykeops.config.compile_backend != "direct"
+            or os.path.exists(build_folder + os.path.sep + "compiler_id.txt")
+        )
+    )
+    if not is_configured:
+        if pykeops.config.verbose or is_shared:
+            print(
+                "[pyKeOps] Initializing build folder for dtype="
+                + str(dtype)
+                + " and lang="
+                + lang
+                + " in "
+                + os.path.realpath(build_folder)
+                + " ... ",
+                end="",
+                flush=True,
+            )
+        with timed_phase("configure"):
+            run_and_display(
+                command_line + ["-DcommandLine=" + " ".join(command_line)],
+                build_folder,
+                msg="CMAKE",
+            )
+        if pykeops.config.verbose or is_shared:
+            print("done.", flush=True)
+
+
+# compiler signatures recorded in the shared build folders, see get_compiler_signature
+_compiler_signatures = {}
+
+
+def get_compiler_signature(dtype, lang, include_dirs):
+    """
+    Return a string identifying the compilers picked by cmake to build the formulas with the given
+    (dtype, lang, include_dirs), as recorded in the shared build folder, which is configured if needed. It is part
+    of the hash of the modules names, so that modules built by different compilers are never mixed up.
+    """
+    shared_build_folder = get_build_folder_name(dtype, lang, include_dirs)
+    if shared_build_folder not in _compiler_signatures or not os.path.isdir(
+        shared_build_folder
+    ):
+        check_or_prebuild(dtype, lang, include_dirs)
+        try:
+            with open(
+                shared_build_folder + os.path.sep + "compiler_signature.txt"
+            ) as f:
+                _compiler_signatures[shared_build_folder] = f.read().strip()
+        except OSError:
+            return ""  # cmake failed: the formula cannot be compiled anyway
+    return _compiler_signatures[shared_build_folder]
+
+
+# compiler command lines recorded in the shared build folders, see get_compile_command
+_compile_commands = {}
+
+
+def get_compile_command(dtype, lang, include_dirs):
+    """
+    Return the compiler command line of the formulas with the given (dtype, lang, include_dirs), as recorded by cmake
+    in the shared build folder: a dict with keys "directory", "file", "arguments" and "compiler_id". Return None if
+    cmake did not record it (e.g. with a generator which does not support CMAKE_EXPORT_COMPILE_COMMANDS).
+    """
+    shared_build_folder = get_build_folder_name(dtype, lang, include_dirs)
+    if shared_build_folder not in _compile_commands or not os.path.isdir(
+        shared_build_folder
+    ):
+        check_or_prebuild(dtype, lang, include_dirs)
+        _compile_commands[shared_build_folder] = read_compile_command(
+            shared_build_folder
+        )
+    return _compile_commands[shared_build_folder]
+
+
+def read_compile_command(build_folder):
+    try:
+        with open(build_folder + os.path.sep + "compile_commands.json") as f:
+            entries = json.load(f)
+        with open(build_folder + os.path.sep + "compiler_id.txt") as f:
+            compiler_id = f.read().strip()
+    except (OSError, ValueError):
+        return None
+
+    for entry in entries:
+        if os.path.basename(entry["file"]).startswith("link_autodiff."):
+            arguments = (
+                entry["arguments"]
+                if "arguments" in entry
+                else shlex.split(entry["command"])
+            )
+            return {
+                "directory": entry["directory"],
+                "file": entry["file"],
+                "arguments": arguments,
+                "compiler_id": compiler_id,
+            }
+    return None
+
+
+def get_formula_compile_command(compile_command, build_folder):
+    """
+    Adapt the compiler command line recorded in a shared build folder to a formula specific build folder: the header
+    of the formula is read from build_folder and its object file is written in build_folder.
+    """
+    arguments = []
+    args = iter(compile_command["arguments"])
+    for arg in args:
+        if arg[:2] == "-I" and os.path.realpath(arg[2:]) == os.path.realpath(
+            compile_command["directory"]
+        ):
+            arg = "-I" + build_folder
+        elif arg == "-o":
+            next(args)
+            arg = build_folder + os.path.sep + pykeops.config.shared_obj_name + ".o"
+            arguments.append("-o")
+        arguments.append(arg)
+    return dict(compile_command, directory=build_folder, arguments=arguments)
+
+
+def get_or_build_precompiled_header(compile_command, optional_flags):
+    """
+    Build (once) the precompiled header of keops_includes.h for the compiler command line of a formula. The optional
+    flags of the formula are defined before keops_includes.h is included (see formula.h.in): they are part of the
+    precompiled header, which is made of a header that includes keops_includes.h. If the precompiled header cannot
+    be used, gcc falls back to this header.
+
+    :return: the path of the header, or None if the precompiled header could not be built.
+    """
+    arguments = []
+    args = iter(compile_command["arguments"])
+    for arg in args:
+        if arg in ("-include", "-o"):
+            next(args)  # the header and the object file of the formula
+        elif arg == "-c" or arg == compile_command["file"]:
+            pass
+        elif arg[:2] == "-I" and os.path.realpath(arg[2:]) == os.path.realpath(
+            compile_command["directory"]
+        ):
+            pass
+        else:
+            arguments.append(arg)
+    arguments += optional_flags
+
+    pch_folder = (
+        pykeops.config.bin_folder
+        + os.path.sep
+        + "build-pch-"
+        + sha256(" ".join(arguments).encode("utf-8")).hexdigest()[:10]
+    )
+    header = pch_folder + os.path.sep + "keops_includes.h"
+    pch_file = header + ".gch"
+
+    os.makedirs(pch_folder, exist_ok=True)
+    with open(os.path.join(pch_folder, "pykeops_pch.lock"), "w") as lock:
+        with FileLock(lock):
+            if not os.path.isfile(pch_file):
+                with open(header, "w") as f:
+                    f.write("#include <keops_includes.h>\n")
+                with timed_phase("pch"):
+                    run_and_display(
+                        arguments + ["-x", "c++-header", header, "-o", pch_file],
+                        pch_folder,
+                        msg="PCH",
+                    )
+    return header if os.path.isfile(pch_file) else None
+
+
+def compile_formula_directly(build_folder, optional_flags):
+    """
+    Compile the object file of a formula with the compiler command line written in its build folder by
+    check_or_prebuild (direct compilation backend).
+    """
+    with open(build_folder + os.path.sep + "compile_command.json") as f:
+        compile_command = json.load(f)
+    arguments = compile_command["arguments"]
+
+    pch_header = None
+    if pykeops.config.use_pch and compile_command["compiler_id"] == "GNU":
+        pch_header = get_or_build_precompiled_header(compile_command, optional_flags)
+    if pch_header is not None:
+        # gcc only uses a precompiled header which is included first, with the same macros: the optional flags are
+        # defined on the command line, before KeOps_formula.h defines them again.
+        arguments = (
+            arguments[:1]
+            + list(optional_flags)
+            + ["-include", pch_header]
+            + arguments[1:]
+        )
+
+    env = None
+    ccache = shutil.which("ccache") if pykeops.config.use_ccache else None
+    if ccache is not None:
+        arguments = [ccache] + arguments
+        if pch_header is not None:
+            # see the "Precompiled headers" section of the ccache manual
+            arguments += ["-fpch-preprocess"]
+            env = dict(os.environ, CCACHE_SLOPPINESS="pch_defines,time_macros")
+
+    formula_object = build_folder + os.path.sep + pykeops.config.shared_obj_name + ".o"
+    if os.path.exists(formula_object):
+        os.remove(formula_object)
+    with timed_phase("compile"):
+        run_and_display(arguments, build_folder, msg="COMPILE", env=env)
+
+
 def build_keops_formula_object_file(
     build_folder, dtype, formula, alias_string, optional_flags
 ):
     create_keops_include_file(
         build_folder, dtype, formula, alias_string, optional_flags
     )
-    run_and_display(
-        [
-            "cmake",
-            "--build",
-            ".",
-            "--target",
-            pykeops.config.shared_obj_name,
-            "--",
-            "VERBOSE=1",
-        ],
-        build_folder,
-        msg="MAKE",
-    )
+    if os.path.exists(build_folder + os.path.sep + "compile_command.json"):
+        compile_formula_directly(build_folder, optional_flags)
+        return
+    with timed_phase("compile"):
+        run_and_display(
+            [
+                "cmake",
+                "--build",
+                ".",
+                "--target",
+                pykeops.config.shared_obj_name,
+                "--",
+                "VERBOSE=1",
+            ],
+            build_folder,
+            msg="MAKE",
+        )
 
 
-def compile_generic_routine(
-    formula, aliases, dllname, dtype, lang, optional_flags, include_dirs, build_folder
+def build_formula_object_file(
+    formula, aliases, dllname, dtype, optional_flags, build_folder
 ):
+    """
+    Compile the object file of a formula in its build folder (which is prepared by check_or_prebuild).
+
+    :return: the path of the object file, or None if the compilation failed.
+    """
     aliases = check_aliases_list(aliases)
 
     def process_alias(alias):
@@ -241,38 +528,102 @@ def compile_generic_routine(
     build_keops_formula_object_file(
         build_folder, dtype, formula, alias_string, optional_flags
     )
-
-    template_name, is_rebuilt = get_or_build_pybind11_template(
-        dtype, lang, include_dirs, use_prebuilt_formula=True
+    formula_object = build_folder + os.path.sep + pykeops.config.shared_obj_name + ".o"
+    if not os.path.isfile(formula_object):
+        print("failed.", flush=True)
+        return None
+    return formula_object
+
+
+def get_cmake_cache_variable(build_folder, name):
+    try:
+        with open(build_folder + os.path.sep + "CMakeCache.txt") as f:
+            match = re.search(
+                "^" + name + r"(?::\w+)?=(.*)$", f.read(), flags=re.MULTILINE
+            )
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+def link_pybind11_template(template_name, template_build_folder):
+    """
+    Link the object file of a formula with the (already compiled) pybind11 template. With the direct compilation
+    backend, the link command lines recorded by cmake are run directly, without the make machinery.
+    """
+    link_script = os.path.join(
+        template_build_folder, "CMakeFiles", template_name + ".dir", "link.txt"
     )
+    with timed_phase("link"):
+        if pykeops.config.compile_backend != "direct" or not os.path.isfile(
+            link_script
+        ):
+            run_and_display(
+                ["cmake", "--build", ".", "--target", template_name, "--", "VERBOSE=1"],
+                template_build_folder,
+                msg="MAKE",
+            )
+            return
 
-    template_build_folder = (
-        pykeops.config.bin_folder
-        + os.path.sep
-        + "build-pybind11_template-"
-        + template_name
-    )
+        with open(link_script) as f:
+            for line in f:
+                if line.strip():
+                    run_and_display(
+                        shlex.split(line), template_build_folder, msg="LINK"
+                    )
+
+        # pybind11 strips the modules in Release mode
+        strip = get_cmake_cache_variable(template_build_folder, "CMAKE_STRIP")
+        if pykeops.config.build_type == "Release" and strip:
+            for file in pathlib.Path(template_build_folder).glob(
+                template_name + "*.so"
+            ):
+                run_and_display([strip, str(file)], template_build_folder, msg="STRIP")
 
-    if not is_rebuilt:
-        fname = pykeops.config.shared_obj_name + ".o"
-        os.rename(
-            pykeops.config.bin_folder + os.path.sep + fname,
-            template_build_folder + os.path.sep + fname,
-        )
-        run_and_display(
-            ["cmake", "--build", ".", "--target", template_name, "--", "VERBOSE=1"],
-            template_build_folder,
-            msg="MAKE",
-        )
 
-    os.makedirs(pykeops.config.bin_folder + os.path.sep + dllname, exist_ok=True)
-    fname = list(pathlib.Path(template_build_folder).glob(template_name + "*.so"))[
-        0
-    ].name
-    os.rename(
-        template_build_folder + os.path.sep + fname,
-        pykeops.config.bin_folder + os.path.sep + dllname + os.path.sep + fname,
+def compile_generic_routine(
+    formula, aliases, dllname, dtype, lang, optional_flags, include_dirs, build_folder
+):
+    formula_object = build_formula_object_file(
+        formula, aliases, dllname, dtype, optional_flags, build_folder
     )
+    if formula_object is None:
+        # the compilation of the formula failed: there is nothing to link
+        return
+
+    # The pybind11 template folder is shared by all the formulas: linking is the only serialized step.
+    template_name = get_pybind11_template_name(dtype, lang, include_dirs)
+    template_build_folder = get_pybind11_template_build_folder(template_name)
+    os.makedirs(template_build_folder, exist_ok=True)
+
+    with open(
+        os.path.join(template_build_folder, "pykeops_template.lock"), "w"
+    ) as lock:
+        with FileLock(lock):
+            template_name, is_rebuilt = get_or_build_pybind11_template(
+                dtype, lang, include_dirs, formula_object=formula_object
+            )
+
+            if not is_rebuilt:
+                os.replace(
+                    formula_object,
+                    template_build_folder
+                    + os.path.sep
+                    + pykeops.config.shared_obj_name
+                    + ".o",
+                )
+                link_pybind11_template(template_name, template_build_folder)
+
+            os.makedirs(
+                pykeops.config.bin_folder + os.path.sep + dllname, exist_ok=True
+            )
+            fname = list(
+                pathlib.Path(template_build_folder).glob(template_name + "*.so")
+            )[0].name
+            os.replace(
+                template_build_folder + os.path.sep + fname,
+                pykeops.config.bin_folder + os.path.sep + dllname + os.path.sep + fname,
+            )
 
     print("Done.", flush=True)
 
@@ -344,3 +695,73 @@ def compile_specific_fshape_scp_routine(
         msg="MAKE",
     )
     print("Done.")
+
+
+def get_bundle_build_folder(bundle_name):
+    return pykeops.config.bin_folder + os.path.sep + "build-" + bundle_name
+
+
+def compile_bundle(bundle_name, lang, include_dirs, members):
+    """
+    Link the object files of several formulas in a single python module, the bundle, which is stored in
+    pykeops.config.bin_folder/bundle_name/. The formulas are defined in submodules of the bundle.
+
+    :param members: list of (name, dtype, formula_object) tuples. The name of a member is the name of its submodule.
+    :return: the path of the shared object of the bundle, or None if the compilation failed.
+    """
+    build_folder = get_bundle_build_folder(bundle_name)
+    os.makedirs(build_folder, exist_ok=True)
+
+    print(
+        "[pyKeOps] Compiling bundle "
+        + bundle_name
+        + " ("
+        + str(len(members))
+        + " formulas) in "
+        + os.path.realpath(pykeops.config.bin_folder)
+        + " ... ",
+        end="",
+        flush=True,
+    )
+
+    command_line = [
+        "cmake",
+        pykeops.config.script_bundle_folder,
+        "-DCMAKE_BUILD_TYPE=" + "'{}'".format(pykeops.config.build_type),
+        "-DPYTHON_LANG=" + "'{}'".format(lang),
+        "-DPYTHON_EXECUTABLE=" + "'{}'".format(sys.executable),
+        "-DPYBIND11_PYTHON_VERSION="
+        + "'{}'".format(
+            str(sys.version_info.major) + "." + str(sys.version_info.minor)
+        ),
+        "-DC_CONTIGUOUS=1",
+        "-Dbundle_name=" + "'{}'".format(bundle_name),
+        "-Dbundle_members=" + "'{}'".format(";".join(name for (name, _, _) in members)),
+        "-Dbundle_types="
+        + "'{}'".format(";".join(c_type[dtype] for (_, dtype, _) in members)),
+        "-Dbundle_objects=" + "'{}'".format(";".join(obj for (_, _, obj) in members)),
+    ] + include_dirs
+
+    with timed_phase("bundle"):
+        run_and_display(command_line, build_folder, msg="CMAKE")
+        run_and_display(
+            ["cmake", "--build", ".", "--target", bundle_name, "--", "VERBOSE=1"],
+            build_folder,
+            msg="MAKE",
+        )
+
+    files = list(pathlib.Path(build_folder).glob(bundle_name + "*.so"))
+    if not files:
+        print("failed.", flush=True)
+        return None
+    os.makedirs(pykeops.config.bin_folder + os.path.sep + bundle_name, exist_ok=True)
+    path = (
+        pykeops.config.bin_folder
+        + os.path.sep
+        + bundle_name
+        + os.path.sep
+        + files[0].name
+    )
+    os.replace(str(files[0]), path)
+    print("done.", flush=True)
+    return path
@@ -0,0 +1,118 @@
+import functools
+import threading
+
+import pykeops.config
+
+# Options of the Cpu engine that are given at call time, without recompiling the KeOps routines: the number of
+# threads and the schedule of the loops over the lines (see keops/core/mapreduce/CpuOptions.h). They are passed
+# to the compiled module just before each call, by CpuOptions.apply.
+
+# schedules of the loops over the lines, as encoded by CpuOptions.h ; -1 means the default schedule of each loop
+schedule_kinds = {"static": 0, "dynamic": 1, "guided": 2, "numa": 3}
+
+
+def check_num_threads(num_threads):
+    if num_threads is not None and (
+        not isinstance(num_threads, int) or num_threads < 1
+    ):
+        raise ValueError(
+            "[KeOps] num_threads should be None or a positive integer, got {}.".format(
+                num_threads
+            )
+        )
+    return num_threads
+
+
+def parse_schedule(schedule):
+    """
+    Turn a schedule "kind" or "kind,chunk" (as in the OMP_SCHEDULE environment variable) into the
+    (kind, chunk) pair of integers of CpuOptions.h.
+    """
+    if schedule is None:
+        return -1, 0
+    kind, _, chunk = str(schedule).partition(",")
+    kind = kind.strip()
+    if kind not in schedule_kinds:
+        raise ValueError(
+            "[KeOps] Invalid schedule '{}'. It should be one of {}, possibly followed by ',chunk'.".format(
+                schedule, list(schedule_kinds)
+            )
+        )
+    if not chunk:
+        return schedule_kinds[kind], 0
+    if kind == "numa" or not chunk.strip().isdigit() or int(chunk) < 1:
+        raise ValueError(
+            "[KeOps] Invalid chunk size in schedule '{}': it should be a positive integer, "
+            "and cannot be used with 'numa'.".format(schedule)
+        )
+    return schedule_kinds[kind], int(chunk)
+
+
+def set_num_threads(num_threads=None):
+    r"""
+    Set the default number of threads of the Cpu engine of KeOps, for the routines that do not specify
+    their own **num_threads**. It is taken into account by the next calls, without recompiling the routines.
+
+    Args:
+        num_threads (int, default None): The number of threads. None restores the default number of threads
+            of OpenMP, e.g. the value of the ``OMP_NUM_THREADS`` environment variable.
+    """
+    pykeops.config.num_threads = check_num_threads(num_threads)
+
+
+class CpuOptions:
+    """
+    The num_threads and schedule options of a KeOps routine on the Cpu. They are also the options of the calls
+    made in a "with" block, e.g. in the backward pass of a PyTorch routine (see current).
+    """
+
+    _local = threading.local()
+
+    def __init__(self, num_threads=None, schedule=None):
+        self.num_threads = check_num_threads(num_threads)
+        self.schedule, self.chunk = parse_schedule(schedule)
+
+    def apply(self, myconv):
+        """
+        Set the options of the next calls of the compiled module myconv by the current thread.
+        """
+        num_threads = self.num_threads or pykeops.config.num_threads or 0
+        myconv.set_cpu_options(num_threads, self.schedule, self.chunk)
+
+    def __enter__(self):
+        self._stack().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        self._stack().pop()
+
+    @classmethod
+    def _stack(cls):
+        if not hasattr(cls._local, "stack"):
+            cls._local.stack = []
+        return cls._local.stack
+
+    @classmethod
+    def current(cls):
+        """
+        The options of the innermost "with" block of the current thread, or the default options.
+        """
+        stack = cls._stack()
+        return stack[-1] if stack else default_cpu_options
+
+
+default_cpu_options = CpuOptions()
+
+
+def with_cpu_options(method):
+    """
+    Decorator of the __call__ method of a KeOps routine: the options of the routine (its cpu_options attribute)
+    are those of all the calls that it makes, backward passes included.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.cpu_options:
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,418 @@
+import numpy as np
+
+from pykeops.common.parse_formula import (
+    aliases_to_variables,
+    canonicalize,
+    parse_formula,
+)
+
+# Maximum number of entries of the (block of the) kernel matrix which is evaluated at once, per dimension of the
+# formula: the output lines are processed by blocks to bound the memory footprint.
+max_block_entries = 2 ** 22
+
+
+class NumpyOps:
+    """
+    Array operations used by the dense evaluation of the formulas, for numpy arrays.
+    """
+
+    @staticmethod
+    def const(value, like):
+        return np.full((1, 1, 1), value, dtype=like.dtype)
+
+    @staticmethod
+    def zeros(dim, like):
+        return np.zeros((1, 1, dim), dtype=like.dtype)
+
+    @staticmethod
+    def arange(n, like):
+        return np.arange(n, dtype=like.dtype)
+
+    @staticmethod
+    def sum(x, axis=-1, keepdims=True):
+        return x.sum(axis, keepdims=keepdims)
+
+    @staticmethod
+    def min(x, axis=-1, keepdims=True):
+        return x.min(axis, keepdims=keepdims)
+
+    @staticmethod
+    def max(x, axis=-1, keepdims=True):
+        return x.max(axis, keepdims=keepdims)
+
+    @staticmethod
+    def argmin(x, axis=-1, keepdims=True):
+        out = x.argmin(axis).astype(x.dtype)
+        return np.expand_dims(out, axis) if keepdims else out
+
+    @staticmethod
+    def argmax(x, axis=-1, keepdims=True):
+        out = x.argmax(axis).astype(x.dtype)
+        return np.expand_dims(out, axis) if keepdims else out
+
+    @staticmethod
+    def sort(x, axis):
+        indices = np.argsort(x, axis=axis, kind="stable")
+        return np.take_along_axis(x, indices, axis), indices.astype(x.dtype)
+
+    @staticmethod
+    def concat(xs, axis=-1):
+        return np.concatenate(xs, axis)
+
+    @staticmethod
+    def stack(xs, axis):
+        return np.stack(xs, axis)
+
+    @staticmethod
+    def expand(x, shape):
+        return np.broadcast_to(x, shape)
+
+    @staticmethod
+    def where(cond, x, y):
+        return np.where(cond, x, y)
+
+    @staticmethod
+    def cast(x, like):
+        return x.astype(like.dtype)
+
+    @staticmethod
+    def matmul(a, b):
+        return np.matmul(a, b)
+
+    exp, log, sin, cos, sqrt = np.exp, np.log, np.sin, np.cos, np.sqrt
+    asin, acos, atan, abs, sign = np.arcsin, np.arccos, np.arctan, np.abs, np.sign
+    maximum, minimum, floor = np.maximum, np.minimum, np.floor
+
+
+class TorchOps:
+    """
+    Array operations used by the dense evaluation of the formulas, for torch tensors.
+    """
+
+    def __init__(self):
+        import torch
+
+        self.torch = torch
+        self.exp, self.log, self.sin, self.cos = (
+            torch.exp,
+            torch.log,
+            torch.sin,
+            torch.cos,
+        )
+        self.sqrt, self.asin, self.acos, self.atan = (
+            torch.sqrt,
+            torch.asin,
+            torch.acos,
+            torch.atan,
+        )
+        self.abs, self.sign, self.floor = torch.abs, torch.sign, torch.floor
+        self.maximum, self.minimum = torch.max, torch.min
+
+    def const(self, value, like):
+        return like.new_full((1, 1, 1), value)
+
+    def zeros(self, dim, like):
+        return like.new_zeros((1, 1, dim))
+
+    def arange(self, n, like):
+        return self.torch.arange(n, dtype=like.dtype, device=like.device)
+
+    def sum(self, x, axis=-1, keepdims=True):
+        return x.sum(axis, keepdim=keepdims)
+
+    def min(self, x, axis=-1, keepdims=True):
+        return x.min(axis, keepdim=keepdims)[0]
+
+    def max(self, x, axis=-1, keepdims=True):
+        return x.max(axis, keepdim=keepdims)[0]
+
+    def argmin(self, x, axis=-1, keepdims=True):
+        return x.argmin(axis, keepdim=keepdims).type_as(x)
+
+    def argmax(self, x, axis=-1, keepdims=True):
+        return x.argmax(axis, keepdim=keepdims).type_as(x)
+
+    def sort(self, x, axis):
+        values, indices = self.torch.sort(x, dim=axis)
+        return values, indices.type_as(x)
+
+    def concat(self, xs, axis=-1):
+        return self.torch.cat(xs, axis)
+
+    def stack(self, xs, axis):
+        return self.torch.stack(xs, axis)
+
+    def expand(self, x, shape):
+        return x.expand(shape)
+
+    def where(self, cond, x, y):
+        return self.torch.where(cond, x, y)
+
+    def cast(self, x, like):
+        return x.type_as(like)
+
+    def matmul(self, a, b):
+        return self.torch.matmul(a, b)
+
+
+def _leading_shape(*xs):
+    return tuple(max(sizes) for sizes in zip(*(x.shape[:-1] for x in xs)))
+
+
+def _broadcast(ops, *xs):
+    shape = _leading_shape(*xs)
+    return [ops.expand(x, shape + x.shape[-1:]) for x in xs]
+
+
+def _rsqrt(ops, x):
+    # as in KeOps, Rsqrt(0) = 0
+    safe = ops.where(x == 0, ops.const(1, x), x)
+    return ops.where(x == 0, ops.const(0, x), 1 / ops.sqrt(safe))
+
+
+def _weighted_sqnorm(ops, s, x):
+    d = x.shape[-1]
+    if s.shape[-1] == 1:
+        return s * ops.sum(x * x)
+    if s.shape[-1] == d:
+        return ops.sum(s * x * x)
+    s, x = _broadcast(ops, s, x)
+    matrix = s.reshape(s.shape[:-1] + (d, d))
+    return ops.sum(ops.matmul(matrix, x[..., None])[..., 0] * x)
+
+
+def _extract_t(ops, x, start, dim):
+    before, after = ops.zeros(start, x), ops.zeros(dim - start - x.shape[-1], x)
+    return ops.concat(_broadcast(ops, before, x, after))
+
+
+def _one_hot(ops, x, n):
+    return ops.cast(ops.floor(x + 0.5) == ops.arange(n, x), x)
+
+
+def _mat_vec_mult(ops, a, b):
+    a, b = _broadcast(ops, a, b)
+    matrix = a.reshape(a.shape[:-1] + (-1, b.shape[-1]))
+    return ops.matmul(matrix, b[..., None])[..., 0]
+
+
+def _vec_mat_mult(ops, b, a):
+    a, b = _broadcast(ops, a, b)
+    matrix = a.reshape(a.shape[:-1] + (b.shape[-1], -1))
+    return ops.matmul(b[..., None, :], matrix)[..., 0, :]
+
+
+def _tensor_prod(ops, a, b):
+    a, b = _broadcast(ops, a, b)
+    return (a[..., :, None] * b[..., None, :]).reshape(a.shape[:-1] + (-1,))
+
+
+def _sqdist(ops, x, y):
+    return ops.sum((x - y) ** 2)
+
+
+# Dense implementations of the operations: functions of the array operations, of the evaluated formula arguments
+# and of the integer arguments, in the order of the signatures of parse_formula.
+operations = {
+    "Minus": lambda ops, a: -a,
+    "Add": lambda ops, a, b: a + b,
+    "Subtract": lambda ops, a, b: a - b,
+    "ScalOrMult": lambda ops, a, b: a * b,
+    "Divide": lambda ops, a, b: a / b,
+    "Scalprod": lambda ops, a, b: ops.sum(a * b),
+    "SqNorm2": lambda ops, a: ops.sum(a * a),
+    "Norm2": lambda ops, a: ops.sqrt(ops.sum(a * a)),
+    "SqDist": _sqdist,
+    "Normalize": lambda ops, a: _rsqrt(ops, ops.sum(a * a)) * a,
+    "WeightedSqNorm": _weighted_sqnorm,
+    "WeightedSqDist": lambda ops, s, a, b: _weighted_sqnorm(ops, s, a - b),
+    "Exp": lambda ops, a: ops.exp(a),
+    "Log": lambda ops, a: ops.log(a),
+    "Sin": lambda ops, a: ops.sin(a),
+    "Cos": lambda ops, a: ops.cos(a),
+    "Asin": lambda ops, a: ops.asin(a),
+    "Acos": lambda ops, a: ops.acos(a),
+    "Atan": lambda ops, a: ops.atan(a),
+    "Abs": lambda ops, a: ops.abs(a),
+    "Sign": lambda ops, a: ops.sign(a),
+    "Sqrt": lambda ops, a: ops.sqrt(a),
+    "Rsqrt": _rsqrt,
+    "Square": lambda ops, a: a * a,
+    "Inv": lambda ops, a: 1 / a,
+    "Step": lambda ops, a: ops.cast(a >= 0, a),
+    "ReLU": lambda ops, a: ops.where(a < 0, ops.const(0, a), a),
+    "XLogX": lambda ops, a: ops.where(
+        a == 0, ops.const(0, a), a * ops.log(ops.where(a == 0, ops.const(1, a), a))
+    ),
+    "Pow": lambda ops, a, m: a ** m,
+    "Powf": lambda ops, a, b: ops.exp(b * ops.log(a)),
+    "Clamp": lambda ops, x, a, b: ops.minimum(ops.maximum(x, a), b),
+    "ClampInt": lambda ops, x, a, b: ops.minimum(
+        ops.maximum(x, ops.const(a, x)), ops.const(b, x)
+    ),
+    "Sum": lambda ops, a: ops.sum(a),
+    "Min": lambda ops, a: ops.min(a),
+    "Max": lambda ops, a: ops.max(a),
+    "ArgMin": lambda ops, a: ops.argmin(a),
+    "ArgMax": lambda ops, a: ops.argmax(a),
+    "Concat": lambda ops, a, b: ops.concat(_broadcast(ops, a, b)),
+    "Elem": lambda ops, a, m: a[..., m : m + 1],
+    "Extract": lambda ops, a, start, dim: a[..., start : start + dim],
+    "ExtractT": _extract_t,
+    "OneHot": _one_hot,
+    "SumT": lambda ops, a, dim: a + ops.zeros(dim, a),
+    "MatVecMult": _mat_vec_mult,
+    "VecMatMult": _vec_mat_mult,
+    "TensorProd": _tensor_prod,
+    "Factorize": lambda ops, f, g: f,
+    "GaussKernel": lambda ops, c, x, y, b: ops.exp(-c * _sqdist(ops, x, y)) * b,
+    "CauchyKernel": lambda ops, c, x, y, b: 1 / (1 + c * _sqdist(ops, x, y)) * b,
+    "LaplaceKernel": lambda ops, c, x, y, b: ops.exp(-c * ops.sqrt(_sqdist(ops, x, y)))
+    * b,
+    "InverseMultiquadricKernel": lambda ops, c, x, y, b: 1
+    / ops.sqrt(1 / c + _sqdist(ops, x, y))
+    * b,
+}
+
+
+def _k_smallest(ops, f, k, with_values, with_indices):
+    # f is a (O, R, D) array: return the k smallest values and/or their indices along R, as a (O, K*D) or
+    # (O, K*2*D) array, with the layout of the KMin/ArgKMin/KMin_ArgKMin reductions
+    if f.shape[1] < k:
+        raise NotImplementedError
+    values, indices = ops.sort(f, 1)
+    parts = []
+    if with_values:
+        parts.append(values[:, :k, :])
+    if with_indices:
+        parts.append(indices[:, :k, :])
+    out = ops.stack(parts, 2)  # (O, K, 1 or 2, D)
+    return out.reshape(out.shape[0], -1)
+
+
+def _sum_shift_exp(ops, f, g=None):
+    m = ops.max(f, 1)
+    e = ops.exp(f - m)
+    s = ops.sum(e if g is None else e * g, 1, False)
+    return ops.concat([m[:, 0, :], s])
+
+
+# Dense implementations of the reductions, along the axis 1 of the (O, R, D) evaluated formula.
+reductions = {
+    "Sum_Reduction": lambda ops, f: ops.sum(f, 1, False),
+    "Min_Reduction": lambda ops, f: ops.min(f, 1, False),
+    "Max_Reduction": lambda ops, f: ops.max(f, 1, False),
+    "ArgMin_Reduction": lambda ops, f: ops.argmin(f, 1, False),
+    "ArgMax_Reduction": lambda ops, f: ops.argmax(f, 1, False),
+    "Min_ArgMin_Reduction": lambda ops, f: ops.concat(
+        [ops.min(f, 1, False), ops.argmin(f, 1, False)]
+    ),
+    "Max_ArgMax_Reduction": lambda ops, f: ops.concat(
+        [ops.max(f, 1, False), ops.argmax(f, 1, False)]
+    ),
+    "Max_SumShiftExp_Reduction": _sum_shift_exp,
+    "Max_SumShiftExpWeight_Reduction": _sum_shift_exp,
+    "KMin_Reduction": lambda ops, f, k: _k_smallest(ops, f, k, True, False),
+    "ArgKMin_Reduction": lambda ops, f, k: _k_smallest(ops, f, k, False, True),
+    "KMin_ArgKMin_Reduction": lambda ops, f, k: _k_smallest(ops, f, k, True, True),
+}
+
+
+class DenseReduction:
+    """
+    Dense implementation of a KeOps reduction, with NumPy or PyTorch operations: the (blocks of the) kernel matrix
+    are computed explicitly. This is much slower than the compiled KeOps routines, and is only used while these
+    are compiled (see the background_compile option of Genred).
+
+    A NotImplementedError is raised by the constructor if the formula uses operations which have no dense
+    implementation, and by __call__ if the inputs are not supported (batch dimensions).
+    """
+
+    def __init__(self, formula, aliases, lang):
+        self.ops = TorchOps() if lang == "torch" else NumpyOps()
+        tree = canonicalize(
+            parse_formula(formula), aliases_to_variables(aliases), commute=False
+        )
+        if tree.op not in reductions:
+            raise NotImplementedError
+        self.reduction = tree.op
+        # the integer arguments of the reductions: K (for the KMin reductions) and the axis (last one)
+        int_args = [arg for arg in tree.args if isinstance(arg, int)]
+        self.tag, self.opt_args = int_args[-1], int_args[:-1]
+        self.formula = tree.args[0]
+        self.formula2 = (
+            tree.args[2] if self.reduction.endswith("Weight_Reduction") else None
+        )
+        self.variables = {}
+        self.check(self.formula)
+        if self.formula2 is not None:
+            self.check(self.formula2)
+        if not self.variables:
+            raise NotImplementedError
+
+    def check(self, node):
+        if node.op == "Var":
+            self.variables[node.args[0]] = node.args
+        elif node.op in ("IntCst", "IntInv", "Zero"):
+            pass
+        elif node.op in operations:
+            for arg in node.args:
+                if not isinstance(arg, int):
+                    self.check(arg)
+        else:
+            raise NotImplementedError
+
+    def eval(self, node, values):
+        if node.op == "Var":
+            return values[node.args[0]]
+        like = next(iter(values.values()))
+        if node.op == "IntCst":
+            return self.ops.const(node.args[0], like)
+        if node.op == "IntInv":
+            return self.ops.const(1.0 / node.args[0], like)
+        if node.op == "Zero":
+            return self.ops.zeros(node.args[0], like)
+        args = [
+            arg if isinstance(arg, int) else self.eval(arg, values) for arg in node.args
+        ]
+        return operations[node.op](self.ops, *args)
+
+    def __call__(self, nx, ny, *args):
+        """
+        Return the output of the reduction, as the compiled KeOps routines: a (nx, D) or (ny, D) array.
+        """
+        nout, nred = (nx, ny) if self.tag == 0 else (ny, nx)
+        for (pos, dim, cat) in self.variables.values():
+            if args[pos].ndim != (1 if cat == 2 else 2):
+                raise NotImplementedError  # batch dimensions
+
+        maxdim = max(dim for (_, dim, _) in self.variables.values())
+        block = max(1, max_block_entries // max(1, nred * maxdim))
+        outs = []
+        for start in range(0, nout, block):
+            values = {}
+            for (pos, dim, cat) in self.variables.values():
+                if cat == 2:
+                    values[pos] = args[pos][None, None, :]
+                elif cat == self.tag:
+                    values[pos] = args[pos][start : start + block, None, :]
+                else:
+                    values[pos] = args[pos][None, :, :]
+            f = self.eval(self.formula, values)
+            rows = min(block, nout - start)
+            f = self.ops.expand(f, (rows, nred, f.shape[-1]))
+            extra = (
+                [self.eval(self.formula2, values)] if self.formula2 is not None else []
+            )
+            outs.append(reductions[self.reduction](self.ops, f, *extra, *self.opt_args))
+        return self.ops.concat(outs, 0)
+
+
+def get_dense_reduction(formula, aliases, lang):
+    """
+    Return the DenseReduction of the formula, or None if it has no dense implementation.
+    """
+    try:
+        return DenseReduction(formula, aliases, lang)
+    except NotImplementedError:
+        return None
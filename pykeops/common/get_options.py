@@ -1,4 +1,3 @@
-import re
 import numpy as np
 from collections import OrderedDict
 import pykeops
@@ -30,6 +29,9 @@ class SetBackend:
         "GPU_2D_host",
     ]
 
+    # the options split in device, grid and memory type, computed once
+    split_options = {option: option.split("_") for option in possible_options_list}
+
     def define_tag_backend(self, backend, variables):
         """
         Try to make a good guess for the backend...  available methods are: (host means Cpu, device means Gpu)
@@ -45,7 +47,8 @@ class SetBackend:
         """
 
         # check that the option is valid
-        if backend not in self.possible_options_list:
+        split_backend = self.split_options.get(backend)
+        if split_backend is None:
             raise ValueError(
                 "Invalid backend. Should be one of ", self.possible_options_list
             )
@@ -58,7 +61,6 @@ class SetBackend:
                 self._find_mem(variables),
             )
 
-        split_backend = re.split("_", backend)
         if len(split_backend) == 1:  # CPU or GPU
             return (
                 self.dev[split_backend[0]],
@@ -127,11 +129,15 @@ class SetBackend:
         return 0
 
 
+# SetBackend has no state: a single instance is used for all the calls
+_set_backend = SetBackend()
+
+
 def get_tag_backend(backend, variables, str=False):
     """
     entry point to get the correct backend
     """
-    res = SetBackend()
+    res = _set_backend
     if not str:
         return res.define_tag_backend(backend, variables)
     else:
@@ -9,17 +9,10 @@ namespace py = pybind11;
 /////////////////////////////////////////////////////////////////////////////////
 
 template< typename array_t, typename index_t >
-array_t generic_red(
-        int tagCpuGpu,        // tagCpuGpu=0     means Reduction on Cpu, tagCpuGpu=1       means Reduction on Gpu, tagCpuGpu=2 means Reduction on Gpu from device data
-        int tag1D2D,          // tag1D2D=0       means 1D Gpu scheme,      tag1D2D=1       means 2D Gpu scheme
-        int tagHostDevice,    // tagHostDevice=1 means _fromDevice suffix. tagHostDevice=0 means _fromHost suffix
-        int Device_Id,        // id of GPU device
-        py::tuple py_ranges,  // () if no "sparsity" ranges are given (default behavior)
-                              // Otherwise, ranges is a 6-uple of (integer) array_t
-                              // ranges = (ranges_i, slices_i, redranges_j, ranges_j, slices_j, redranges_i)
-                              // as documented in the doc on sparstiy and clustering.
-		int nx,				  // number of samples / data points of the "i" indexed variables
-		int ny,				  // number of samples / data points of the "j" indexed variables
+array_t generic_red_(
+        int tagCpuGpu, int tag1D2D, int tagHostDevice, int Device_Id, py::tuple py_ranges, int nx, int ny,
+        array_t* out,         // output array given by the user, or nullptr to allocate a new one
+        bool accumulate,      // if true, the output of the reduction is added to *out (Cpu engine only)
         py::args py_args) {
   
 //////////////////////////////////////////////////////////////
@@ -44,6 +37,12 @@ array_t generic_red(
   for (int i = 0; i < nranges; i++)
     ranges[i] = py::cast< index_t >(py_ranges[i]);
 
+  // Check the output array
+  if (out != nullptr) {
+    keops_binders::Sizes< array_t > SS(nargs, &args[0], nx, ny);
+    keops_binders::check_output(*out, SS.shape_out, SS.nbatchdims);
+  }
+
 //////////////////////////////////////////////////////////////
 // Call Cuda codes                                          //
 //////////////////////////////////////////////////////////////
@@ -58,8 +57,46 @@ array_t generic_red(
            nargs,
            &args[0],
            nranges,
-           &ranges[0]);
+           &ranges[0],
+           out,
+           accumulate);
   py::gil_scoped_acquire acquire;
   return result;
 }
 
+template< typename array_t, typename index_t >
+array_t generic_red(
+        int tagCpuGpu,        // tagCpuGpu=0     means Reduction on Cpu, tagCpuGpu=1       means Reduction on Gpu, tagCpuGpu=2 means Reduction on Gpu from device data
+        int tag1D2D,          // tag1D2D=0       means 1D Gpu scheme,      tag1D2D=1       means 2D Gpu scheme
+        int tagHostDevice,    // tagHostDevice=1 means _fromDevice suffix. tagHostDevice=0 means _fromHost suffix
+        int Device_Id,        // id of GPU device
+        py::tuple py_ranges,  // () if no "sparsity" ranges are given (default behavior)
+                              // Otherwise, ranges is a 6-uple of (integer) array_t
+                              // ranges = (ranges_i, slices_i, redranges_j, ranges_j, slices_j, redranges_i)
+                              // as documented in the doc on sparstiy and clustering.
+		int nx,				  // number of samples / data points of the "i" indexed variables
+		int ny,				  // number of samples / data points of the "j" indexed variables
+        py::args py_args) {
+  return generic_red_< array_t, index_t >(tagCpuGpu, tag1D2D, tagHostDevice, Device_Id, py_ranges, nx, ny,
+                                          nullptr, false, py_args);
+}
+
+// Same as generic_red, but the output is written in the array out, which must be contiguous and have the shape
+// of the output: it is returned. If accumulate is true, the output of the reduction is added to out by
+// the Cpu engine, without temporary array.
+template< typename array_t, typename index_t >
+array_t generic_red_out(
+        int tagCpuGpu, int tag1D2D, int tagHostDevice, int Device_Id, py::tuple py_ranges, int nx, int ny,
+        array_t out, bool accumulate, py::args py_args) {
+  return generic_red_< array_t, index_t >(tagCpuGpu, tag1D2D, tagHostDevice, Device_Id, py_ranges, nx, ny,
+                                          &out, accumulate, py_args);
+}
+
+// Sets the options of the Cpu engine for the next calls of the calling thread (see keops/core/mapreduce/CpuOptions.h):
+// num_threads (0 means the default of OpenMP), schedule (-1 means the default of each loop, then static, dynamic,
+// guided or numa) and the chunk size of the schedule (0 means the default of OpenMP).
+void set_cpu_options(int num_threads, int schedule, int chunk) {
+#if !USE_HALF
+  CpuSetOptions(num_threads, schedule, chunk);
+#endif
+}
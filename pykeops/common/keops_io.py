@@ -1,21 +1,58 @@
-import importlib.util
-import os
+import concurrent.futures
+import contextlib
+import threading
+import time
 
 import pykeops.config
 from pykeops.common.compile_routines import (
     compile_generic_routine,
     get_pybind11_template_name,
-    get_build_folder_name,
     check_or_prebuild,
 )
-from pykeops.common.utils import module_exists, create_and_lock_build_folder
-from pykeops.common.set_path import create_name
+from pykeops.common.utils import create_and_lock_build_folder
+from pykeops.common.set_path import create_name, set_build_folder
+from pykeops.common.parse_formula import get_canonical_formula, validate_formula
+from pykeops.common.kernel_cache import (
+    find_bundle_member,
+    find_module,
+    find_failure,
+    record_failure,
+    register_module,
+    record_hit,
+    load_module,
+)
+
+
+def get_kernel_names(formula, aliases, dtype, lang, optional_flags, include_dirs):
+    """
+    Check a kernel and compute its canonical form and the names of its compiled module.
+
+    :return: formula, aliases, optional_flags (canonical forms), template_name, dll_name
+    """
+    # Syntax errors and dimension mismatches are detected here, in milliseconds, rather than by the compiler.
+    validate_formula(formula, aliases)
+
+    # Structurally identical formulas are compiled once: the formula is given in a canonical form,
+    # with positional variables and sorted commutative operations.
+    formula, aliases, optional_flags = get_canonical_formula(
+        formula, aliases, optional_flags
+    )
+
+    # get template name for dtype
+    template_name = get_pybind11_template_name(dtype, lang, include_dirs)
+
+    # create the name from formula, aliases and dtype.
+    dll_name = create_name(formula, aliases, dtype, lang, optional_flags, include_dirs)
+
+    return formula, aliases, optional_flags, template_name, dll_name
 
 
 class LoadKeOps:
     """
     Load the keops shared library that corresponds to the given formula, aliases, dtype and lang.
-    If the shared library cannot be loaded, it will be compiled.
+    The compiled modules are searched in the bundles of formulas (see pykeops.build_bundle), then in the cache roots
+    (see pykeops.config.cache_roots) and in the local cache pykeops.config.bin_folder. If the shared library cannot be
+    found, it will be compiled in the local cache.
     Note: This function is thread/process safe by using a file lock.
 
     :return: The Python function that corresponds to the loaded Keops kernel.
@@ -24,33 +61,57 @@ class LoadKeOps:
     def __init__(
         self, formula, aliases, dtype, lang, optional_flags=[], include_dirs=[]
     ):
-        self.formula = formula
-        self.aliases = aliases
+        (
+            self.formula,
+            self.aliases,
+            self.optional_flags,
+            self.template_name,
+            self.dll_name,
+        ) = get_kernel_names(
+            formula, aliases, dtype, lang, optional_flags, include_dirs
+        )
         self.dtype = dtype
         self.lang = lang
-        self.optional_flags = optional_flags
         self.include_dirs = include_dirs
 
-        # get build folder name for dtype
-        self.build_folder = get_build_folder_name(dtype, lang, include_dirs)
+        # a bundle gathers many formulas in a single shared object: it is loaded once for all its members
+        self.bundle = None
+        if pykeops.config.build_type != "Debug":
+            self.bundle = find_bundle_member(self.dll_name, self.template_name)
+            if self.bundle is not None:
+                return
 
-        # get template name for dtype
-        self.template_name = get_pybind11_template_name(dtype, lang, include_dirs)
+        # each formula is compiled in its own build folder, so that several formulas may be compiled concurrently
+        self.build_folder = set_build_folder(pykeops.config.bin_folder, self.dll_name)
 
-        # create the name from formula, aliases and dtype.
-        self.dll_name = create_name(
-            self.formula, self.aliases, self.dtype, self.lang, self.optional_flags
-        )
+        self.module_path = find_module(self.dll_name, self.template_name)
 
-        if (not module_exists(self.dll_name, self.template_name)) or (
-            pykeops.config.build_type == "Debug"
-        ):
+        if pykeops.config.build_type == "Debug":
+            self._safe_compile()
+        elif self.module_path is None:
+            if find_failure(self.dll_name) is not None:
+                raise ValueError(
+                    "[KeOps] The compilation of the formula {} failed previously. Run pykeops.clean_pykeops() "
+                    "to try again.".format(self.formula)
+                )
             self._safe_compile()
+        else:
+            record_hit(self.dll_name, self.template_name)
 
     @create_and_lock_build_folder()
     def _safe_compile(self):
+        # the module may have been compiled by another process while we were waiting for the lock
+        if pykeops.config.build_type != "Debug":
+            self.module_path = find_module(
+                self.dll_name, self.template_name, refresh=True
+            ) or register_module(self.dll_name, self.template_name)
+            if self.module_path is not None:
+                return
+        start = time.perf_counter()
         # if needed, safely run cmake in build folder to prepare for building
-        check_or_prebuild(self.dtype, self.lang, self.include_dirs)
+        check_or_prebuild(
+            self.dtype, self.lang, self.include_dirs, build_folder=self.build_folder
+        )
         # launch compilation and linking of required KeOps formula
         compile_generic_routine(
             self.formula,
@@ -62,23 +123,207 @@ class LoadKeOps:
             self.include_dirs,
             self.build_folder,
         )
+        self.module_path = register_module(
+            self.dll_name, self.template_name, time.perf_counter() - start
+        )
+        if self.module_path is None:
+            record_failure(self.dll_name, self.formula)
 
     def import_module(self):
-        full_dll_name = self.dll_name + "." + self.template_name
-        module_bin_folder = os.path.dirname(
-            os.path.dirname(importlib.util.find_spec(full_dll_name).origin)
-        )
-        if not os.path.samefile(
-            module_bin_folder,
-            pykeops.config.bin_folder,
-        ):
+        if self.bundle is not None:
+            bundle_name, path, member = self.bundle
+            return getattr(load_module(bundle_name, path), member)
+        if self.module_path is None:
             raise ImportError(
-                "[pyKeOps]: Current pykeops.config.bin_folder is {} but keops module {} is loaded from {} folder. "
-                "This may happened when changing bin_folder **after** loading a keops module. Please check everything "
-                "is fine.".format(
-                    pykeops.config.bin_folder,
-                    self.dll_name,
-                    module_bin_folder,
+                "[pyKeOps]: The keops module {} could not be compiled (formula: {}). Set the environment variable "
+                "PYKEOPS_VERBOSE=1 to display the compilation logs.".format(
+                    self.dll_name, self.formula
                 )
             )
-        return importlib.import_module(full_dll_name)
+        return load_module(self.dll_name + "." + self.template_name, self.module_path)
+
+
+class KernelRegistry:
+    """
+    In-process registry of the keops modules that have already been loaded.
+
+    Loading a KeOps kernel through :class:`LoadKeOps` involves hashing the formula, several file system
+    lookups and an import. The registry memoizes the imported module with respect to the key
+    (formula, aliases, dtype, lang, optional_flags, include_dirs) so that these steps are performed once per
+    process. The registry is thread safe: concurrent requests for the same kernel load it only once.
+
+    Kernels may also be compiled in the background with :func:`get_async`, which returns a future.
+
+    The registry has to be invalidated whenever ``pykeops.config.bin_folder`` changes, see :func:`invalidate`.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._modules = {}
+        self._pending = {}
+        self._futures = {}
+        self._executor = None
+        self._recording = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(formula, aliases, dtype, lang, optional_flags=[], include_dirs=[]):
+        return (
+            formula,
+            tuple(aliases),
+            dtype,
+            lang,
+            tuple(optional_flags),
+            tuple(include_dirs),
+        )
+
+    def get(self, formula, aliases, dtype, lang, optional_flags=[], include_dirs=[]):
+        """
+        Return the python module corresponding to the KeOps kernel, loading (and compiling) it if needed.
+        """
+        kernels = getattr(self._recording, "kernels", None)
+        if kernels is not None:
+            kernels.append((lang, formula, list(aliases), dtype, list(optional_flags)))
+            return None
+
+        if pykeops.config.build_type == "Debug":
+            # Debug mode forces recompilation of every kernel: bypass the registry.
+            return LoadKeOps(
+                formula, aliases, dtype, lang, optional_flags, include_dirs
+            ).import_module()
+
+        key = self.make_key(formula, aliases, dtype, lang, optional_flags, include_dirs)
+
+        with self._lock:
+            module = self._modules.get(key)
+            if module is not None:
+                self.hits += 1
+                return module
+            self.misses += 1
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+
+        if not owner:
+            # another thread is loading the very same kernel: wait for it and retry.
+            event.wait()
+            with self._lock:
+                module = self._modules.get(key)
+            if module is not None:
+                return module
+            return self.get(formula, aliases, dtype, lang, optional_flags, include_dirs)
+
+        # The lock is released while loading, so that distinct kernels may be compiled concurrently.
+        try:
+            module = LoadKeOps(
+                formula, aliases, dtype, lang, optional_flags, include_dirs
+            ).import_module()
+            with self._lock:
+                self._modules[key] = module
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+        return module
+
+    def get_async(
+        self, formula, aliases, dtype, lang, optional_flags=[], include_dirs=[]
+    ):
+        """
+        Return a :class:`concurrent.futures.Future` of the python module corresponding to the KeOps kernel.
+        If needed, the kernel is loaded (and compiled) by a background worker thread: concurrent requests for the
+        same kernel share the same future.
+        """
+        key = self.make_key(formula, aliases, dtype, lang, optional_flags, include_dirs)
+        with self._lock:
+            module = self._modules.get(key)
+            recording = getattr(self._recording, "kernels", None) is not None
+            if module is None and not recording:
+                future = self._futures.get(key)
+                if future is None:
+                    if self._executor is None:
+                        self._executor = concurrent.futures.ThreadPoolExecutor(
+                            thread_name_prefix="pykeops-compile"
+                        )
+                    future = self._futures[key] = self._executor.submit(
+                        self.get,
+                        formula,
+                        aliases,
+                        dtype,
+                        lang,
+                        optional_flags,
+                        include_dirs,
+                    )
+                    future.add_done_callback(lambda f: self._forget_future(key, f))
+                return future
+
+        # the module is already loaded, or the kernel is only recorded (see record)
+        future = concurrent.futures.Future()
+        future.set_result(
+            module
+            if module is not None
+            else self.get(formula, aliases, dtype, lang, optional_flags, include_dirs)
+        )
+        return future
+
+    def _forget_future(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    @contextlib.contextmanager
+    def record(self):
+        """
+        Within this context, the kernels requested by the current thread are appended to the returned list as
+        (lang, formula, aliases, dtype, optional_flags) tuples, but they are neither compiled nor loaded.
+        This is used to collect the kernels of Genred objects without compiling them.
+        """
+        kernels = []
+        self._recording.kernels = kernels
+        try:
+            yield kernels
+        finally:
+            self._recording.kernels = None
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._modules
+
+    def __len__(self):
+        with self._lock:
+            return len(self._modules)
+
+    def invalidate(self):
+        """
+        Forget every loaded module and reset the counters. Called when ``pykeops.config.bin_folder`` changes.
+        """
+        with self._lock:
+            self._modules.clear()
+            self._futures.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._modules),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+kernel_registry = KernelRegistry()
+
+
+def load_keops_module(
+    formula, aliases, dtype, lang, optional_flags=[], include_dirs=[]
+):
+    """
+    Return the python module corresponding to the given KeOps kernel, going through the in-process registry.
+    """
+    return kernel_registry.get(
+        formula, aliases, dtype, lang, optional_flags, include_dirs
+    )
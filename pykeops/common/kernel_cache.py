@@ -0,0 +1,472 @@
+import atexit
+import copy
+import importlib.util
+import json
+import os
+import pathlib
+import shutil
+import sys
+import threading
+import time
+
+import pykeops.config
+from pykeops.common.utils import FileLock
+
+manifest_name = "manifest.json"
+
+
+def get_cache_roots():
+    """
+    Return the list of the cache roots, in the order they are searched: first the read-only
+    roots listed in pykeops.config.cache_roots, then the writable local root pykeops.config.bin_folder.
+    """
+    local_root = os.path.realpath(pykeops.config.bin_folder)
+    roots = [
+        os.path.realpath(os.path.expanduser(root))
+        for root in pykeops.config.cache_roots
+    ]
+    return [root for root in roots if root != local_root] + [local_root]
+
+
+class Manifest:
+    """
+    Index of the KeOps modules stored in a cache root. It maps the full name of the modules,
+    i.e. "<dll_name>.<template_name>", to the path of the shared object relative to the root.
+    Reading the manifest avoids scanning the sys.path to look for a module.
+
+    The manifest also records, in its "bundles" section, the bundles of formulas (see pykeops.build_bundle)
+    with the full names of their members. Its "stats" section holds the cumulative
+    usage counters of the cache, which are not reset when modules are evicted.
+    """
+
+    sections = ("modules", "bundles", "stats")
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, manifest_name)
+        self.data = {section: {} for section in self.sections}
+        self._mtime = None
+
+    @property
+    def entries(self):
+        return self.data["modules"]
+
+    @property
+    def bundles(self):
+        return self.data["bundles"]
+
+    @property
+    def stats(self):
+        return self.data["stats"]
+
+    def reload(self):
+        """
+        Read the manifest from disk, if it has been modified since the last reading.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.data = {section: {} for section in self.sections}
+            self._mtime = None
+            return
+        if mtime != self._mtime:
+            try:
+                with open(self.path, "r") as f:
+                    content = json.load(f)
+            except (OSError, ValueError):
+                content = {}
+            self.data = {section: content.get(section, {}) for section in self.sections}
+            self._mtime = mtime
+
+    def lookup(self, full_name):
+        """
+        Return the absolute path of the shared object of the module, or None.
+        """
+        entry = self.entries.get(full_name)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry["path"])
+        return path if os.path.isfile(path) else None
+
+    def lookup_bundle(self, full_name):
+        """
+        Return the name and absolute path of a bundle containing the module, with the name of the member, or None.
+        """
+        for (bundle_name, entry) in self.bundles.items():
+            member = entry["members"].get(full_name)
+            if member is not None:
+                path = os.path.join(self.root, entry["path"])
+                if os.path.isfile(path):
+                    return bundle_name, path, member
+        return None
+
+    def update(self, func, section="modules"):
+        """
+        Safely apply func to the entries of a section of the manifest (read, modify, write) and save it on disk.
+        If section is None, func is applied to the whole content of the manifest.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            with FileLock(lock):
+                self._mtime = None
+                self.reload()
+                func(self.data if section is None else self.data[section])
+                tmp_path = self.path + ".{}.tmp".format(os.getpid())
+                with open(tmp_path, "w") as f:
+                    json.dump(dict(version=1, **self.data), f, indent=1)
+                os.replace(tmp_path, self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+
+    def add(self, full_name, path):
+        relpath = os.path.relpath(path, self.root)
+
+        def add_entry(entries):
+            entries[full_name] = dict(entries.get(full_name, {}), path=relpath)
+
+        self.update(add_entry)
+
+
+_manifests = {}
+
+
+def get_manifest(root):
+    root = os.path.realpath(root)
+    if root not in _manifests:
+        _manifests[root] = Manifest(root)
+        _manifests[root].reload()
+    return _manifests[root]
+
+
+def get_local_manifest():
+    return get_manifest(pykeops.config.bin_folder)
+
+
+def get_counters(data):
+    """
+    Return the cumulative usage counters of the "stats" section of the manifest content data. The counters
+    of a manifest written by a previous version of pykeops are initialized from its modules.
+    """
+    counters = data["stats"]
+    if not counters:
+        entries = data["modules"].values()
+        counters.update(
+            compilations=len(entries),
+            hits=sum(entry.get("hits", 0) for entry in entries),
+            compile_seconds=sum(entry.get("compile_seconds", 0) for entry in entries),
+            compile_seconds_saved=sum(
+                entry.get("hits", 0) * entry.get("compile_seconds", 0)
+                for entry in entries
+            ),
+        )
+    return counters
+
+
+def find_module(dll_name, template_name, refresh=False):
+    """
+    Look for a compiled KeOps module in the cache roots. Read-only roots are searched first.
+
+    :param refresh: if True, re-read the manifests that have been modified on disk (e.g. by another process).
+    :return: the absolute path of the shared object, or None.
+    """
+    full_name = dll_name + "." + template_name
+    for root in get_cache_roots():
+        manifest = get_manifest(root)
+        if refresh:
+            manifest.reload()
+        path = manifest.lookup(full_name)
+        if path is not None:
+            return path
+    return None
+
+
+def find_bundle_member(dll_name, template_name, refresh=False):
+    """
+    Look for a bundle of formulas containing the module in the cache roots.
+
+    :return: (bundle_name, path of the shared object of the bundle, name of the member), or None.
+    """
+    full_name = dll_name + "." + template_name
+    for root in get_cache_roots():
+        manifest = get_manifest(root)
+        if refresh:
+            manifest.reload()
+        found = manifest.lookup_bundle(full_name)
+        if found is not None:
+            return found
+    return None
+
+
+def register_bundle(bundle_name, path, members):
+    """
+    Add a bundle freshly compiled in pykeops.config.bin_folder to the local manifest.
+
+    :param members: dict which maps the full names of the modules of the bundle to the names of their submodules.
+    """
+    manifest = get_local_manifest()
+
+    def add_bundle(bundles):
+        bundles[bundle_name] = {
+            "path": os.path.relpath(path, manifest.root),
+            "members": members,
+            "size": get_folder_size(os.path.dirname(path)),
+        }
+
+    manifest.update(add_bundle, section="bundles")
+
+
+def parse_size(size):
+    """
+    Convert a size given as a number of bytes or as a string with a K, M or G suffix (e.g. "10G") to bytes.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper()
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def get_folder_size(path):
+    size = 0
+    for folder, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(folder, f))
+            except OSError:
+                pass
+    return size
+
+
+def register_module(dll_name, template_name, compile_seconds=0.0):
+    """
+    Add a module freshly compiled in pykeops.config.bin_folder to the local manifest, and evict the
+    least recently used modules if the local cache exceeds its limits.
+
+    :return: the absolute path of the shared object, or None if the compilation failed.
+    """
+    from pykeops.common.set_path import set_build_folder
+
+    files = list(
+        pathlib.Path(pykeops.config.bin_folder, dll_name).glob(template_name + "*.so")
+    )
+    if not files:
+        return None
+    path = str(files[0])
+    manifest = get_local_manifest()
+    size = get_folder_size(os.path.dirname(path)) + get_folder_size(
+        set_build_folder(pykeops.config.bin_folder, dll_name)
+    )
+
+    def add_entry(data):
+        full_name = dll_name + "." + template_name
+        if full_name not in data["modules"]:
+            counters = get_counters(data)
+            counters["compilations"] += 1
+            counters["compile_seconds"] += compile_seconds
+        data["modules"][full_name] = {
+            "path": os.path.relpath(path, manifest.root),
+            "size": size,
+            "compile_seconds": compile_seconds,
+            "hits": 0,
+            "last_access": time.time(),
+        }
+
+    manifest.update(add_entry, section=None)
+    evict(keep=[dll_name + "." + template_name])
+    return path
+
+
+# Failed compilations of the current process: (root, dll_name) -> record. They are not written in the manifest,
+# since a compilation may fail for transient reasons (interrupted build, full disk...) which are fixed later.
+_failures = {}
+
+
+def record_failure(dll_name, formula):
+    """
+    Record that the compilation of a module in the local cache failed, for the life of the current process.
+    """
+    root = os.path.realpath(pykeops.config.bin_folder)
+    _failures[root, dll_name] = {"formula": formula, "time": time.time()}
+
+
+def find_failure(dll_name):
+    """
+    Return the record of a failed compilation of the module by the current process, or None.
+    """
+    return _failures.get((os.path.realpath(pykeops.config.bin_folder), dll_name))
+
+
+# Hits of the current process which are not yet written in the manifests: (root, full_name) -> (hits, last_access).
+# They are written once, at exit or when the statistics of the cache are needed, so that loading a module
+# never waits for the lock of the manifest.
+_pending_hits = {}
+_pending_hits_lock = threading.Lock()
+
+
+def record_hit(dll_name, template_name):
+    """
+    Update the usage statistics of a module of the local cache which is loaded without compilation.
+    The hit is kept in memory until the next call to flush_hits().
+    """
+    full_name = dll_name + "." + template_name
+    manifest = get_local_manifest()
+    if full_name not in manifest.entries:
+        return
+    with _pending_hits_lock:
+        hits, _ = _pending_hits.get((manifest.root, full_name), (0, 0))
+        _pending_hits[manifest.root, full_name] = (hits + 1, time.time())
+
+
+@atexit.register
+def flush_hits():
+    """
+    Write the hits recorded by the current process in the manifests, with a single update per manifest.
+    """
+    with _pending_hits_lock:
+        pending = dict(_pending_hits)
+        _pending_hits.clear()
+    roots = {}
+    for (root, full_name), hit in pending.items():
+        roots.setdefault(root, {})[full_name] = hit
+
+    for root, hits in roots.items():
+
+        def add_hits(data):
+            counters = get_counters(data)
+            for full_name, (count, last_access) in hits.items():
+                entry = data["modules"].get(full_name)
+                if entry is None:
+                    continue
+                entry["hits"] = entry.get("hits", 0) + count
+                entry["last_access"] = max(entry.get("last_access", 0), last_access)
+                counters["hits"] += count
+                counters["compile_seconds_saved"] += count * entry.get(
+                    "compile_seconds", 0
+                )
+
+        try:
+            get_manifest(root).update(add_hits, section=None)
+        except OSError:
+            pass
+
+
+# Open files of the modules loaded by the current process: a shared lock is held on each of them,
+# so that other processes never evict a module in use.
+_in_use = {}
+
+
+def is_in_use(path):
+    if path in _in_use:
+        return True
+    try:
+        with open(path, "rb") as f:
+            with FileLock(f, blocking=False):
+                pass
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def evict(max_size=None, max_count=None, keep=[]):
+    """
+    Remove the least recently used modules of the local cache until its total size and number of modules
+    are below the given limits (default to pykeops.config.cache_max_size and pykeops.config.cache_max_count).
+    Modules loaded by a live process, and the modules listed in keep, are never removed. Bundles are built
+    explicitly by pykeops.build_bundle: they are exempt from the limits, and never removed.
+
+    :return: the list of the removed modules.
+    """
+    from pykeops.common.set_path import set_build_folder
+
+    max_size = parse_size(
+        pykeops.config.cache_max_size if max_size is None else max_size
+    )
+    max_count = pykeops.config.cache_max_count if max_count is None else max_count
+    if max_size is None and max_count is None:
+        return []
+
+    flush_hits()
+    manifest = get_local_manifest()
+    removed = []
+
+    def remove_lru(entries):
+        size = sum(entry.get("size", 0) for entry in entries.values())
+        count = len(entries)
+        for name in sorted(entries, key=lambda n: entries[n].get("last_access", 0)):
+            if (max_size is None or size <= max_size) and (
+                max_count is None or count <= max_count
+            ):
+                break
+            path = os.path.join(manifest.root, entries[name]["path"])
+            if name in keep or is_in_use(path):
+                continue
+            dll_name = name.split(".")[0]
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            shutil.rmtree(set_build_folder(manifest.root, dll_name), ignore_errors=True)
+            size -= entries[name].get("size", 0)
+            count -= 1
+            removed.append(name)
+            del entries[name]
+
+    manifest.update(remove_lru)
+    return removed
+
+
+def cache_stats():
+    """
+    Return usage statistics of the local cache pykeops.config.bin_folder. The number of modules and bundles,
+    and the size, describe the current content of the cache (bundles included); the numbers of compilations
+    and hits, and the compilation times, are cumulated since the creation of the cache, evicted modules included.
+    """
+    from pykeops.common.compile_routines import phase_timings
+    from pykeops.common.keops_io import kernel_registry
+
+    flush_hits()
+    manifest = get_local_manifest()
+    manifest.reload()
+    counters = get_counters(copy.deepcopy(manifest.data))
+    hits, compilations = counters["hits"], counters["compilations"]
+    return {
+        "folder": manifest.root,
+        "modules": len(manifest.entries),
+        "bundles": len(manifest.bundles),
+        "size": sum(entry.get("size", 0) for entry in manifest.entries.values())
+        + sum(bundle.get("size", 0) for bundle in manifest.bundles.values()),
+        "compilations": compilations,
+        "hits": hits,
+        "hit_ratio": hits / (hits + compilations) if hits + compilations > 0 else 0.0,
+        "compile_seconds": counters["compile_seconds"],
+        "compile_seconds_saved": counters["compile_seconds_saved"],
+        "compile_phases": dict(phase_timings),
+        "process": kernel_registry.stats(),
+    }
+
+
+def load_module(full_name, path):
+    """
+    Import the KeOps module (or bundle of modules) stored in the shared object given by path.
+    """
+    if full_name in sys.modules:
+        return sys.modules[full_name]
+    spec = importlib.util.spec_from_file_location(full_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[full_name] = module
+
+    # mark the module as in use, for the whole life of the process
+    try:
+        f = open(path, "rb")
+        FileLock(f, shared=True, blocking=False).acquire()
+        _in_use[path] = f
+    except OSError:
+        pass
+    return module
+
+
+def clear_manifests():
+    # called by clean_pykeops(): the failed compilations are attempted again
+    _manifests.clear()
+    _failures.clear()
@@ -1,5 +1,6 @@
 import copy
 import re
+import weakref
 
 import numpy as np
 
@@ -20,6 +21,110 @@ def is_scalar_and_equals(x, val):
         return False
 
 
+class FormulaNode:
+    r"""Node of the hash-consed expression DAG that underlies the formula of a :class:`LazyTensor`.
+
+    A node is made of **children** nodes, interleaved with the strings of **parts**:
+    its formula is ``parts[0] + children[0] + parts[1] + ... + parts[-1]``.
+    Leaves (variables, constants...) have no children and a single part.
+    Nodes are unique: building twice the same operation on the same operands
+    returns the same node, so that repeated subexpressions are shared in the DAG.
+    Building a node costs O(arity), whatever the length of the formulas of its children.
+    """
+
+    __slots__ = ("parts", "children", "size", "__weakref__")
+
+    _nodes = weakref.WeakValueDictionary()
+
+    def __new__(cls, parts, children=()):
+        key = (parts,) + children
+        node = cls._nodes.get(key)
+        if node is None:
+            node = super().__new__(cls)
+            node.parts = parts
+            node.children = children
+            # size of the formula tree (i.e. without sharing), used to order the factorizations
+            node.size = 1 + sum(child.size for child in children)
+            cls._nodes[key] = node
+        return node
+
+    @classmethod
+    def leaf(cls, formula):
+        return cls((formula,))
+
+    @classmethod
+    def op(cls, *items):
+        r"""Builds a node from a sequence of strings and :class:`FormulaNode`, e.g. ``op("Exp(", f, ")")``."""
+        parts, children, part = (), (), ""
+        for item in items:
+            if isinstance(item, FormulaNode):
+                parts, children, part = parts + (part,), children + (item,), ""
+            else:
+                part += item
+        return cls(parts + (part,), children)
+
+    def is_leaf(self):
+        return len(self.children) == 0
+
+    def nodes(self):
+        r"""Returns the list of the distinct nodes of the DAG, children first."""
+        order, seen, stack = [], set(), [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif id(node) not in seen:
+                seen.add(id(node))
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+        return order
+
+    def render(self, memo=None):
+        r"""Returns the formula string of the node. **memo** caches the strings of subformulas."""
+        memo = {} if memo is None else memo
+        for node in self.nodes():
+            if id(node) not in memo:
+                strings = [node.parts[0]]
+                for child, part in zip(node.children, node.parts[1:]):
+                    strings += [memo[id(child)], part]
+                memo[id(node)] = "".join(strings)
+        return memo[id(self)]
+
+    def map_leaves(self, fun):
+        r"""Returns the node obtained by replacing each leaf of formula ``f`` with a leaf of formula ``fun(f)``."""
+        new = {}
+        for node in self.nodes():
+            if node.is_leaf():
+                new[id(node)] = FormulaNode.leaf(fun(node.parts[0]))
+            else:
+                children = tuple(new[id(child)] for child in node.children)
+                new[id(node)] = FormulaNode(node.parts, children)
+        return new[id(self)]
+
+    def factorized(self):
+        r"""Returns the formula string of the node, where the subformulas that appear several times
+        in the DAG are computed once only, through :mod:`Factorize` operations.
+
+        As ``Factorize(F,G)`` replaces **G** inside **F**, the largest subformulas are factorized first:
+        the formula of ``(D.exp() * D)`` with ``D = x.sqdist(y)`` becomes
+        ``Factorize((Exp(D) * D),D)``, with the full string of **D** in place of ``D``.
+        """
+        indegrees = {}
+        for node in self.nodes():
+            for child in node.children:
+                indegrees[id(child)] = indegrees.get(id(child), 0) + 1
+        shared = [
+            node
+            for node in self.nodes()
+            if not node.is_leaf() and indegrees.get(id(node), 0) > 1
+        ]
+        memo = {}
+        formula = self.render(memo)
+        for node in sorted(shared, key=lambda node: -node.size):
+            formula = "Factorize(" + formula + "," + node.render(memo) + ")"
+        return formula
+
+
 class GenericLazyTensor:
     r"""Symbolic wrapper for NumPy arrays and PyTorch tensors. This is the abstract class,
     end user should use :class:`pykeops.numpy.LazyTensor` or :class:`pykeops.torch.LazyTensor`.
@@ -40,7 +145,7 @@ class GenericLazyTensor:
 
     variables = ()
     symbolic_variables = ()
-    formula = None
+    _node = None  # Root of the expression DAG, see FormulaNode
     formula2 = None
     ndim = None
     tools = None
@@ -157,6 +262,17 @@ class GenericLazyTensor:
             else:
                 self.dtype = self.tools.dtypename(self.tools.dtype(x))
 
+    @property
+    def formula(self):
+        r"""
+        The formula string of the :class:`LazyTensor`, rendered from its expression DAG.
+        """
+        return None if self._node is None else self._node.render()
+
+    @formula.setter
+    def formula(self, formula):
+        self._node = None if formula is None else FormulaNode.leaf(formula)
+
     def lt_constructor(self, x=None, axis=None):
         r"""This method is specialized in :class:`pykeops.numpy.LazyTensor` and :class:`pykeops.torch.LazyTensor`. It
         returns a new instance of a LazyTensor (numpy or pytorch)."""
@@ -291,10 +407,12 @@ class GenericLazyTensor:
 
     def separate_kwargs(self, kwargs):
         # separating keyword arguments for Genred init vs Genred call...
-        # Currently the only four additional optional keyword arguments that are passed to Genred init
+        # Currently the only additional optional keyword arguments that are passed to Genred init
         # are accuracy options: dtype_acc, use_double_acc and sum_cheme,
         # chunk mode option enable_chunks,
-        # and compiler option optional_flags.
+        # compiler options optional_flags and background_compile,
+        # the fused gradients option value_and_grad,
+        # and the options of the Cpu engine num_threads and schedule.
         kwargs_init = []
         kwargs_call = []
         for key in kwargs:
@@ -304,6 +422,10 @@ class GenericLazyTensor:
                 "sum_scheme",
                 "enable_chunks",
                 "optional_flags",
+                "background_compile",
+                "value_and_grad",
+                "num_threads",
+                "schedule",
             ):
                 kwargs_init += [(key, kwargs[key])]
             else:
@@ -407,13 +529,15 @@ class GenericLazyTensor:
 
         res = self.init()  # Copy of self, without a formula
         if opt_arg2 is not None:
-            res.formula = "{}({},{},{})".format(
-                operation, self.formula, opt_arg, opt_arg2
+            res._node = FormulaNode.op(
+                operation + "(", self._node, ",{},{})".format(opt_arg, opt_arg2)
             )
         elif opt_arg is not None:
-            res.formula = "{}({},{})".format(operation, self.formula, opt_arg)
+            res._node = FormulaNode.op(
+                operation + "(", self._node, ",{})".format(opt_arg)
+            )
         else:
-            res.formula = "{}({})".format(operation, self.formula)
+            res._node = FormulaNode.op(operation + "(", self._node, ")")
         res.ndim = dimres
         return res
 
@@ -478,31 +602,38 @@ class GenericLazyTensor:
         res.ndim = dimres
 
         if not rversion:
-            lformula, rformula = self.formula, other.formula
+            lnode, rnode = self._node, other._node
         else:
-            rformula, lformula = self.formula, other.formula
+            rnode, lnode = self._node, other._node
 
         if is_operator:
-            res.formula = "({} {} {})".format(lformula, operation, rformula)
+            res._node = FormulaNode.op("(", lnode, " {} ".format(operation), rnode, ")")
         elif opt_arg is not None:
             if hasattr(opt_arg, "__GenericLazyTensor__"):
-                opt_arg = opt_arg.formula
+                opt_arg = opt_arg._node
+            else:
+                opt_arg = str(opt_arg)
             if opt_pos == "last":
-                res.formula = "{}({}, {}, {})".format(
-                    operation, lformula, rformula, opt_arg
+                res._node = FormulaNode.op(
+                    operation + "(", lnode, ", ", rnode, ", ", opt_arg, ")"
                 )
             elif opt_pos == "middle":
-                res.formula = "{}({}, {}, {})".format(
-                    operation, lformula, opt_arg, rformula
+                res._node = FormulaNode.op(
+                    operation + "(", lnode, ", ", opt_arg, ", ", rnode, ")"
                 )
         else:
-            res.formula = "{}({}, {})".format(operation, lformula, rformula)
+            res._node = FormulaNode.op(operation + "(", lnode, ", ", rnode, ")")
 
         # special case of multiplication with a variable V : we define a special tag to enable factorization in case
         # the user requires a sum reduction over the opposite index (or any index if V is a parameter):
         # for example sum_i V_j k(x_i,y_j) = V_j sum_i k(x_i,y_j), so we will use KeOps reduction for the kernel
         # k(x_i,y_j) only, then multiply the result with V.
-        if operation == "*" and other.formula[:3] == "Var" and other.ndim > 100:
+        if (
+            operation == "*"
+            and other._node.is_leaf()
+            and other._node.parts[0][:3] == "Var"
+            and other.ndim > 100
+        ):
             res.rec_multVar_highdim = (self, other)
 
         return res
@@ -573,13 +704,29 @@ class GenericLazyTensor:
 
         if opt_arg is not None:
             if hasattr(opt_arg, "__GenericLazyTensor__"):
-                opt_arg = opt_arg.formula
-            res.formula = "{}({}, {}, {}, {})".format(
-                operation, self.formula, other1.formula, other2.formula, opt_arg
+                opt_arg = opt_arg._node
+            else:
+                opt_arg = str(opt_arg)
+            res._node = FormulaNode.op(
+                operation + "(",
+                self._node,
+                ", ",
+                other1._node,
+                ", ",
+                other2._node,
+                ", ",
+                opt_arg,
+                ")",
             )
         else:
-            res.formula = "{}({}, {}, {})".format(
-                operation, self.formula, other1.formula, other2.formula
+            res._node = FormulaNode.op(
+                operation + "(",
+                self._node,
+                ", ",
+                other1._node,
+                ", ",
+                other2._node,
+                ")",
             )
 
         return res
@@ -607,6 +754,8 @@ class GenericLazyTensor:
           axis (integer): The axis with respect to which the reduction should be performed.
             Supported values are **nbatchdims** and **nbatchdims + 1**, where **nbatchdims** is the number of "batch" dimensions before the last three
             (:math:`i` indices, :math:`j` indices, variables' dimensions).
+            For Sum reductions, **axis** = (**nbatchdims**, **nbatchdims + 1**) performs
+            a reduction over both :math:`i` and :math:`j` indices, which returns a single vector.
           dim (integer): alternative keyword for the **axis** argument.
           call (True or False): Should we actually perform the reduction on the current variables?
             If **True**, the returned object will be a NumPy array or a PyTorch tensor.
@@ -646,11 +795,31 @@ class GenericLazyTensor:
                 accuracy for large sized data.
             enable_chunks (bool, default True): enable automatic selection of special "chunked" computation mode for accelerating reductions
                                 with formulas involving large dimension variables.
+          background_compile (bool, default None): compile the KeOps routine in a background thread, and meanwhile
+            compute the reduction with a dense NumPy or PyTorch implementation of the formula. See :meth:`ready`.
+          value_and_grad (bool, default False): PyTorch only. For a sum reduction of a scalar formula wrt. j,
+            compute the gradients wrt. the ``Vi`` variables which require grad together with the value of
+            the reduction, in the same map-reduce pass. See :mod:`pykeops.torch.Genred`.
+          num_threads (int, default None): number of threads of the CPU engine, given at call time
+            without recompiling the KeOps routine. See :func:`pykeops.set_num_threads`.
+          schedule (string, default None): schedule of the loops of the CPU engine, e.g. ``"dynamic,16"``
+            or ``"numa"``. See :mod:`pykeops.numpy.Genred`.
         """
 
         if axis is None:
             axis = dim  # NumPy uses axis, PyTorch uses dim...
-        if axis - self.nbatchdims not in (0, 1):
+        if isinstance(axis, (tuple, list)):
+            # reduction over both i and j
+            if reduction_op != "Sum" or sorted(axis) != [
+                self.nbatchdims,
+                self.nbatchdims + 1,
+            ]:
+                raise ValueError(
+                    "[KeOps] Reductions over both i and j must be Sum reductions, with 'axis' (or 'dim') equal to "
+                    "the number of batch dimensions + (0, 1)."
+                )
+            axis = None
+        elif axis - self.nbatchdims not in (0, 1):
             raise ValueError(
                 "Reductions must be called with 'axis' (or 'dim') equal to the number of batch dimensions + 0 or 1."
             )
@@ -662,16 +831,20 @@ class GenericLazyTensor:
             res = self.join(other)
             res.formula2 = other.formula
 
-        res.formula = self.formula
+        res._node = self._node
         res.reduction_op = reduction_op
-        res.axis = axis - self.nbatchdims
+        res.axis = None if axis is None else axis - self.nbatchdims
         res.opt_arg = opt_arg
 
         kwargs_init, kwargs_call = self.separate_kwargs(kwargs)
 
         res.kwargs = kwargs_call
         res.ndim = self.ndim
-        if reduction_op == "Sum" and hasattr(self, "rec_multVar_highdim"):
+        if (
+            reduction_op == "Sum"
+            and res.axis is not None
+            and hasattr(self, "rec_multVar_highdim")
+        ):
             if res.axis != self.rec_multVar_highdim[1].axis:
                 return (
                     self.rec_multVar_highdim[0].sum(axis=axis)
@@ -680,6 +853,14 @@ class GenericLazyTensor:
             res.rec_multVar_highdim = id(self.rec_multVar_highdim[1].variables[0])
         else:
             res.rec_multVar_highdim = None
+
+        # Subformulas that appear several times are computed once only, through Factorize operations.
+        # We leave formulas with large dimensional variables as they are, for the sake of the chunked mode:
+        leaves = [node.parts[0] for node in res._node.nodes() if node.is_leaf()]
+        dims = re.findall(r"Var(?:Symb)?\(-?\d+,(\d+),", " ".join(leaves))
+        if all(int(dim) <= 100 for dim in dims):
+            res.formula = res._node.factorized()
+
         if res.dtype is not None:
             res.fixvariables()  # Turn the "id(x)" numbers into consecutive labels
             # "res" now becomes a callable object:
@@ -785,7 +966,7 @@ class GenericLazyTensor:
             # var is given and must be a symbolic variable which is already inside self
             varindex = var.symbolic_variables[0][0]
             res = self.init()
-            res.formula = self.formula
+            res._node = self._node
 
         res.formula2 = None
         res.reduction_op = "Solve"
@@ -882,12 +1063,23 @@ class GenericLazyTensor:
 
         return self.callfun(*args, *self.variables, **self.kwargs)
 
+    def ready(self):
+        r"""
+        Returns a :class:`concurrent.futures.Future` of the compiled KeOps routine of a reduction, as
+        :meth:`pykeops.torch.Genred.ready`: this is mostly useful with the **background_compile** option.
+        """
+        if not hasattr(getattr(self, "callfun", None), "ready"):
+            raise ValueError(
+                "[KeOps] ready() may be called only on the output of a reduction whose dtype is known."
+            )
+        return self.callfun.ready()
+
     def __str__(self):
         r"""
         Returns a verbose string identifier.
         """
         tmp = self.init()  # ~ self.copy()
-        tmp.formula = self.formula
+        tmp._node = self._node
         tmp.formula2 = None if not hasattr(self, "formula2") else self.formula2
 
         tmp.fixvariables()  # Replace Var(id(x),...) with consecutive labels
@@ -1624,6 +1816,7 @@ class GenericLazyTensor:
 
           - if **axis or dim = 0**, return the sum reduction of **self** over the "i" indexes.
           - if **axis or dim = 1**, return the sum reduction of **self** over the "j" indexes.
+          - if **axis or dim = (0, 1)**, return the sum reduction of **self** over both the "i" and "j" indexes.
           - if **axis or dim = 2**, return a new :class:`LazyTensor` object representing the sum of the values of the vector **self**,
 
         Keyword Args:
@@ -2099,15 +2292,15 @@ class GenericLazyTensor:
         elif res.axis == 1:
             res.axis = 0
 
-        if res.formula is not None:  # Switch variables with CAT=0 and CAT=1
-            res.formula = re.sub(
-                r"(Var|VarSymb)\((\d+),(\d+),0\)", r"\1(\2,\3,i)", res.formula
-            )
-            res.formula = re.sub(
-                r"(Var|VarSymb)\((\d+),(\d+),1\)", r"\1(\2,\3,0)", res.formula
-            )
-            res.formula = re.sub(
-                r"(Var|VarSymb)\((\d+),(\d+),i\)", r"\1(\2,\3,1)", res.formula
+        if res._node is not None:  # Switch variables with CAT=0 and CAT=1
+            res._node = res._node.map_leaves(
+                lambda f: re.sub(
+                    r"(Var|VarSymb)\((\d+),(\d+),([01])\)",
+                    lambda m: "{}({},{},{})".format(
+                        m.group(1), m.group(2), m.group(3), 1 - int(m.group(4))
+                    ),
+                    f,
+                )
             )
 
         if res.formula2 is not None:  # Switch variables with CAT=0 and CAT=1
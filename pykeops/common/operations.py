@@ -28,6 +28,37 @@ def preprocess(reduction_op, formula2):
     return reduction_op_internal, formula2
 
 
+# Reductions whose output is post-processed: the output of the engine is not the final result.
+postprocessed_reductions = (
+    "SumSoftMaxWeight",
+    "SoftMax",
+    "ArgMin",
+    "ArgMax",
+    "Min_ArgMin",
+    "MinArgMin",
+    "Max_ArgMax",
+    "MaxArgMax",
+    "KMin",
+    "ArgKMin",
+    "KMin_ArgKMin",
+    "KMinArgKMin",
+    "LogSumExp",
+)
+
+
+def check_output_reduction(reduction_op, axis):
+    # an output array given by the user is filled directly by the engine, so that the reduction
+    # must not be post-processed
+    if reduction_op in postprocessed_reductions:
+        raise ValueError(
+            "[KeOps] The out argument is not supported with the "
+            + reduction_op
+            + " reduction."
+        )
+    if axis is None:
+        raise ValueError("[KeOps] The out argument is not supported with axis=None.")
+
+
 def postprocess(out, binding, reduction_op, nout, opt_arg, dtype):
     tools = get_tools(binding)
     # Post-processing of the output:
@@ -0,0 +1,671 @@
+import re
+
+import numpy as np
+
+from pykeops.common.parse_type import get_type, categories
+
+# infix operators of the KeOps formulas, with the name of the corresponding operation
+binary_operators = {
+    "+": "Add",
+    "-": "Subtract",
+    "*": "ScalOrMult",
+    "/": "Divide",
+    "|": "Scalprod",
+}
+unary_operators = {"-": "Minus"}
+
+# precedence of the binary operators, as in C++ (the formulas are C++ expressions)
+precedence = {"|": 1, "+": 2, "-": 2, "*": 3, "/": 3}
+
+# variables given by their category
+variable_categories = dict(categories, Vx=0, Vy=1)
+
+# deprecated names of the reductions
+reduction_synonyms = {
+    "SumReduction": "Sum_Reduction",
+    "LogSumExpReduction": "Max_SumShiftExp_Reduction",
+    "LogSumExpVectReduction": "Max_SumShiftExpWeight_Reduction",
+    "MinReduction": "Min_Reduction",
+    "MaxReduction": "Max_Reduction",
+    "ArgMinReduction": "ArgMin_Reduction",
+    "ArgMaxReduction": "ArgMax_Reduction",
+    "MaxArgMaxReduction": "Max_ArgMax_Reduction",
+    "KMinReduction": "KMin_Reduction",
+    "ArgKMinReduction": "ArgKMin_Reduction",
+    "KMinArgKMinReduction": "KMin_ArgKMin_Reduction",
+}
+
+# operations whose (two) operands may be swapped without changing the result, even in floating point arithmetic
+commutative_operations = ("Add", "ScalOrMult", "Scalprod", "SqDist")
+
+token_regex = re.compile(r"\s*(?:([0-9]+)|([A-Za-z_][A-Za-z_0-9]*)|(\S))")
+
+
+class Node:
+    """
+    A node of the syntax tree of a KeOps formula: an operation name and a tuple of arguments, which are
+    either nodes or integers. Variables are the nodes Var(pos,dim,cat) and aliases are the nodes with op "Alias".
+    """
+
+    __slots__ = ("op", "args", "_str")
+
+    def __init__(self, op, args=()):
+        self.op = op
+        self.args = tuple(args)
+        self._str = None
+
+    def __str__(self):
+        if self._str is None:
+            if self.op == "Alias":
+                self._str = self.args[0]
+            else:
+                self._str = (
+                    self.op + "(" + ",".join(str(arg) for arg in self.args) + ")"
+                )
+        return self._str
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+def tokenize(formula):
+    tokens = []
+    pos = 0
+    formula = formula.rstrip()
+    while pos < len(formula):
+        m = token_regex.match(formula, pos)
+        if m.group(1) is not None:
+            tokens.append(("int", m.group(1), m.start(1)))
+        elif m.group(2) is not None:
+            tokens.append(("name", m.group(2), m.start(2)))
+        else:
+            tokens.append(("punct", m.group(3), m.start(3)))
+        pos = m.end()
+    tokens.append(("end", "", len(formula)))
+    return tokens
+
+
+class FormulaParser:
+    """
+    Recursive descent parser for the KeOps formulas.
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.pos = 0
+
+    def error(self, msg, token=None):
+        token = self.tokens[self.pos] if token is None else token
+        return ValueError(
+            "[KeOps] Invalid formula: {} at position {} in '{}'.".format(
+                msg, token[2], self.formula
+            )
+        )
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value:
+            raise self.error(
+                "expected '{}' but found '{}'".format(
+                    value, token[1] or "end of formula"
+                ),
+                token,
+            )
+
+    def parse(self):
+        node = self.expression()
+        if self.peek()[0] != "end":
+            raise self.error("unexpected '{}'".format(self.peek()[1]))
+        return node
+
+    def expression(self, min_precedence=1):
+        left = self.unary()
+        while True:
+            kind, value, _ = self.peek()
+            if kind != "punct" or value not in precedence:
+                return left
+            if precedence[value] < min_precedence:
+                return left
+            token = self.next()
+            right = self.expression(precedence[value] + 1)
+            if isinstance(left, int) or isinstance(right, int):
+                raise self.error(
+                    "integers must be wrapped as IntCst(n) in formulas", token
+                )
+            left = Node(binary_operators[value], (left, right))
+
+    def unary(self):
+        kind, value, _ = self.peek()
+        if kind == "punct" and value in ("-", "+"):
+            token = self.next()
+            operand = self.unary()
+            if isinstance(operand, int):
+                return -operand if value == "-" else operand
+            if value == "+":
+                raise self.error("unexpected '+'", token)
+            return Node(unary_operators[value], (operand,))
+        return self.primary()
+
+    def primary(self):
+        token = self.next()
+        kind, value, _ = token
+        if kind == "int":
+            return int(value)
+        if kind == "punct" and value == "(":
+            node = self.expression()
+            self.expect(")")
+            return node
+        if kind == "name":
+            if self.peek()[1] != "(":
+                return Node("Alias", (value,))
+            self.next()
+            args = []
+            if self.peek()[1] != ")":
+                args.append(self.expression())
+                while self.peek()[1] == ",":
+                    self.next()
+                    args.append(self.expression())
+            self.expect(")")
+            return Node(value, args)
+        raise self.error("unexpected '{}'".format(value or "end of formula"), token)
+
+
+def parse_formula(formula):
+    """
+    Parse a KeOps formula (a string) into a syntax tree of Node objects.
+    """
+    return FormulaParser(formula).parse()
+
+
+def aliases_to_variables(aliases):
+    """
+    Return a dict mapping the names of the aliases to (pos, dim, cat) tuples.
+    """
+    variables = {}
+    for (i, alias) in enumerate(aliases):
+        name, cat, dim, pos = get_type(alias, position_in_list=i)
+        if name is not None:
+            variables[name] = (pos, dim, cat)
+    return variables
+
+
+def canonicalize(node, variables, commute=True):
+    """
+    Return the canonical form of the syntax tree node:
+        - aliases and Vi/Vj/Pm variables are replaced by positional Var(pos,dim,cat) variables,
+        - deprecated names of reductions are replaced by the current ones,
+        - constants are normalized (e.g. Minus(IntCst(1)) -> IntCst(-1)),
+        - if commute is True, the operands of commutative operations are sorted.
+    """
+    if isinstance(node, int):
+        return node
+    if node.op == "Alias":
+        name = node.args[0]
+        if name not in variables:
+            raise ValueError(
+                "[KeOps] Invalid formula: unknown variable '{}'.".format(name)
+            )
+        return Node("Var", variables[name])
+    if node.op in variable_categories and len(node.args) == 2:
+        return Node("Var", node.args + (variable_categories[node.op],))
+
+    op = reduction_synonyms.get(node.op, node.op)
+    args = tuple(canonicalize(arg, variables, commute) for arg in node.args)
+
+    if op == "Minus" and isinstance(args[0], Node) and args[0].op == "IntCst":
+        return Node("IntCst", (-args[0].args[0],))
+    if commute and op in commutative_operations and str(args[1]) < str(args[0]):
+        args = (args[1], args[0])
+    return Node(op, args)
+
+
+#########################################################################################
+# Type checking: dimensions of the operations, arity of the reductions, categories of the variables
+
+
+class FormulaError(ValueError):
+    pass
+
+
+def _equal(name, *dims):
+    if len(set(dims)) > 1:
+        raise FormulaError(
+            "{} expects operands of the same dimension, but got dimensions {}".format(
+                name, ", ".join(str(d) for d in dims)
+            )
+        )
+    return dims[0]
+
+
+def _broadcast(name, *dims):
+    dim = max(dims)
+    if any(d != dim and d != 1 for d in dims):
+        raise FormulaError(
+            "{} expects operands of the same dimension, or of dimension 1, but got dimensions {}".format(
+                name, ", ".join(str(d) for d in dims)
+            )
+        )
+    return dim
+
+
+def _scalar(name, dim, what="operand"):
+    if dim != 1:
+        raise FormulaError(
+            "{} expects a scalar {}, but got dimension {}".format(name, what, dim)
+        )
+
+
+def _positive(name, dim):
+    if dim < 1:
+        raise FormulaError(
+            "{} expects an operand of positive dimension, but got dimension {}".format(
+                name, dim
+            )
+        )
+    return 1
+
+
+def _elem(name, d, m):
+    if not 0 <= m < d:
+        raise FormulaError(
+            "index {} is out of bounds in {} (operand of dimension {})".format(
+                m, name, d
+            )
+        )
+    return 1
+
+
+def _elem_t(name, d, n, m):
+    _scalar(name, d)
+    if not 0 <= m < n:
+        raise FormulaError(
+            "index {} is out of bounds in {} (output of dimension {})".format(
+                m, name, n
+            )
+        )
+    return n
+
+
+def _extract(name, d, start, length):
+    if start < 0 or length < 1 or start + length > d:
+        raise FormulaError(
+            "indices [{},{}) are out of bounds in {} (operand of dimension {})".format(
+                start, start + length, name, d
+            )
+        )
+    return length
+
+
+def _extract_t(name, d, start, dim):
+    if start < 0 or start + d > dim:
+        raise FormulaError(
+            "an operand of dimension {} cannot be injected at position {} in {} of dimension {}".format(
+                d, start, name, dim
+            )
+        )
+    return dim
+
+
+def _mat_vec(name, a, b):
+    if a % b != 0:
+        raise FormulaError(
+            "{} expects a matrix of dimension multiple of the dimension of the vector, "
+            "but got dimensions {} and {}".format(name, a, b)
+        )
+    return a // b
+
+
+def _weighted_norm(name, s, a):
+    if s not in (1, a, a * a):
+        raise FormulaError(
+            "{} expects weights of dimension 1, {} or {}, but got dimension {}".format(
+                name, a, a * a, s
+            )
+        )
+    return 1
+
+
+def _scalar_radial_kernel(name, c, x, y, b):
+    _scalar(name, c, "parameter")
+    _broadcast(name, x, y)
+    return b
+
+
+def _tensordot(name, a, b, dimfa, dimfb, contfa, contfb, *permute):
+    prod = lambda dims: int(np.prod(dims)) if len(dims) else 1
+    if prod(dimfa) != a or prod(dimfb) != b:
+        raise FormulaError(
+            "{} expects operands of dimensions {} and {}, but got dimensions {} and {}".format(
+                name, prod(dimfa), prod(dimfb), a, b
+            )
+        )
+    if len(contfa) != len(contfb) or any(
+        not (0 <= i < len(dimfa) and 0 <= j < len(dimfb)) or dimfa[i] != dimfb[j]
+        for (i, j) in zip(contfa, contfb)
+    ):
+        raise FormulaError("{} has inconsistent contraction dimensions".format(name))
+    return prod(dimfa) * prod(dimfb) // prod([dimfa[i] for i in contfa]) ** 2
+
+
+# Signatures of the operations: the kinds of the arguments, and a function which returns the
+# dimension of the output from the dimensions of the formulas and the values of the integer arguments.
+# Kinds: "f" is a formula, "n" an integer, "I" an index sequence Ind(...), "v" a variable,
+# "r" a formula or a reduction (for gradients).
+signatures = {}
+
+for (
+    op
+) in "Abs Acos Asin Atan Cos Sin Exp Log Inv Minus Sign Sqrt Rsqrt Square Step ReLU XLogX Normalize".split():
+    signatures[op] = ("f", lambda name, d: d)
+for op in ("SqNorm2", "Norm2"):
+    signatures[op] = ("f", lambda name, d: 1)
+for op in ("Sum", "Min", "Max", "ArgMin", "ArgMax"):
+    signatures[op] = ("f", _positive)
+for op in ("Add", "Subtract", "ScalOrMult", "Divide"):
+    signatures[op] = ("ff", _broadcast)
+for op in ("GaussKernel", "CauchyKernel", "LaplaceKernel", "InverseMultiquadricKernel"):
+    signatures[op] = ("ffff", _scalar_radial_kernel)
+
+signatures.update(
+    {
+        "Var": ("nnn", None),
+        "IntCst": ("n", lambda name, n: 1),
+        "IntInv": ("n", lambda name, n: 1),
+        "Zero": ("n", lambda name, d: d),
+        "Pow": ("fn", lambda name, d, m: d),
+        "Powf": ("ff", lambda name, a, b: _scalar(name, b, "exponent") or a),
+        "ClampInt": ("fnn", lambda name, d, a, b: d),
+        "Clamp": ("fff", _broadcast),
+        "Scalprod": ("ff", lambda name, a, b: _equal(name, a, b) and 1),
+        "SqDist": ("ff", lambda name, a, b: _broadcast(name, a, b) and 1),
+        "WeightedSqNorm": ("ff", _weighted_norm),
+        "WeightedSqDist": (
+            "fff",
+            lambda name, s, a, b: _weighted_norm(name, s, _broadcast(name, a, b)),
+        ),
+        "Concat": ("ff", lambda name, a, b: a + b),
+        "Elem": ("fn", _elem),
+        "ElemT": ("fnn", _elem_t),
+        "Extract": ("fnn", _extract),
+        "ExtractT": ("fnn", _extract_t),
+        "OneHot": (
+            "fn",
+            lambda name, d, n: _scalar(name, d) or _positive(name, n) and n,
+        ),
+        "SumT": ("fn", lambda name, d, n: _scalar(name, d) or n),
+        "MatVecMult": ("ff", _mat_vec),
+        "VecMatMult": ("ff", lambda name, b, a: _mat_vec(name, a, b)),
+        "TensorProd": ("ff", lambda name, a, b: a * b),
+        "TensorDot": ("ffIIII*", _tensordot),
+        "GradMatrix": ("fv", lambda name, f, v: f * v),
+        "Factorize": ("ff", lambda name, f, g: f),
+        "DivFreeGaussKernel": (
+            "ffff",
+            lambda name, c, x, y, b: _scalar(name, c, "parameter")
+            or _equal(name, x, y, b),
+        ),
+        "CurlFreeGaussKernel": (
+            "ffff",
+            lambda name, c, x, y, b: _scalar(name, c, "parameter")
+            or _equal(name, x, y, b),
+        ),
+        "TRIGaussKernel": (
+            "fffff",
+            lambda name, l, c, x, y, b: _scalar(name, l, "parameter")
+            or _scalar(name, c, "parameter")
+            or _equal(name, x, y, b),
+        ),
+        "SumGaussKernel": (
+            "fffff",
+            lambda name, c, w, x, y, b: _equal(name, c, w)
+            and _broadcast(name, x, y)
+            and b,
+        ),
+        "Grad": ("rvf", None),
+        "Grad_WithSavedForward": ("rvff", None),
+        "GradFromPos": ("rvn", lambda name, f, v, i: v),
+        "GradFromPos_WithSavedForward": ("rvn", lambda name, f, v, i: v),
+        "GradFromInd": ("rnn", None),
+        "GradFromInd_WithSavedForward": ("rnn", None),
+    }
+)
+
+# Reductions: kinds of the arguments (the axis "I" is given as an integer "n") and output dimension.
+reductions = {
+    "Sum_Reduction": ("fn", lambda name, d, i: d),
+    "Max_SumShiftExp_Reduction": (
+        "fn",
+        lambda name, d, i: _scalar(name, d, "formula") or 2,
+    ),
+    "Max_SumShiftExpWeight_Reduction": (
+        "fnf",
+        lambda name, d, i, g: _scalar(name, d, "formula") or 1 + g,
+    ),
+    "Min_Reduction": ("fn", lambda name, d, i: d),
+    "Max_Reduction": ("fn", lambda name, d, i: d),
+    "ArgMin_Reduction": ("fn", lambda name, d, i: d),
+    "ArgMax_Reduction": ("fn", lambda name, d, i: d),
+    "Min_ArgMin_Reduction": ("fn", lambda name, d, i: 2 * d),
+    "Max_ArgMax_Reduction": ("fn", lambda name, d, i: 2 * d),
+    "KMin_Reduction": ("fnn", lambda name, d, k, i: k * d),
+    "ArgKMin_Reduction": ("fnn", lambda name, d, k, i: k * d),
+    "KMin_ArgKMin_Reduction": ("fnn", lambda name, d, k, i: 2 * k * d),
+}
+
+
+class FormulaChecker:
+    """
+    Compute the dimensions of the nodes of a formula, checking that the formula is well typed.
+    """
+
+    def __init__(self, variables):
+        # variables maps names of aliases to (pos, dim, cat) ; positions maps positions to (dim, cat)
+        self.variables = variables
+        self.positions = {}
+        for (name, (pos, dim, cat)) in variables.items():
+            self.add_variable(pos, dim, cat, name)
+
+    def add_variable(self, pos, dim, cat, name):
+        if cat not in (0, 1, 2):
+            raise FormulaError(
+                "invalid category {} for variable {} (should be 0, 1 or 2)".format(
+                    cat, name
+                )
+            )
+        if dim < 1:
+            raise FormulaError("invalid dimension {} for variable {}".format(dim, name))
+        if self.positions.setdefault(pos, (dim, cat)) != (dim, cat):
+            raise FormulaError(
+                "variable {} is Var({},{},{}) but argument {} is also used as Var({},{},{})".format(
+                    name, pos, dim, cat, pos, pos, *self.positions[pos]
+                )
+            )
+
+    def check(self, node):
+        """
+        Return (dim, is_reduction) for the node. Raise a FormulaError if the node is invalid.
+        """
+        if isinstance(node, int):
+            raise FormulaError("unexpected integer {}".format(node))
+        op = reduction_synonyms.get(node.op, node.op)
+
+        if op == "Alias":
+            if node.args[0] not in self.variables:
+                raise FormulaError("unknown variable '{}'".format(node.args[0]))
+            return self.variables[node.args[0]][1], False
+        if op in variable_categories and len(node.args) == 2:
+            node = Node("Var", node.args + (variable_categories[op],))
+            op = "Var"
+
+        if op in reductions:
+            kinds, rule = reductions[op]
+        elif op in signatures:
+            kinds, rule = signatures[op]
+        elif op == "Ind":
+            raise FormulaError("unexpected index sequence {}".format(node))
+        else:
+            raise FormulaError("unknown operation '{}'".format(node.op))
+
+        variadic = kinds.endswith("*")
+        kinds = kinds.rstrip("*")
+        if len(node.args) < len(kinds) or (
+            len(node.args) > len(kinds) and not variadic
+        ):
+            raise FormulaError(
+                "{} expects {} arguments, but got {}".format(
+                    node.op, len(kinds), len(node.args)
+                )
+            )
+        kinds += "I" * (len(node.args) - len(kinds))
+
+        values, is_reduction = [], False
+        for (i, (kind, arg)) in enumerate(zip(kinds, node.args)):
+            if kind == "n":
+                if not isinstance(arg, int):
+                    raise FormulaError(
+                        "argument {} of {} should be an integer".format(i + 1, node.op)
+                    )
+                values.append(arg)
+            elif kind == "I":
+                if not isinstance(arg, Node) or arg.op != "Ind":
+                    raise FormulaError(
+                        "argument {} of {} should be an index sequence Ind(...)".format(
+                            i + 1, node.op
+                        )
+                    )
+                values.append(arg.args)
+            else:
+                if isinstance(arg, int):
+                    raise FormulaError(
+                        "argument {} of {} should be a formula, not the integer {} "
+                        "(use IntCst({}) for constants)".format(
+                            i + 1, node.op, arg, arg
+                        )
+                    )
+                dim, red = self.check(arg)
+                if red and kind != "r":
+                    raise FormulaError(
+                        "reductions cannot be used inside {}".format(node.op)
+                    )
+                is_reduction = is_reduction or red
+                if kind == "v" and self.variable_of(arg) is None:
+                    raise FormulaError(
+                        "argument {} of {} should be a variable".format(i + 1, node.op)
+                    )
+                values.append(dim)
+
+        if op == "Var":
+            self.add_variable(*values, name=str(node))
+            return values[1], False
+        if op in ("Grad", "Grad_WithSavedForward"):
+            _equal(op + " (formula and gradient input)", values[0], values[2])
+            if op == "Grad_WithSavedForward":
+                _equal(op + " (formula and saved forward)", values[0], values[3])
+            return values[1], is_reduction
+        if op in ("GradFromInd", "GradFromInd_WithSavedForward"):
+            if values[1] not in self.positions:
+                raise FormulaError(
+                    "{} refers to the unknown variable of position {}".format(
+                        node.op, values[1]
+                    )
+                )
+            return self.positions[values[1]][0], is_reduction
+        if op in reductions:
+            # the axis is the last integer argument: Sum_Reduction(F,I), KMin_Reduction(F,K,I)...
+            axis = values[kinds.rindex("n")]
+            if axis not in (0, 1):
+                raise FormulaError(
+                    "the reduction axis of {} should be 0 or 1, but got {}".format(
+                        node.op, axis
+                    )
+                )
+            return rule(node.op, *values), True
+        return rule(node.op, *values), is_reduction
+
+    def variable_of(self, node):
+        if node.op == "Var":
+            return node.args
+        if node.op == "Alias":
+            return self.variables.get(node.args[0])
+        if node.op in variable_categories and len(node.args) == 2:
+            return node.args
+        return None
+
+
+def check_formula(formula, aliases):
+    """
+    Check that a formula is well formed and well typed, without compiling it.
+    A ValueError with a precise message is raised if the formula is invalid.
+
+    :return: the dimension of the output of the reduction.
+    """
+    if not isinstance(formula, Node):
+        formula = parse_formula(formula)
+    try:
+        dim, is_reduction = FormulaChecker(aliases_to_variables(aliases)).check(formula)
+        if not is_reduction:
+            raise FormulaError("the formula should be a reduction")
+    except FormulaError as e:
+        raise ValueError(
+            "[KeOps] Invalid formula: {} in '{}'.".format(e, formula)
+        ) from None
+    return dim
+
+
+# formulas known to be invalid, with the corresponding error messages
+_invalid_formulas = {}
+
+
+def validate_formula(formula, aliases):
+    """
+    Same as :func:`check_formula`, but the invalid formulas are remembered: checking again a known-bad formula
+    raises the same error immediately.
+    """
+    key = (formula, tuple(aliases))
+    if key in _invalid_formulas:
+        raise ValueError(_invalid_formulas[key])
+    try:
+        return check_formula(formula, aliases)
+    except ValueError as e:
+        _invalid_formulas[key] = str(e)
+        raise
+
+
+def get_canonical_formula(formula, aliases, optional_flags=[]):
+    """
+    Return the canonical form of (formula, aliases, optional_flags), which is used to name the compiled
+    KeOps modules: structurally identical formulas share the same module, whatever the names of their
+    variables, the spacing or the order of the operands of commutative operations.
+
+    Variables keep their positions, since these give the order of the arguments of the compiled routine.
+    The operands of products are not swapped when the MULT_VAR_HIGHDIM option is set, as this option relies
+    on the form of the formula.
+
+    :return: formula (str), aliases (list of "Var(pos,dim,cat)" strings), optional_flags (sorted list)
+    """
+    optional_flags = sorted(set(optional_flags))
+    variables = aliases_to_variables(aliases)
+    commute = "-DMULT_VAR_HIGHDIM=1" not in optional_flags
+    tree = canonicalize(parse_formula(formula), variables, commute)
+
+    canonical_aliases = []
+    for (i, alias) in enumerate(aliases):
+        _, cat, dim, pos = get_type(alias, position_in_list=i)
+        canonical_aliases.append(str(Node("Var", (pos, dim, cat))))
+
+    return str(tree), canonical_aliases, optional_flags
@@ -53,6 +53,42 @@ def parse_aliases(aliases):
     return tuple(categories), tuple(dimensions)
 
 
+class AliasSignature:
+    """
+    Compact signature of a list of aliases: the category, dimension and position of every variable, parsed once
+    (e.g. when a Genred object is created) so that the sizes of the inputs may be computed at every call without
+    parsing the aliases again.
+    """
+
+    __slots__ = ("categories", "dims", "positions", "pos_x", "pos_y")
+
+    def __init__(self, aliases):
+        self.categories, self.dims, self.positions = [], [], []
+        for (var_ind, sig) in enumerate(aliases):
+            _, cat, dim, pos = get_type(sig, position_in_list=var_ind)
+            self.categories.append(cat)
+            self.dims.append(dim)
+            self.positions.append(pos)
+        self.categories = tuple(self.categories)
+        self.dims = tuple(self.dims)
+        self.positions = tuple(self.positions)
+        # positions of the first i and j variables, whose numbers of lines give nx and ny (see get_sizes)
+        self.pos_x = next(
+            (p for (c, p) in zip(self.categories, self.positions) if c == 0), None
+        )
+        self.pos_y = next(
+            (p for (c, p) in zip(self.categories, self.positions) if c == 1), None
+        )
+
+    def get_sizes(self, *args):
+        """
+        Same as get_sizes(aliases, *args).
+        """
+        nx = 1 if self.pos_x is None else args[self.pos_x].shape[-2]
+        ny = 1 if self.pos_y is None else args[self.pos_y].shape[-2]
+        return nx, ny
+
+
 def get_sizes(aliases, *args):
     nx, ny = None, None
     for (var_ind, sig) in enumerate(aliases):
@@ -0,0 +1,137 @@
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import time
+
+import pykeops.config
+
+
+def _lang_of(obj):
+    return "torch" if type(obj).__module__.startswith("pykeops.torch") else "numpy"
+
+
+def _signature_of(obj):
+    """
+    Return the (lang, formula, aliases, dtype, optional_flags) signature of the kernel used by a
+    Genred or KernelSolve object.
+    """
+    lang = _lang_of(obj)
+    optional_flags = list(obj.optional_flags)
+    if lang == "torch" and getattr(obj, "rec_multVar_highdim", None) is not None:
+        # torch routines add this flag when they are called
+        optional_flags += ["-DMULT_VAR_HIGHDIM=1"]
+    return lang, obj.formula, list(obj.aliases), obj.dtype, optional_flags
+
+
+def _kernel_of(obj):
+    """
+    Return the signature of the kernel used by a Genred or KernelSolve object, or None if the kernel
+    is already compiled.
+    """
+    if _lang_of(obj) == "numpy":
+        # numpy routines compile their kernel at instantiation
+        return None
+    return _signature_of(obj)
+
+
+def _normalize_spec(spec):
+    """
+    Turn a user spec into a picklable job: either ("kernel", signature) or ("genred", lang, kwargs).
+    """
+    if isinstance(spec, dict):
+        kwargs = dict(spec)
+        lang = kwargs.pop("lang", "numpy")
+        if lang not in ("numpy", "torch"):
+            raise ValueError('[KeOps] lang should be "numpy" or "torch".')
+        if "formula" not in kwargs or "aliases" not in kwargs:
+            raise ValueError(
+                "[KeOps] precompile specs given as dicts must contain the 'formula' and 'aliases' keys."
+            )
+        return "genred", lang, kwargs
+
+    # reduced LazyTensors hold their Genred/KernelSolve routine in the callfun attribute
+    routine = getattr(spec, "callfun", spec)
+    if not hasattr(routine, "formula") or not hasattr(routine, "aliases"):
+        raise ValueError(
+            "[KeOps] Cannot precompile {}: specs should be dicts of Genred arguments, Genred/KernelSolve "
+            "objects or reduced LazyTensors with a known dtype.".format(spec)
+        )
+    return "kernel", _kernel_of(routine)
+
+
+def _run_job(bin_folder, job):
+    """
+    Compile (if needed) the kernel described by job. This function is run in the worker processes.
+    """
+    from pykeops.common.keops_io import LoadKeOps
+    from pykeops.common.set_path import set_bin_folder
+
+    if pykeops.config.bin_folder != bin_folder:
+        set_bin_folder(bin_folder)
+
+    start = time.perf_counter()
+    if job[0] == "genred":
+        _, lang, kwargs = job
+        if lang == "torch":
+            from pykeops.torch import Genred
+        else:
+            from pykeops.numpy import Genred
+        # the kernel is compiled by the worker process itself, not by a background thread
+        kernel = _kernel_of(Genred(**dict(kwargs, background_compile=False)))
+    else:
+        kernel = job[1]
+
+    if kernel is not None:
+        lang, formula, aliases, dtype, optional_flags = kernel
+        if lang == "torch":
+            from pykeops.torch import include_dirs
+        else:
+            include_dirs = []
+        LoadKeOps(formula, aliases, dtype, lang, optional_flags, include_dirs)
+
+    return time.perf_counter() - start
+
+
+def precompile(specs, workers=None):
+    r"""
+    Compile a list of KeOps kernels ahead of time, using a pool of processes.
+
+    Every formula is compiled in its own build folder, so that the kernels are built concurrently:
+    only the final linking step with the pybind11 template is serialized.
+
+    Args:
+        specs (list): the kernels to compile. Each spec may be:
+
+          - a **dict** of arguments for the :class:`Genred <pykeops.numpy.Genred>` constructor, with an additional
+            key ``"lang"`` (``"numpy"`` (default) or ``"torch"``), e.g.
+            ``{"formula": "Exp(-SqNorm2(x-y))", "aliases": ["x=Vi(3)", "y=Vj(3)"], "axis": 1, "lang": "torch"}``,
+          - a :class:`Genred <pykeops.torch.Genred>` or :class:`KernelSolve <pykeops.torch.KernelSolve>` object,
+          - a reduced :class:`LazyTensor <pykeops.torch.LazyTensor>`, obtained with ``call=False``.
+
+    Keyword Args:
+        workers (int, default None): number of worker processes. Defaults to the number of cpus.
+
+    Returns:
+        list of float: the time (in seconds) spent to load or compile each kernel.
+    """
+    jobs = [_normalize_spec(spec) for spec in specs]
+    bin_folder = pykeops.config.bin_folder
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1:
+        timings = [_run_job(bin_folder, job) for job in jobs]
+    else:
+        # "spawn" avoids forking a process which may hold locks (threads, cuda context...)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            timings = list(executor.map(_run_job, [bin_folder] * len(jobs), jobs))
+
+    # make the freshly compiled modules visible to the import system of the current process
+    importlib.invalidate_caches()
+
+    return timings
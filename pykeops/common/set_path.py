@@ -1,8 +1,6 @@
 import os
-import shutil
 import sys
 import warnings
-from hashlib import sha256
 
 from pykeops import __version__ as version
 import pykeops.config
@@ -39,10 +37,14 @@ def set_bin_folder(bf_user=None, append_to_python_path=True):
     # Create the bin_folder dir here... as importing a non existing dir makes python not happy...
     os.makedirs(bin_folder, exist_ok=True)
 
+    # the previous bin_folder, if any: it is not read with pykeops.config.bin_folder, which would create the
+    # default bin_folder if it has not been used yet
+    previous_bin_folder = vars(pykeops.config).get("bin_folder", "")
+
     # Save the path and append in python path
     if append_to_python_path:
-        while pykeops.config.bin_folder in sys.path:
-            sys.path.remove(pykeops.config.bin_folder)
+        while previous_bin_folder and previous_bin_folder in sys.path:
+            sys.path.remove(previous_bin_folder)
         sys.path.append(bin_folder)
         if any(
             any(i in s for i in ["libKeOps", "fshape_scp", "radial_kernel"])
@@ -54,26 +56,38 @@ def set_bin_folder(bf_user=None, append_to_python_path=True):
                 " pykeops, that is, before any computations."
             )
 
+    # Modules loaded from the previous bin_folder must not be served anymore
+    if previous_bin_folder != bin_folder:
+        from pykeops.common.keops_io import kernel_registry
+
+        kernel_registry.invalidate()
+
     pykeops.config.bin_folder = bin_folder
 
 
-def create_name(formula, aliases, dtype, lang, optional_flags):
+def create_name(formula, aliases, dtype, lang, optional_flags, include_dirs=[]):
     """
-    Compose the shared object name
+    Compose the shared object name. It is a content hash of the formula, the compilation options, the
+    compilers and the KeOps version, so that compiled formulas may be shared between several cache folders.
     """
+    from hashlib import sha256
+
+    from pykeops.common.compile_routines import get_compiler_signature
+
     formula = formula.replace(" ", "")  # Remove spaces
     aliases = [alias.replace(" ", "") for alias in aliases]
 
     # Since the OS prevents us from using arbitrary long file names, an okayish solution is to call
     # a standard hash function, and hope that we won't fall into a non-injective nightmare case...
     dll_name = ",".join(aliases + [formula] + optional_flags) + "_" + dtype
-    dll_name = (
-        "libKeOps"
-        + lang
-        + sha256((pykeops.config.bin_folder + dll_name).encode("utf-8")).hexdigest()[
-            :10
+    dll_name += "_" + ",".join(
+        [
+            version,
+            pykeops.config.build_type,
+            get_compiler_signature(dtype, lang, include_dirs),
         ]
     )
+    dll_name = "libKeOps" + lang + sha256(dll_name.encode("utf-8")).hexdigest()[:10]
     return dll_name
 
 
@@ -87,14 +101,21 @@ def clean_pykeops(path="", lang=""):
             '[pyKeOps:] lang should be the empty string, "numpy" or "torch"'
         )
 
+    import shutil
+
     if path == "":
         path = pykeops.config.bin_folder
 
+    from pykeops.common.keops_io import kernel_registry
+
+    kernel_registry.invalidate()
+
     print("Cleaning " + path + "...")
 
     for f in os.scandir(path):
         if f.is_dir(follow_symlinks=False) and (
             f.name.count("build-" + lang)
+            or f.name.count("build-libKeOps" + lang)
             or f.name.count("build-pybind11_template-libKeOps")
             or f.name.count("libKeOps" + lang)
             or f.name.count("build-fshape_scp")
@@ -106,9 +127,23 @@ def clean_pykeops(path="", lang=""):
             f.name.count("fshape_scp")
             or f.name.count("radial_kernel")
             or f.name.count("keops_hash")
+            or (f.name.count("manifest.json") and lang == "")
         ):
             os.remove(f.path)
         else:
             continue
 
         print("    - " + f.path + " has been removed.")
+
+    from pykeops.common.kernel_cache import get_manifest, clear_manifests
+
+    def remove_entries(entries):
+        for name in list(entries):
+            if name.startswith("libKeOps" + lang):
+                del entries[name]
+
+    if lang != "" and os.path.isfile(os.path.join(path, "manifest.json")):
+        # remove the entries of the deleted modules and bundles from the manifest
+        for section in ("modules", "bundles"):
+            get_manifest(path).update(remove_entries, section=section)
+    clear_manifests()
@@ -1,13 +1,20 @@
-import fcntl
 import functools
 import importlib.util
 import os
 import subprocess
 
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform: the files are not locked
+    fcntl = None
+
 import pykeops.config
 
 c_type = dict(float16="half2", float32="float", float64="double")
 
+# compiler option of the reductions over both i and j (see FULL_REDUCTION in keops/keops_includes.h)
+full_reduction_flag = "-DFULL_REDUCTION=1"
+
 
 def module_exists(dllname, template_name):
     if not os.path.exists(pykeops.config.bin_folder + os.path.sep + dllname):
@@ -29,6 +36,67 @@ def axis2cat(axis):
         raise ValueError("Axis should be 0 or 1.")
 
 
+def check_full_reduction(reduction_op, axis):
+    """
+    Check the options of a reduction over both i and j (axis=None), which is only available for Sum reductions.
+    :return: True if axis is None.
+    """
+    if axis is not None:
+        return False
+    if reduction_op != "Sum":
+        raise ValueError(
+            "[KeOps] axis=None (reduction over both i and j) is only available for Sum reductions."
+        )
+    return True
+
+
+def plain_cpu_engine(tagCpuGpu, ranges, signature, args):
+    """
+    Check if a reduction runs on the Cpu engine, without ranges or batch dimensions. Only this engine sums the lines
+    of a reduction over j (see full_reduction_flag), otherwise they are summed by NumPy or PyTorch, and reads
+    non contiguous variables without copy.
+    """
+    return (
+        tagCpuGpu == 0
+        and not ranges
+        and all(
+            len(args[pos].shape) == 2
+            for pos in (signature.pos_x, signature.pos_y)
+            if pos is not None
+        )
+    )
+
+
+def check_batch_offsets(offsets_i, offsets_j, nx, ny):
+    """
+    Check the offsets of a batch of independent problems of different sizes, stored one after the other
+    in the inputs (see batch_ranges): they should go from 0 to nx (resp. ny) in increasing order.
+    """
+    if offsets_i is None or offsets_j is None:
+        raise ValueError(
+            "[KeOps] batch_offsets_i and batch_offsets_j should be given together."
+        )
+    if len(offsets_i) != len(offsets_j) or len(offsets_i) < 2:
+        raise ValueError(
+            "[KeOps] batch_offsets_i and batch_offsets_j should have the same length B+1, for B problems."
+        )
+    for (offsets, n, name) in ((offsets_i, nx, "i"), (offsets_j, ny, "j")):
+        if (
+            int(offsets[0]) != 0
+            or int(offsets[-1]) != n
+            or (offsets[1:] < offsets[:-1]).any()
+        ):
+            raise ValueError(
+                "[KeOps] batch_offsets_"
+                + name
+                + " should increase from 0 to the number of lines of the "
+                + name
+                + " variables ("
+                + str(n)
+                + ")."
+            )
+
+
 def cat2axis(cat):
     """
     Axis is the dimension to sum (the pythonic way). Cat is the dimension that
@@ -43,16 +111,31 @@ def cat2axis(cat):
 
 
 class FileLock:
-    def __init__(self, fd, op=fcntl.LOCK_EX):
+    """
+    Lock on an open file, exclusive or shared. If blocking is False, acquire() raises a BlockingIOError
+    when the file is locked by another process instead of waiting.
+    """
+
+    def __init__(self, fd, shared=False, blocking=True):
         self.fd = fd
-        self.op = op
+        self.shared = shared
+        self.blocking = blocking
+
+    def acquire(self):
+        if fcntl is not None:
+            op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            fcntl.flock(self.fd, op if self.blocking else op | fcntl.LOCK_NB)
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
 
     def __enter__(self):
-        fcntl.flock(self.fd, self.op)
+        self.acquire()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.release()
 
 
 def create_and_lock_build_folder():
@@ -157,16 +240,17 @@ def replace_strings_in_file(filename, source_target_string_pairs):
         file.write(filedata)
 
 
-def run_and_display(args, build_folder, msg=""):
+def run_and_display(args, build_folder, msg="", env=None):
     """
     This function run the command stored in args and display the output if needed
     :param args: list
     :param msg: str
+    :param env: dict, environment of the command (None for the environment of the current process)
     :return: None
     """
     try:
         proc = subprocess.run(
-            args, cwd=build_folder, stdout=subprocess.PIPE, check=True
+            args, cwd=build_folder, stdout=subprocess.PIPE, check=True, env=env
         )
         if pykeops.config.verbose:
             print(proc.stdout.decode("utf-8"))
@@ -1,15 +1,14 @@
 import os
 import importlib.util
 
-from pykeops.common.gpu_utils import get_gpu_number
-
 ###############################################################
 # Initialize some variables: the values may be redefined later
 
 ##########################################################
 # Update config module: Search for GPU
-
-gpu_available = get_gpu_number() > 0
+#
+# gpu_available and bin_folder are computed at their first use (see __getattr__ below), so that
+# "import pykeops" neither loads libcuda nor creates folders.
 
 numpy_found = importlib.util.find_spec("numpy") is not None
 torch_found = importlib.util.find_spec("torch") is not None
@@ -26,14 +25,76 @@ script_template_folder = (
 script_linking_folder = (
     os.path.dirname(os.path.abspath(__file__)) + "/cmake_scripts/script_linking/"
 )
+script_bundle_folder = (
+    os.path.dirname(os.path.abspath(__file__)) + "/cmake_scripts/script_bundle/"
+)
 script_specific_folder = (
     os.path.dirname(os.path.abspath(__file__)) + "/cmake_scripts/script_specific/"
 )
 
 shared_obj_name = "KeOps_formula"
 
-bin_folder = (
-    ""  # init bin_folder... should be populated with the set_bin_folder() function
+# bin_folder is populated with the set_bin_folder() function, which is called at the first use of bin_folder
+
+# Read-only cache roots (e.g. a shared network folder or a folder embedded in a container image), searched for
+# compiled formulas before bin_folder. This is a list of paths, which may be set with the PYKEOPS_CACHE_ROOTS
+# environment variable (paths separated by os.pathsep).
+cache_roots = (
+    [root for root in os.environ["PYKEOPS_CACHE_ROOTS"].split(os.pathsep) if root]
+    if "PYKEOPS_CACHE_ROOTS" in os.environ
+    else []
+)
+
+# Limits on the local cache (bin_folder): when the total size of the compiled formulas (in bytes, or with a
+# K, M or G suffix) or their number exceeds these limits, the least recently used formulas are removed.
+# None means no limit.
+cache_max_size = (
+    os.environ["PYKEOPS_CACHE_MAX_SIZE"]
+    if "PYKEOPS_CACHE_MAX_SIZE" in os.environ
+    else None
+)
+cache_max_count = (
+    int(os.environ["PYKEOPS_CACHE_MAX_COUNT"])
+    if "PYKEOPS_CACHE_MAX_COUNT" in os.environ
+    else None
+)
+
+# Compilation backend. With "direct", the compiler command lines recorded by cmake (once per dtype and lang) are
+# used to call the compiler and the linker directly for every new formula. With "cmake", a cmake build is run for
+# every formula.
+compile_backend = (
+    str(os.environ["PYKEOPS_COMPILE_BACKEND"])
+    if "PYKEOPS_COMPILE_BACKEND" in os.environ
+    else "direct"
+)
+
+# Options of the direct backend: use a precompiled header for keops_includes.h (gcc only) and prefix the compiler
+# command lines with ccache (if found). These are booleans: False or True
+use_pch = (
+    bool(int(os.environ["PYKEOPS_USE_PCH"]))
+    if "PYKEOPS_USE_PCH" in os.environ
+    else False
+)
+use_ccache = (
+    bool(int(os.environ["PYKEOPS_USE_CCACHE"]))
+    if "PYKEOPS_USE_CCACHE" in os.environ
+    else False
+)
+
+# Compile the new kernels in a background thread, and meanwhile compute the reductions with a dense NumPy/PyTorch
+# implementation of the formulas (see the background_compile option of Genred). This is a boolean: False or True
+background_compile = (
+    bool(int(os.environ["PYKEOPS_BACKGROUND_COMPILE"]))
+    if "PYKEOPS_BACKGROUND_COMPILE" in os.environ
+    else False
+)
+
+# Default number of threads of the Cpu engine, for the routines that do not specify their own num_threads
+# (see pykeops.set_num_threads). This is an integer, or None to use the default number of threads of OpenMP
+num_threads = (
+    int(os.environ["PYKEOPS_NUM_THREADS"])
+    if "PYKEOPS_NUM_THREADS" in os.environ
+    else None
 )
 
 # Set the verbosity option: display output of compilations. This is a boolean: False or True
@@ -49,3 +110,19 @@ build_type = (
     if ("PYKEOPS_BUILD_TYPE" in os.environ)
     else "Release"
 )
+
+
+def __getattr__(name):
+    # lazy attributes of the module: they are computed once, at their first use
+    if name == "gpu_available":
+        from pykeops.common.gpu_utils import get_gpu_number
+
+        globals()["gpu_available"] = get_gpu_number() > 0
+        return globals()["gpu_available"]
+    if name == "bin_folder":
+        from pykeops.common.set_path import set_bin_folder
+
+        globals()["bin_folder"] = ""  # init bin_folder... populated by set_bin_folder()
+        set_bin_folder()
+        return globals()["bin_folder"]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -233,3 +233,36 @@ def swap_axes(ranges):
         return None
     else:
         return (*ranges[3:6], *ranges[0:3])
+
+
+def batch_ranges(offsets_i, offsets_j):
+    r"""Computes the block-diagonal **ranges** of a batch of independent problems of different sizes.
+
+    If :math:`B` point clouds :math:`x^{(b)}` and :math:`y^{(b)}` are stored one after the other in
+    two arrays :math:`x_i` and :math:`y_j`, the reductions of the :math:`B` problems may be computed
+    in a single call, with the **ranges** returned by this function: each :math:`x^{(b)}_i` only interacts
+    with the :math:`y^{(b)}_j` of the same problem.
+
+    Args:
+        offsets_i ((B+1,) integer array): Slice indices :math:`[0, M_0, M_0+M_1, ..., M]` of the :math:`B` problems in :math:`[0,M]`.
+        offsets_j ((B+1,) integer array): Slice indices :math:`[0, N_0, N_0+N_1, ..., N]` of the :math:`B` problems in :math:`[0,N]`.
+
+    Returns:
+        A 6-uple of integer arrays that can be used as an optional **ranges**
+        argument of :class:`pykeops.numpy.Genred`.
+
+    Example:
+        >>> ranges = batch_ranges(np.array([0, 2, 5]), np.array([0, 3, 4]))
+        >>> print(ranges[0])  # ranges_i
+        [[0 2]
+         [2 5]]
+        >>> print(ranges[2])  # redranges_j
+        [[0 3]
+         [3 4]]
+        --> x_i[0:2] interacts with y_j[0:3], x_i[2:5] interacts with y_j[3:4]
+    """
+    offsets_i, offsets_j = np.asarray(offsets_i), np.asarray(offsets_j)
+    ranges_i = np.stack((offsets_i[:-1], offsets_i[1:]), axis=1).astype("int32")
+    ranges_j = np.stack((offsets_j[:-1], offsets_j[1:]), axis=1).astype("int32")
+    slices = np.arange(1, len(offsets_i), dtype="int32")
+    return ranges_i, slices, ranges_j, ranges_j, slices, ranges_i
@@ -8,7 +8,7 @@
 
 #include "common/keops_io.h"
 
-using __NUMPYARRAY__ = pybind11::array_t< __TYPE__, pybind11::array::c_style >;
+using __NUMPYARRAY__ = pybind11::array_t< __TYPE__, 0 >;
 using __RANGEARRAY__ = pybind11::array_t< __INDEX__, pybind11::array::c_style >;
 
 
@@ -17,10 +17,9 @@ namespace keops_binders {
 //                  Template specialization (NumPy Arrays)                     //
 /////////////////////////////////////////////////////////////////////////////////
 
-// <__TYPE__, pybind11::array::c_style>  ensures 2 things whatever is the arguments:
-//  1) the precision used is __TYPE__ (float or double typically) on the device,
-//  2) everything is convert as contiguous before being loaded in memory
-// this is maybe not the best in term of performance... but at least it is safe.
+// <__TYPE__, 0>  ensures that the precision used is __TYPE__ (float or double typically) on the device.
+// The arrays are not copied to be contiguous: strided arrays are read as such by the Cpu engine, and
+// pykeops.numpy.Genred makes the args contiguous for the other engines.
 
 template<>
 int get_ndim(__NUMPYARRAY__ obj_ptri) {
@@ -39,7 +38,17 @@ __TYPE__* get_data(__NUMPYARRAY__ obj_ptri) {
 
 template<>
 bool is_contiguous(__NUMPYARRAY__ obj_ptri) {
-  return obj_ptri.c_style;  // always true because of pybind11::array::c_style
+  return obj_ptri.flags() & pybind11::array::c_style;
+}
+
+template<>
+int get_stride(__NUMPYARRAY__ obj_ptri, int l) {
+  // NumPy strides are given in bytes
+  int stride = obj_ptri.strides(l);
+  int itemsize = sizeof(__TYPE__);
+  if (stride % itemsize)
+    throw std::runtime_error("[KeOps] The strides of the arrays should be multiples of their itemsize.");
+  return stride / itemsize;
 }
 
 template<>
@@ -78,13 +87,26 @@ void keops_error(std::basic_string< char > msg) {
 /////////////////////////////////////////////////////////////////////////////////
 
 
-PYBIND11_MODULE(VALUE_OF(MODULE_NAME), m) {
+static void define_module(pybind11::module &m) {
 m.doc() = "pyKeOps: KeOps for numpy through pybind11.";
 
 m.def("genred_numpy", &generic_red <__NUMPYARRAY__, __RANGEARRAY__>, "Entry point to keops - numpy version.");
+m.def("genred_numpy_out", &generic_red_out <__NUMPYARRAY__, __RANGEARRAY__>, "Entry point to keops, with an output array - numpy version.");
+m.def("set_cpu_options", &set_cpu_options, "Set the number of threads and the schedule of the Cpu engine.");
 
 m.attr("tagIJ") = keops_binders::keops_tagIJ;
 m.attr("dimout") = keops_binders::keops_dimout;
 m.attr("formula") = keops_binders::keops_formula_string;
 }
 
+#ifdef KEOPS_BUNDLE_ENTRY
+// The formula is a member of a bundle (see pykeops.build_bundle): its functions are defined in a submodule
+// of the bundle, by the entry point KEOPS_BUNDLE_ENTRY.
+extern "C" void KEOPS_BUNDLE_ENTRY(pybind11::module &m) {
+define_module(m);
+}
+#else
+PYBIND11_MODULE(VALUE_OF(MODULE_NAME), m) {
+define_module(m);
+}
+#endif
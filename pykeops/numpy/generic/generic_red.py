@@ -1,11 +1,29 @@
 import numpy as np
 
+import pykeops.config
+from pykeops.common.cpu_options import CpuOptions
+from pykeops.common.dense_reduction import get_dense_reduction
 from pykeops.common.get_options import get_tag_backend
-from pykeops.common.keops_io import LoadKeOps
-from pykeops.common.operations import preprocess, postprocess
-from pykeops.common.parse_type import get_sizes, complete_aliases, get_optional_flags
-from pykeops.common.utils import axis2cat
+from pykeops.common.keops_io import kernel_registry, load_keops_module
+from pykeops.common.operations import (
+    check_output_reduction,
+    preprocess,
+    postprocess,
+)
+from pykeops.common.parse_type import (
+    AliasSignature,
+    complete_aliases,
+    get_optional_flags,
+)
+from pykeops.common.utils import (
+    axis2cat,
+    check_batch_offsets,
+    check_full_reduction,
+    full_reduction_flag,
+    plain_cpu_engine,
+)
 from pykeops.numpy import default_dtype
+from pykeops.numpy.cluster import batch_ranges
 
 
 class Genred:
@@ -65,6 +83,9 @@ class Genred:
         enable_chunks=True,
         optional_flags=[],
         rec_multVar_highdim=None,
+        background_compile=None,
+        num_threads=None,
+        schedule=None,
     ):
         r"""
         Instantiate a new generic operation.
@@ -104,6 +125,8 @@ class Genred:
 
                   - **axis** = 0: reduction with respect to :math:`i`, outputs a ``Vj`` or ":math:`j`" variable.
                   - **axis** = 1: reduction with respect to :math:`j`, outputs a ``Vi`` or ":math:`i`" variable.
+                  - **axis** = None: reduction with respect to both :math:`i` and :math:`j`, outputs a single vector.
+                    Only available for ``"Sum"`` reductions: on the CPU, both sums are performed by KeOps.
 
             dtype (string, default = ``"float64"``): Specifies the numerical ``dtype`` of the input and output arrays.
                 The supported values are:
@@ -140,6 +163,27 @@ class Genred:
 
                         optional_flags (list, default []): further optional flags passed to the compiler, in the form ['-D...=...','-D...=...']
 
+            background_compile (bool, default None): if True, the KeOps routine is compiled by a background thread
+                and, until it is ready, the reduction is computed with a (much slower) dense NumPy implementation
+                of the formula. See :meth:`ready`. Default value None uses ``pykeops.config.background_compile``.
+
+            num_threads (int, default None): number of threads used by the CPU engine. Default value None uses
+                ``pykeops.config.num_threads`` (see :func:`pykeops.set_num_threads`) or, if it is None, the default
+                number of threads of OpenMP. This option is given to the routine at call time: it does not trigger
+                a new compilation.
+
+            schedule (string, default None): schedule of the loops of the CPU engine over the lines of the output,
+                as in the ``OMP_SCHEDULE`` environment variable. The supported values are:
+
+                  - **schedule** = ``"static"``, ``"dynamic"`` or ``"guided"``, possibly followed by a chunk size,
+                    e.g. ``"dynamic,16"``.
+                  - **schedule** = ``"numa"``: static schedule with one contiguous block of lines per thread, and
+                    threads spread over the cores (``proc_bind(spread)``), so that each thread writes
+                    the block of the output that lies in the memory of its NUMA node.
+
+                Default value None keeps the default schedule of the engine. Like **num_threads**,
+                this option does not trigger a new compilation.
+
         """
         if cuda_type:
             # cuda_type is just old keyword for dtype, so this is just a trick to keep backward compatibility
@@ -150,7 +194,9 @@ class Genred:
                 "[KeOps] Float16 type is only supported with PyTorch tensors inputs."
             )
 
+        self.cpu_options = CpuOptions(num_threads, schedule)
         self.reduction_op = reduction_op
+        self.full_reduction = check_full_reduction(reduction_op, axis)
         reduction_op_internal, formula2 = preprocess(reduction_op, formula2)
 
         if rec_multVar_highdim is not None:
@@ -164,6 +210,9 @@ class Genred:
             dtype,
             enable_chunks,
         )
+        if self.full_reduction:
+            # the lines of the reduction wrt. j are summed by the engine (see __call__)
+            self.optional_flags += [full_reduction_flag]
         str_opt_arg = "," + str(opt_arg) if opt_arg else ""
         str_formula2 = "," + formula2 if formula2 else ""
 
@@ -173,19 +222,39 @@ class Genred:
             + formula
             + str_opt_arg
             + ","
-            + str(axis2cat(axis))
+            + str(axis2cat(1 if self.full_reduction else axis))
             + str_formula2
             + ")"
         )
         self.aliases = complete_aliases(self.formula, aliases)
+        # the aliases are parsed once: the calls only read the sizes of the inputs
+        self.signature = AliasSignature(self.aliases)
         self.dtype = dtype
-        self.myconv = LoadKeOps(
-            self.formula, self.aliases, self.dtype, "numpy", self.optional_flags
-        ).import_module()
+        if background_compile is None:
+            background_compile = pykeops.config.background_compile
+        if background_compile:
+            # the kernel is compiled in the background: until then, we use a dense implementation of the formula
+            self.myconv = None
+            self._future = self.ready()
+            self._dense = get_dense_reduction(self.formula, self.aliases, "numpy")
+        else:
+            self.myconv = load_keops_module(
+                self.formula, self.aliases, self.dtype, "numpy", self.optional_flags
+            )
         self.axis = axis
         self.opt_arg = opt_arg
 
-    def __call__(self, *args, backend="auto", device_id=-1, ranges=None):
+    def __call__(
+        self,
+        *args,
+        backend="auto",
+        device_id=-1,
+        ranges=None,
+        out=None,
+        accumulate=False,
+        batch_offsets_i=None,
+        batch_offsets_j=None
+    ):
         r"""
         Apply the routine on arbitrary NumPy arrays.
 
@@ -276,15 +345,60 @@ class Genred:
                 indices ``j in range( ranges_j[k,0], ranges_j[k,1] )`` should be computed using a Map-Reduce scheme over
                 indices ``i in Union( range( redranges_i[l, 0], redranges_i[l, 1] ))`` for ``l in range( slices_j[k-1], slices_j[k] )``.
 
+            out ((M,D) or (N,D) array, None by default): If given, the output of the reduction
+                is written in this array, which is returned: this avoids the allocation of a new array
+                at each call. It must have the shape of the output, the ``dtype`` of the inputs
+                and be C-contiguous. This is not supported with the reductions whose
+                output is post-processed (e.g. ``"LogSumExp"`` or ``"ArgMin"``), nor with **axis** = None.
+
+            accumulate (bool, default=False): If True, the output of the reduction is added
+                to the content of **out**, instead of overwriting it. On the CPU, the engine adds the output
+                of each line to **out** directly, without temporary array.
+
+            batch_offsets_i, batch_offsets_j ((B+1,) integer arrays, None by default): Offsets
+                :math:`[0, M_0, M_0+M_1, ..., M]` and :math:`[0, N_0, N_0+N_1, ..., N]` of a batch of :math:`B`
+                independent problems of different sizes, whose variables are stored one after the other in the
+                inputs: the reductions of all the problems are computed in a single call, with
+                block-diagonal **ranges** (see ``batch_ranges`` in the ``cluster`` module).
+                They cannot be used together with **ranges**.
+
         Returns:
             (M,D) or (N,D) array:
 
             The output of the reduction,
             a **2d-tensor** with :math:`M` or :math:`N` lines (if **axis** = 1
             or **axis** = 0, respectively) and a number of columns
-            that is inferred from the **formula**.
+            that is inferred from the **formula**. If **axis** = None,
+            the output is a **1d-array** of size D.
         """
 
+        if out is not None:
+            check_output_reduction(self.reduction_op, self.axis)
+            if out.dtype != args[0].dtype:
+                raise ValueError(
+                    "[KeOps] The out array should have the same dtype as the inputs."
+                )
+            if not out.flags.c_contiguous or not out.flags.writeable:
+                raise ValueError(
+                    "[KeOps] The out array should be C-contiguous and writeable."
+                )
+        elif accumulate:
+            raise ValueError("[KeOps] accumulate=True requires an out array.")
+
+        if batch_offsets_i is not None or batch_offsets_j is not None:
+            # ragged batch of problems: block-diagonal ranges
+            if ranges is not None:
+                raise ValueError(
+                    "[KeOps] batch_offsets_i and batch_offsets_j cannot be used with ranges."
+                )
+            batch_offsets_i, batch_offsets_j = (
+                None if offsets is None else np.asarray(offsets)
+                for offsets in (batch_offsets_i, batch_offsets_j)
+            )
+            nx, ny = self.signature.get_sizes(*args)
+            check_batch_offsets(batch_offsets_i, batch_offsets_j, nx, ny)
+            ranges = batch_ranges(batch_offsets_i, batch_offsets_j)
+
         # Get tags
         tagCpuGpu, tag1D2D, _ = get_tag_backend(backend, args)
         if ranges is None:
@@ -293,8 +407,19 @@ class Genred:
         # N.B.: KeOps C++ expects contiguous integer arrays as ranges
         ranges = tuple(np.ascontiguousarray(r) for r in ranges)
 
-        nx, ny = get_sizes(self.aliases, *args)
-        nout, nred = (nx, ny) if self.axis == 1 else (ny, nx)
+        nx, ny = self.signature.get_sizes(*args)
+        nout, nred = (ny, nx) if self.axis == 0 else (nx, ny)
+
+        # N.B.: the Cpu engine reads the variables with their strides, without copy; the parameters
+        # and the inputs of the other engines should be contiguous
+        in_cpu_engine = plain_cpu_engine(tagCpuGpu, ranges, self.signature, args)
+        if in_cpu_engine:
+            args = list(args)
+            for (cat, pos) in zip(self.signature.categories, self.signature.positions):
+                if cat == 2:
+                    args[pos] = np.ascontiguousarray(args[pos])
+        else:
+            args = [np.ascontiguousarray(arg) for arg in args]
 
         if "Arg" in self.reduction_op:
             # when using Arg type reductions,
@@ -310,10 +435,81 @@ class Genred:
                     "size of input array is too large for Arg type reduction with float16 dtype.."
                 )
 
-        out = self.myconv.genred_numpy(
-            tagCpuGpu, tag1D2D, 0, device_id, ranges, nx, ny, *args
-        )
+        # array in which the engine writes the output, if any: with accumulate=True, the Cpu engine adds its
+        # output to out, and the output of the Gpu engines is added to out from an array local to the call
+        target = out
+        if accumulate and tagCpuGpu != 0:
+            target = np.empty_like(out)
+
+        res = None
+        if self.myconv is None:
+            if not self._future.done() and self._dense is not None and not ranges:
+                try:
+                    res = self._dense(nx, ny, *args)
+                except NotImplementedError:
+                    pass
+            if res is None:
+                self.myconv = self._future.result()
+
+        if res is None:
+            myconv = self.myconv
+            if self.full_reduction and not in_cpu_engine:
+                optional_flags = list(self.optional_flags)
+                optional_flags.remove(full_reduction_flag)
+                myconv = load_keops_module(
+                    self.formula, self.aliases, self.dtype, "numpy", optional_flags
+                )
+            self.cpu_options.apply(myconv)
+            if target is None:
+                res = myconv.genred_numpy(
+                    tagCpuGpu, tag1D2D, 0, device_id, ranges, nx, ny, *args
+                )
+            else:
+                res = myconv.genred_numpy_out(
+                    tagCpuGpu,
+                    tag1D2D,
+                    0,
+                    device_id,
+                    ranges,
+                    nx,
+                    ny,
+                    target,
+                    accumulate and target is out,
+                    *args
+                )
+        elif out is not None:
+            if res.shape != out.shape:
+                raise ValueError(
+                    "[KeOps] Wrong shape for the output array: it should be "
+                    + str(res.shape)
+                    + "."
+                )
+            target = res
+
+        if out is not None:
+            if target is not out:
+                if accumulate:
+                    out += target
+                else:
+                    out[...] = target
+            return out
+
+        if self.full_reduction:
+            # sum of the lines; the output of the engine is a single line
+            res = res.sum(-2)
 
         return postprocess(
-            out, "numpy", self.reduction_op, nout, self.opt_arg, self.dtype
+            res, "numpy", self.reduction_op, nout, self.opt_arg, self.dtype
+        )
+
+    def ready(self):
+        r"""
+        Return a :class:`concurrent.futures.Future` of the compiled KeOps routine, which is done when the routine
+        is compiled and loaded. If needed, the compilation is started in a background thread.
+
+        This is mostly useful with **background_compile** = True: ``my_conv.ready().result()`` waits for the
+        end of the compilation.
+        """
+        return kernel_registry.get_async(
+            self.formula, self.aliases, self.dtype, "numpy", self.optional_flags
         )
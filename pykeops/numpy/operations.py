@@ -1,7 +1,8 @@
 import numpy as np
 
+from pykeops.common.cpu_options import CpuOptions
 from pykeops.common.get_options import get_tag_backend
-from pykeops.common.keops_io import LoadKeOps
+from pykeops.common.keops_io import load_keops_module
 from pykeops.common.operations import ConjugateGradientSolver
 from pykeops.common.parse_type import complete_aliases, get_optional_flags
 from pykeops.common.utils import axis2cat
@@ -154,9 +155,10 @@ class KernelSolve:
         self.aliases = complete_aliases(formula, aliases)
         self.varinvalias = varinvalias
         self.dtype = dtype
-        self.myconv = LoadKeOps(
-            self.formula, self.aliases, self.dtype, "numpy", optional_flags
-        ).import_module()
+        self.optional_flags = optional_flags
+        self.myconv = load_keops_module(
+            self.formula, self.aliases, self.dtype, "numpy", self.optional_flags
+        )
 
         if varinvalias[:4] == "Var(":
             # varinv is given directly as Var(*,*,*) so we just have to read the index
@@ -242,4 +244,5 @@ class KernelSolve:
                 res += alpha * var
             return res
 
+        CpuOptions.current().apply(self.myconv)
         return ConjugateGradientSolver("numpy", linop, varinv, eps=eps)
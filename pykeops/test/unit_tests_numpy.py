@@ -437,6 +437,688 @@ class NumpyUnitTestCase(unittest.TestCase):
             self.assertTrue(res_keops.shape == res_numpy.shape)
             self.assertTrue(np.allclose(res_keops, res_numpy, atol=1e-3))
 
+    ############################################################
+    def test_kernel_registry(self):
+        ############################################################
+        import shutil
+        import tempfile
+        from pykeops.numpy import Genred
+        from pykeops.common.keops_io import kernel_registry
+
+        formula = "Exp(-SqNorm2(x-y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+
+        kernel_registry.invalidate()
+        Genred(formula, aliases, reduction_op="Sum", axis=1)
+        self.assertEqual(kernel_registry.stats()["misses"], 1)
+        gamma = Genred(formula, aliases, reduction_op="Sum", axis=1)(
+            self.x, self.y, self.g
+        )
+        stats = kernel_registry.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["size"], 1)
+
+        gamma_py = np.sum(
+            np.exp(-np.sum((self.x[:, None, :] - self.y[None, :, :]) ** 2, axis=2))
+            * self.g.T,
+            axis=1,
+        )
+        self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+
+        # changing bin_folder must invalidate the registry
+        bin_folder = pykeops.config.bin_folder
+        new_bin_folder = tempfile.mkdtemp()
+        try:
+            pykeops.set_bin_folder(bin_folder)
+            self.assertEqual(kernel_registry.stats()["size"], 1)
+            pykeops.set_bin_folder(new_bin_folder)
+            self.assertEqual(kernel_registry.stats()["size"], 0)
+        finally:
+            pykeops.set_bin_folder(bin_folder)
+            shutil.rmtree(new_bin_folder, ignore_errors=True)
+
+    ############################################################
+    def test_precompile(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+        specs = [
+            {"formula": "Exp(-SqDist(x,y))*b", "aliases": aliases, "axis": 1},
+            {"formula": "Inv(IntCst(1)+SqDist(x,y))*b", "aliases": aliases, "axis": 1},
+        ]
+        timings = pykeops.precompile(specs, workers=2)
+        self.assertEqual(len(timings), 2)
+
+        gamma = Genred(**specs[1])(self.x, self.y, self.g)
+        gamma_py = np.sum(
+            self.g.T
+            / (1 + np.sum((self.x[:, None, :] - self.y[None, :, :]) ** 2, axis=2)),
+            axis=1,
+        )
+        self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+
+    ############################################################
+    def test_cache_roots(self):
+        ############################################################
+        import tempfile
+        from pykeops.numpy import Genred
+        from pykeops.common.keops_io import LoadKeOps
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+        gamma = Genred(formula, aliases, reduction_op="Sum", axis=1)(
+            self.x, self.y, self.g
+        )
+
+        # the local cache is used as a read-only cache root by a new (empty) local cache
+        bin_folder, cache_roots = pykeops.config.bin_folder, pykeops.config.cache_roots
+        try:
+            with tempfile.TemporaryDirectory() as new_bin_folder:
+                pykeops.config.cache_roots = [bin_folder]
+                pykeops.set_bin_folder(new_bin_folder)
+                myconv = Genred(formula, aliases, reduction_op="Sum", axis=1)
+                kernel = LoadKeOps(
+                    myconv.formula,
+                    myconv.aliases,
+                    myconv.dtype,
+                    "numpy",
+                    myconv.optional_flags,
+                )
+                self.assertTrue(kernel.module_path.startswith(bin_folder))
+                # only cmake is run in the new local cache, to identify the compiler
+                self.assertTrue(
+                    all(f.startswith("build-") for f in os.listdir(new_bin_folder))
+                )
+                self.assertTrue(
+                    np.allclose(myconv(self.x, self.y, self.g), gamma, atol=1e-6)
+                )
+        finally:
+            pykeops.config.cache_roots = cache_roots
+            pykeops.set_bin_folder(bin_folder)
+
+    ############################################################
+    def test_cache_stats(self):
+        ############################################################
+        from pykeops.numpy import Genred
+        from pykeops.common.kernel_cache import evict, get_local_manifest, record_hit
+
+        myconv = Genred("SqDist(x,y)*b", ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"], axis=1)
+        stats = pykeops.cache_stats()
+        Genred("SqDist(x,y)*b", ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"], axis=1)
+        # the second instantiation is served by the in-process registry
+        self.assertEqual(pykeops.cache_stats()["hits"], stats["hits"])
+        self.assertGreater(stats["modules"], 0)
+        self.assertGreater(stats["size"], 0)
+        self.assertGreaterEqual(stats["compilations"], stats["modules"])
+        self.assertTrue(0 <= stats["hit_ratio"] <= 1)
+
+        # the hits are kept in memory, and written in the manifest by cache_stats()
+        manifest = get_local_manifest()
+        mtime = os.stat(manifest.path).st_mtime_ns
+        record_hit(*next(iter(manifest.entries)).split(".", 1))
+        self.assertEqual(os.stat(manifest.path).st_mtime_ns, mtime)
+        self.assertEqual(pykeops.cache_stats()["hits"], stats["hits"] + 1)
+
+        # modules loaded by the current process are never evicted
+        evict(max_count=0)
+        self.assertGreater(pykeops.cache_stats()["modules"], 0)
+        myconv(self.x, self.y, self.g)
+
+    ############################################################
+    def test_formula_canonicalization(self):
+        ############################################################
+        from pykeops.numpy import Genred
+        from pykeops.common.parse_formula import get_canonical_formula
+
+        formula_1, aliases_1 = "Square(p-a)*Exp(x+y)", [
+            "p=Pm(0,1)",
+            "a=Vj(1,1)",
+            "x=Vi(2,3)",
+            "y=Vj(3,3)",
+        ]
+        formula_2, aliases_2 = "Exp( v + u ) * Square( s - b )", [
+            "s=Pm(1)",
+            "b=Vj(1)",
+            "u=Vi(3)",
+            "v=Vj(3)",
+        ]
+        self.assertEqual(
+            get_canonical_formula(formula_1, aliases_1),
+            get_canonical_formula(formula_2, aliases_2),
+        )
+        self.assertNotEqual(
+            get_canonical_formula("x-y", ["x=Vi(3)", "y=Vj(3)"]),
+            get_canonical_formula("y-x", ["x=Vi(3)", "y=Vj(3)"]),
+        )
+
+        args = (self.sigma, self.g, self.x, self.y)
+        gamma_1 = Genred(formula_1, aliases_1, axis=1)(*args)
+        gamma_2 = Genred(formula_2, aliases_2, axis=1)(*args)
+        self.assertTrue(np.allclose(gamma_1, gamma_2))
+
+    ############################################################
+    def test_formula_validation(self):
+        ############################################################
+        import tempfile
+        from pykeops.numpy import Genred
+        from pykeops.common.parse_formula import check_formula
+
+        aliases = ["x=Vi(3)", "y=Vj(2)", "b=Vj(1)"]
+        self.assertEqual(check_formula("Sum_Reduction(Exp(-x)*b,0)", aliases), 3)
+        self.assertEqual(check_formula("KMin_Reduction(SqNorm2(y),4,1)", aliases), 4)
+        self.assertEqual(check_formula("Sum_Reduction(ElemT(b,3,1),0)", aliases), 3)
+
+        bin_folder = pykeops.config.bin_folder
+        try:
+            with tempfile.TemporaryDirectory() as new_bin_folder:
+                pykeops.set_bin_folder(new_bin_folder)
+                for formula, message in [
+                    ("Exp(-SqDist(x,y))*b", "dimension"),
+                    ("Exp(-SqNorm2(x-z))*b", "unknown variable 'z'"),
+                    ("Expo(-SqNorm2(x))*b", "unknown operation 'Expo'"),
+                    ("Elem(x,3)", "out of bounds"),
+                    ("ElemT(x,3,1)", "scalar"),
+                    ("ElemT(b,3,3)", "out of bounds"),
+                    ("Exp(-SqNorm2(x)*b", "position"),
+                ]:
+                    with self.assertRaisesRegex(ValueError, message):
+                        Genred(formula, aliases, axis=1)
+                # bad formulas are rejected before any compilation
+                self.assertEqual(os.listdir(new_bin_folder), [])
+        finally:
+            pykeops.set_bin_folder(bin_folder)
+
+    ############################################################
+    def test_formula_signatures(self):
+        ############################################################
+        import re
+        from pykeops.common.parse_formula import signatures, reductions
+
+        doc_path = os.path.join(
+            os.path.dirname(pykeops.__file__), "..", "doc", "api", "math-operations.rst"
+        )
+        if not os.path.isfile(doc_path):
+            self.skipTest("the documentation is not available")
+        with open(doc_path) as f:
+            doc = f.read()
+        operations, doc_reductions = doc.split(".. _`part.mathOperation`:")[1].split(
+            ".. _`part.reduction`:"
+        )
+        doc_reductions = doc_reductions.split(".. _`formula.example`:")[0]
+
+        # every documented operation and reduction is known to the formula checker
+        for op in set(re.findall(r"``([A-Z]\w*)\(", operations)):
+            self.assertIn(op, signatures)
+        for line in doc_reductions.splitlines():
+            if "only in Python bindings" not in line:
+                for op in re.findall(r"^``(\w+)``\s", line):
+                    self.assertIn(op + "_Reduction", reductions)
+
+    ############################################################
+    def test_bundle(self):
+        ############################################################
+        from pykeops.numpy import Genred
+        from pykeops.common.keops_io import kernel_registry
+
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+        specs = [
+            {"formula": "Exp(-SqDist(x,y))*b", "aliases": aliases, "axis": 1},
+            {"formula": "SqDist(x,y)*b", "aliases": aliases, "axis": 1},
+            {
+                "formula": "SqDist(x,y)*b",
+                "aliases": aliases,
+                "axis": 1,
+                "dtype": "float32",
+            },
+        ]
+        pykeops.build_bundle(specs, name="unit_test")
+        self.assertGreaterEqual(pykeops.cache_stats()["bundles"], 1)
+
+        # the kernels are now loaded from the bundle
+        kernel_registry.invalidate()
+        gamma = Genred(**specs[1])(self.x, self.y, self.g)
+        gamma_py = np.sum(
+            self.g.T * np.sum((self.x[:, None, :] - self.y[None, :, :]) ** 2, axis=2),
+            axis=1,
+        )
+        self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+        gamma = Genred(**specs[2])(
+            self.x.astype("float32"), self.y.astype("float32"), self.g.astype("float32")
+        )
+        self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-3))
+
+    ############################################################
+    def test_compile_backend(self):
+        ############################################################
+        import tempfile
+        from pykeops.numpy import Genred
+
+        formula = "Exp(-SqDist(x,y))*Square(b)"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+        gamma_py = np.sum(
+            self.g.T ** 2
+            * np.exp(-np.sum((self.x[:, None, :] - self.y[None, :, :]) ** 2, axis=2)),
+            axis=1,
+        )
+
+        # each backend compiles the formula in its own, empty, build folder
+        backend, bin_folder = pykeops.config.compile_backend, pykeops.config.bin_folder
+        try:
+            for compile_backend in ("direct", "cmake"):
+                with tempfile.TemporaryDirectory() as new_bin_folder:
+                    pykeops.config.compile_backend = compile_backend
+                    pykeops.set_bin_folder(new_bin_folder)
+                    gamma = Genred(formula, aliases, axis=1)(self.x, self.y, self.g)
+                    self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+                    phases = pykeops.cache_stats()["compile_phases"]
+                    self.assertGreater(phases["compile"], 0)
+                    self.assertGreater(phases["link"], 0)
+        finally:
+            pykeops.config.compile_backend = backend
+            pykeops.set_bin_folder(bin_folder)
+
+    ############################################################
+    def test_background_compile(self):
+        ############################################################
+        import tempfile
+        from pykeops.numpy import Genred
+
+        formula = "Inv(IntCst(1)+SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"]
+        gamma_py = np.sum(
+            self.g.T
+            / (1 + np.sum((self.x[:, None, :] - self.y[None, :, :]) ** 2, axis=2)),
+            axis=1,
+        )
+
+        # the formula is compiled in an empty build folder
+        bin_folder = pykeops.config.bin_folder
+        try:
+            with tempfile.TemporaryDirectory() as new_bin_folder:
+                pykeops.set_bin_folder(new_bin_folder)
+                my_conv = Genred(formula, aliases, axis=1, background_compile=True)
+                # computed by the dense fallback if the compilation is not over yet
+                gamma = my_conv(self.x, self.y, self.g)
+                self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+
+                self.assertIsNotNone(my_conv.ready().result())
+                gamma = my_conv(self.x, self.y, self.g)
+                self.assertTrue(np.allclose(gamma.ravel(), gamma_py, atol=1e-6))
+                self.assertIsNotNone(my_conv.myconv)
+        finally:
+            pykeops.set_bin_folder(bin_folder)
+
+    ############################################################
+    def test_lazy_import(self):
+        ############################################################
+        import subprocess
+        import sys
+        import tempfile
+
+        # the import time itself is measured by benchmarks/plot_benchmark_import.py
+        heavy_modules = (
+            "ctypes",
+            "numpy",
+            "pykeops.common.gpu_utils",
+            "pykeops.test.install",
+        )
+        code = "import sys, pykeops; print(' '.join(m for m in {} if m in sys.modules))".format(
+            heavy_modules
+        )
+        source_dir = os.path.dirname(os.path.dirname(pykeops.__file__))
+        with tempfile.TemporaryDirectory() as home:
+            out = subprocess.run(
+                [sys.executable, "-c", code],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                env=dict(os.environ, HOME=home, PYTHONPATH=source_dir),
+                check=True,
+            ).stdout
+            # neither numpy nor GPU detection nor test helpers nor build folder at import
+            self.assertEqual(out.strip(), "")
+            self.assertEqual(os.listdir(home), [])
+
+    ############################################################
+    def test_alias_signature(self):
+        ############################################################
+        from pykeops.common.parse_type import AliasSignature, get_sizes
+
+        for aliases in (
+            ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)", "p=Pm(1)"],
+            ["p=Pm(0,1)", "b=Vj(1,3)", "x=Vi(2,3)"],
+            ["Var(0,3,1)", "Var(1,1,2)"],
+        ):
+            signature = AliasSignature(aliases)
+            sizes = {0: self.M, 1: self.N}
+            args = [
+                np.zeros((sizes[cat], dim)) if cat < 2 else np.zeros(dim)
+                for (cat, dim) in zip(signature.categories, signature.dims)
+            ]
+            self.assertEqual(signature.get_sizes(*args), get_sizes(aliases, *args))
+
+    ############################################################
+    def test_full_reduction(self):
+        ############################################################
+        from pykeops.numpy import Genred, LazyTensor
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"]
+        gamma_py = (np.exp(-squared_distances(self.x, self.y)) @ self.b).sum(0)
+
+        my_routine = Genred(formula, aliases, axis=None)
+        gamma_keops = my_routine(self.x, self.y, self.b, backend="CPU")
+        self.assertEqual(gamma_keops.shape, (3,))
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+        x_i = LazyTensor(self.x[:, None, :])
+        y_j = LazyTensor(self.y[None, :, :])
+        b_j = LazyTensor(self.b[None, :, :])
+        gamma_keops = ((-((x_i - y_j) ** 2).sum(-1)).exp() * b_j).sum(axis=(0, 1))
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+        with self.assertRaises(ValueError):
+            Genred(formula, aliases, reduction_op="Max", axis=None)
+
+    ############################################################
+    def test_output_array(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"]
+        gamma_py = np.exp(-squared_distances(self.x, self.y)) @ self.b
+
+        my_routine = Genred(formula, aliases, axis=1, dtype="float64")
+        out = np.zeros((self.M, 3))
+        gamma_keops = my_routine(self.x, self.y, self.b, backend="CPU", out=out)
+        self.assertTrue(gamma_keops is out)
+        self.assertTrue(np.allclose(out, gamma_py))
+
+        my_routine(self.x, self.y, self.b, backend="CPU", out=out, accumulate=True)
+        self.assertTrue(np.allclose(out, 2 * gamma_py))
+
+        with self.assertRaises(ValueError):
+            my_routine(self.x, self.y, self.b, out=out.astype("float32"))
+        with self.assertRaises(ValueError):
+            my_routine(self.x, self.y, self.b, accumulate=True)
+        with self.assertRaises(Exception):
+            my_routine(self.x, self.y, self.b, backend="CPU", out=out[:-1])
+
+    ############################################################
+    def test_output_array_threads(self):
+        ############################################################
+        from concurrent.futures import ThreadPoolExecutor
+        from pykeops.numpy import Genred
+
+        # several threads add the outputs of the same routine to their own arrays
+        x, y, b = np.random.rand(500, 3), np.random.rand(400, 3), np.random.rand(400, 3)
+        gamma_py = np.exp(-squared_distances(x, y)) @ b
+        my_routine = Genred(
+            "Exp(-SqDist(x,y))*b", ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"], axis=1
+        )
+        # two blocks of lines i, which interact with all the lines j
+        ranges = (
+            np.array([[0, 200], [200, 500]], dtype="int32"),
+            np.array([1, 2], dtype="int32"),
+            np.array([[0, 400], [0, 400]], dtype="int32"),
+            np.array([[0, 400]], dtype="int32"),
+            np.array([1], dtype="int32"),
+            np.array([[0, 500]], dtype="int32"),
+        )
+
+        def accumulate(k):
+            out = np.full((500, 3), float(k))
+            for n in range(10):
+                my_routine(
+                    x,
+                    y,
+                    b,
+                    backend="CPU",
+                    out=out,
+                    accumulate=True,
+                    ranges=ranges if n % 2 else None,
+                )
+            return out - k
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(accumulate, range(8)))
+        for res in results:
+            self.assertTrue(np.allclose(res, 10 * gamma_py))
+
+    ############################################################
+    def test_strided_inputs(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(2)", "y=Vj(2)", "b=Vj(3)"]
+        my_routine = Genred(formula, aliases, axis=1)
+
+        x = self.x[:, 1:]  # column slice
+        y = np.asfortranarray(self.y[:, :2])  # Fortran-ordered array
+        b = self.b[::-1]  # negative strides
+        gamma_py = np.exp(-squared_distances(x, y)) @ b
+
+        gamma_keops = my_routine(x, y, b, backend="CPU")
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+        gamma_keops = my_routine(
+            np.ascontiguousarray(x), np.ascontiguousarray(y), b, backend="CPU"
+        )
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+    ############################################################
+    def test_ragged_batch(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"]
+        my_routine = Genred(formula, aliases, axis=1)
+
+        # 3 problems of sizes (2,1), (5,3) and (3,2)
+        offsets_i, offsets_j = np.array([0, 2, 7, 10]), np.array([0, 1, 4, 6])
+        gamma_py = np.concatenate(
+            [
+                np.exp(-squared_distances(self.x[i0:i1], self.y[j0:j1])) @ self.b[j0:j1]
+                for (i0, i1, j0, j1) in zip(
+                    offsets_i[:-1], offsets_i[1:], offsets_j[:-1], offsets_j[1:]
+                )
+            ]
+        )
+
+        gamma_keops = my_routine(
+            self.x,
+            self.y,
+            self.b,
+            backend="CPU",
+            batch_offsets_i=offsets_i,
+            batch_offsets_j=offsets_j,
+        )
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+        with self.assertRaises(ValueError):
+            my_routine(self.x, self.y, self.b, batch_offsets_i=offsets_i)
+
+    ############################################################
+    def test_LazyTensor_factorize(self):
+        ############################################################
+        from pykeops.numpy import LazyTensor
+
+        x_i = LazyTensor(self.x[:, None, :])
+        y_j = LazyTensor(self.y[None, :, :])
+
+        # the same operations on the same operands give the same node of the DAG:
+        self.assertIs((x_i - y_j)._node, (x_i - y_j)._node)
+
+        D_ij = ((x_i - y_j) ** 2).sum(-1)
+        K = (-D_ij).exp() * D_ij
+        self.assertEqual(K.formula.count(D_ij.formula), 2)
+
+        gamma_keops = K.sum(axis=1, call=False)
+        self.assertEqual(gamma_keops.formula.count("Factorize("), 1)
+        self.assertNotIn("Factorize", D_ij.exp().sum(axis=1, call=False).formula)
+
+        D = squared_distances(self.x, self.y)
+        gamma_py = np.sum(np.exp(-D) * D, axis=1)
+        self.assertTrue(np.allclose(gamma_keops().ravel(), gamma_py))
+
+    ############################################################
+    def test_cpu_tiles(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        formula = "Exp(-SqDist(x,y))*b"
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"]
+        gamma_py = np.exp(-squared_distances(self.x, self.y)) @ self.b
+
+        # the line by line loop, and tiles / blocks that do not divide the sizes of the problem:
+        for flags in [
+            [],
+            ["-DCPU_TILED=0"],
+            ["-DCPU_TILE_I=3", "-DCPU_BLOCK_J=4"],
+        ]:
+            my_routine = Genred(formula, aliases, axis=1, optional_flags=flags)
+            gamma_keops = my_routine(self.x, self.y, self.b, backend="CPU")
+            self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+    ############################################################
+    def test_cpu_packets(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        aliases = ["x=Vi(3)", "y=Vj(3)", "b=Vj(3)"]
+
+        # packets of lines j must give the same results as the scalar evaluation, bit for bit,
+        # including for the blocks of lines j that are not a multiple of the packet width:
+        for formula, reduction_op in [
+            ("Exp(-SqDist(x,y))*b", "Sum"),
+            ("Rsqrt(SqDist(x,y))*b", "Sum"),
+            ("SqDist(x,y)", "ArgMin"),
+            ("OneHot(Sum(y), 3)", "Max"),
+        ]:
+            gamma_ref = Genred(formula, aliases, reduction_op=reduction_op, axis=1)(
+                self.x, self.y, self.b, backend="CPU"
+            )
+            for flags in [
+                ["-DCPU_PACKET_WIDTH=4"],
+                ["-DCPU_PACKET_WIDTH=8", "-DCPU_BLOCK_J=13"],
+            ]:
+                my_routine = Genred(
+                    formula,
+                    aliases,
+                    reduction_op=reduction_op,
+                    axis=1,
+                    optional_flags=flags,
+                )
+                gamma_keops = my_routine(self.x, self.y, self.b, backend="CPU")
+                self.assertTrue(np.array_equal(gamma_keops, gamma_ref))
+
+    ############################################################
+    def test_cpu_2D(self):
+        ############################################################
+        from pykeops.numpy import Genred
+
+        # a few lines i against many lines j: the reduction axis is split between the threads
+        x, y = self.x[:3], np.random.rand(2000, self.D)
+        aliases = ["x=Vi({})".format(self.D), "y=Vj({})".format(self.D)]
+        sqd = squared_distances(x, y)
+
+        for reduction_op, opt_arg, gamma_py in [
+            ("Sum", None, sqd.sum(axis=1, keepdims=True)),
+            ("LogSumExp", None, log_sum_exp(-sqd, axis=1)[:, None]),
+            ("ArgMin", None, sqd.argmin(axis=1)[:, None]),
+            ("ArgKMin", 3, np.argsort(sqd, axis=1)[:, :3]),
+        ]:
+            formula = "-SqDist(x,y)" if reduction_op == "LogSumExp" else "SqDist(x,y)"
+            for flags in [["-DCPU_2D=0"], ["-DCPU_MIN_CHUNK_J=16"]]:
+                my_routine = Genred(
+                    formula,
+                    aliases,
+                    reduction_op=reduction_op,
+                    axis=1,
+                    opt_arg=opt_arg,
+                    optional_flags=flags,
+                )
+                gamma_keops = my_routine(x, y, backend="CPU")
+                self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+    ############################################################
+    def test_cpu_options(self):
+        ############################################################
+        import pykeops
+        from pykeops.numpy import Genred
+
+        aliases = ["x=Vi({})".format(self.D), "y=Vj({})".format(self.D)]
+        gamma_py = squared_distances(self.x, self.y).sum(axis=1, keepdims=True)
+
+        # the options are given at call time: all these routines share the same compiled module
+        for schedule in [None, "static", "dynamic,4", "guided", "numa"]:
+            my_routine = Genred(
+                "SqDist(x,y)", aliases, axis=1, num_threads=2, schedule=schedule
+            )
+            gamma_keops = my_routine(self.x, self.y, backend="CPU")
+            self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+        my_routine = Genred("SqDist(x,y)", aliases, axis=1)
+        pykeops.set_num_threads(1)
+        try:
+            gamma_keops = my_routine(self.x, self.y, backend="CPU")
+        finally:
+            pykeops.set_num_threads()
+        self.assertTrue(np.allclose(gamma_keops, gamma_py))
+
+        with self.assertRaises(ValueError):
+            Genred("SqDist(x,y)", aliases, axis=1, num_threads=0)
+        with self.assertRaises(ValueError):
+            Genred("SqDist(x,y)", aliases, axis=1, schedule="foo")
+        with self.assertRaises(ValueError):
+            Genred("SqDist(x,y)", aliases, axis=1, schedule="numa,4")
+
+    ############################################################
+    def test_cpu_ranges_work_list(self):
+        ############################################################
+        from pykeops.numpy import Genred
+        from pykeops.numpy.cluster import from_matrix
+
+        # one large cluster and many small ones: the large cluster is cut into several tasks
+        sizes_i = np.array([300] + [1 + k % 4 for k in range(40)])
+        sizes_j = np.array([200] + [1 + k % 3 for k in range(40)])
+        offsets_i = np.concatenate(([0], np.cumsum(sizes_i)))
+        offsets_j = np.concatenate(([0], np.cumsum(sizes_j)))
+        ranges_i = np.stack((offsets_i[:-1], offsets_i[1:]), 1).astype("int32")
+        ranges_j = np.stack((offsets_j[:-1], offsets_j[1:]), 1).astype("int32")
+        keep = np.random.rand(len(sizes_i), len(sizes_j)) < 0.3
+        keep[0, :] = True
+        ranges_ij = from_matrix(ranges_i, ranges_j, keep)
+
+        x = np.random.rand(offsets_i[-1], self.D)
+        y = np.random.rand(offsets_j[-1], self.D)
+        b = np.random.rand(offsets_j[-1], 1)
+        mask = np.repeat(np.repeat(keep, sizes_i, 0), sizes_j, 1)
+        gamma_py = (np.exp(-squared_distances(x, y)) * mask) @ b
+
+        aliases = ["x=Vi({})".format(self.D), "y=Vj({})".format(self.D), "b=Vj(1)"]
+        results = []
+        for num_threads, schedule in [
+            (1, None),
+            (4, None),
+            (4, "static"),
+            (3, "guided"),
+        ]:
+            my_routine = Genred(
+                "Exp(-SqDist(x,y))*b",
+                aliases,
+                axis=1,
+                num_threads=num_threads,
+                schedule=schedule,
+            )
+            results.append(my_routine(x, y, b, backend="CPU", ranges=ranges_ij))
+            self.assertTrue(np.allclose(results[-1], gamma_py))
+        # each line is reduced by a single task: the results do not depend on the work list
+        for res in results[1:]:
+            self.assertTrue(np.array_equal(res, results[0]))
+
 
 if __name__ == "__main__":
     unittest.main()
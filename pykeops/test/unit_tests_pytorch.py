@@ -673,6 +673,187 @@ class PytorchUnitTestCase(unittest.TestCase):
             torch.allclose(grad_keops.flatten(), grad_torch.flatten(), rtol=1e-4)
         )
 
+    ############################################################
+    def test_cached_gradients(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+        from pykeops.torch.generic.generic_red import gradient_formula
+
+        my_routine = Genred(
+            "Exp(-SqDist(x,y))*b",
+            ["x=Vi(3)", "y=Vj(3)", "b=Vj(1)"],
+            axis=1,
+            dtype="float64",
+        )
+        x = torch.randn(self.M, 3, dtype=torch.float64, requires_grad=True)
+        y = torch.randn(self.N, 3, dtype=torch.float64)
+        b = torch.randn(self.N, 1, dtype=torch.float64)
+        e = torch.randn(self.M, 1, dtype=torch.float64)
+
+        K = torch.exp(-((x[:, None, :] - y[None, :, :]) ** 2).sum(-1))
+        (grad_torch,) = torch.autograd.grad(K @ b, x, e)
+
+        for i in range(3):
+            (grad_keops,) = torch.autograd.grad(my_routine(x, y, b), x, e)
+            self.assertTrue(torch.allclose(grad_keops, grad_torch))
+            if i == 0:
+                misses = gradient_formula.cache_info().misses
+        # the gradient formula is derived at the first backward pass only
+        self.assertEqual(gradient_formula.cache_info().misses, misses)
+
+    ############################################################
+    def test_grouped_gradients(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+        from pykeops.torch.generic.generic_red import gradient_groups
+
+        my_routine = Genred(
+            "Exp(-p*SqDist(x,y)-SqNorm2(z))*b",
+            ["x=Vi(3)", "z=Vi(2)", "y=Vj(3)", "b=Vj(1)", "p=Pm(1)"],
+            axis=1,
+            dtype="float64",
+        )
+        x = torch.randn(self.M, 3, dtype=torch.float64, requires_grad=True)
+        z = torch.randn(self.M, 2, dtype=torch.float64, requires_grad=True)
+        y = torch.randn(self.N, 3, dtype=torch.float64)
+        b = torch.randn(self.N, 1, dtype=torch.float64)
+        p = torch.rand(1, dtype=torch.float64, requires_grad=True)
+        e = torch.randn(self.M, 1, dtype=torch.float64)
+
+        K = torch.exp(
+            -p * ((x[:, None, :] - y[None, :, :]) ** 2).sum(-1)
+            - (z ** 2).sum(-1)[:, None]
+        )
+        grads_torch = torch.autograd.grad(K @ b, (x, z, p), e)
+
+        # the gradients wrt. x, z and p are reductions wrt. j: they are computed in a single pass
+        misses = gradient_groups.cache_info().misses
+        grads_keops = torch.autograd.grad(my_routine(x, z, y, b, p), (x, z, p), e)
+        self.assertEqual(gradient_groups.cache_info().misses, misses + 1)
+        for (grad_keops, grad_torch) in zip(grads_keops, grads_torch):
+            self.assertTrue(torch.allclose(grad_keops, grad_torch))
+
+    ############################################################
+    def test_value_and_grad(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+
+        formula = "Exp(-SqDist(x,y))*(a|b)"
+        aliases = ["x=Vi(3)", "a=Vi(2)", "y=Vj(3)", "b=Vj(2)"]
+        my_routine = Genred(formula, aliases, axis=1, dtype="float64")
+        my_routine_vg = Genred(
+            formula, aliases, axis=1, dtype="float64", value_and_grad=["x"]
+        )
+
+        x = torch.randn(self.M, 3, dtype=torch.float64, requires_grad=True)
+        a = torch.randn(self.M, 2, dtype=torch.float64)
+        y = torch.randn(self.N, 3, dtype=torch.float64, requires_grad=True)
+        b = torch.randn(self.N, 2, dtype=torch.float64)
+
+        energy = my_routine(x, a, y, b).sum()
+        energy_vg = my_routine_vg(x, a, y, b).sum()
+        self.assertTrue(torch.allclose(energy_vg, energy))
+
+        # the gradient wrt. x is computed in the forward pass, the gradient wrt. y by the backward pass
+        grads = torch.autograd.grad(energy, [x, y])
+        grads_vg = torch.autograd.grad(energy_vg, [x, y])
+        for (grad_vg, grad) in zip(grads_vg, grads):
+            self.assertTrue(torch.allclose(grad_vg, grad))
+
+        with self.assertRaises(ValueError):
+            Genred(formula, aliases, axis=0, value_and_grad=True)
+        with self.assertRaises(ValueError):
+            Genred(formula, aliases, axis=1, value_and_grad=["y"])
+
+    ############################################################
+    def test_parameter_gradient(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+
+        my_routine = Genred(
+            "Exp(-p*SqDist(x,y))*b",
+            ["x=Vi(3)", "y=Vj(3)", "b=Vj(2)", "p=Pm(1)"],
+            axis=1,
+            dtype="float64",
+        )
+        x = torch.randn(self.M, 3, dtype=torch.float64)
+        y = torch.randn(self.N, 3, dtype=torch.float64)
+        b = torch.randn(self.N, 2, dtype=torch.float64)
+        p = torch.rand(1, dtype=torch.float64, requires_grad=True)
+        e = torch.randn(self.M, 2, dtype=torch.float64)
+
+        K = torch.exp(-p * ((x[:, None, :] - y[None, :, :]) ** 2).sum(-1))
+        (grad_torch,) = torch.autograd.grad(K @ b, p, e)
+
+        # on the Cpu, the gradient wrt. p is summed over i by KeOps
+        (grad_keops,) = torch.autograd.grad(my_routine(x, y, b, p, backend="CPU"), p, e)
+        self.assertEqual(grad_keops.shape, p.shape)
+        self.assertTrue(torch.allclose(grad_keops, grad_torch))
+
+        # the second order derivatives still rely on the (M, D) gradients
+        (grad_keops,) = torch.autograd.grad(
+            my_routine(x, y, b, p, backend="CPU"), p, e, create_graph=True
+        )
+        self.assertTrue(torch.allclose(grad_keops, grad_torch))
+
+    ############################################################
+    def test_full_reduction(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+
+        my_routine = Genred(
+            "Exp(-SqDist(x,y))*b",
+            ["x=Vi(3)", "y=Vj(3)", "b=Vj(2)"],
+            axis=None,
+            dtype="float64",
+        )
+        x = torch.randn(self.M, 3, dtype=torch.float64, requires_grad=True)
+        y = torch.randn(self.N, 3, dtype=torch.float64, requires_grad=True)
+        b = torch.randn(self.N, 2, dtype=torch.float64)
+        e = torch.randn(2, dtype=torch.float64)
+
+        K = torch.exp(-((x[:, None, :] - y[None, :, :]) ** 2).sum(-1))
+        gamma_torch = (K @ b).sum(0)
+        gamma_keops = my_routine(x, y, b, backend="CPU")
+        self.assertEqual(gamma_keops.shape, (2,))
+        self.assertTrue(torch.allclose(gamma_keops, gamma_torch))
+
+        grads_torch = torch.autograd.grad(gamma_torch, [x, y], e)
+        grads_keops = torch.autograd.grad(gamma_keops, [x, y], e)
+        for (grad_keops, grad_torch) in zip(grads_keops, grads_torch):
+            self.assertTrue(torch.allclose(grad_keops, grad_torch))
+
+    ############################################################
+    def test_output_tensor(self):
+        ############################################################
+        import torch
+        from pykeops.torch import Genred
+
+        my_routine = Genred(
+            "Exp(-SqDist(x,y))*b",
+            ["x=Vi(3)", "y=Vj(3)", "b=Vj(2)"],
+            axis=1,
+            dtype="float64",
+        )
+        x = torch.randn(self.M, 3, dtype=torch.float64)
+        y = torch.randn(self.N, 3, dtype=torch.float64)
+        b = torch.randn(self.N, 2, dtype=torch.float64)
+
+        K = torch.exp(-((x[:, None, :] - y[None, :, :]) ** 2).sum(-1))
+        out = torch.zeros(self.M, 2, dtype=torch.float64)
+        my_routine(x, y, b, backend="CPU", out=out)
+        self.assertTrue(torch.allclose(out, K @ b))
+        my_routine(x, y, b, backend="CPU", out=out, accumulate=True)
+        self.assertTrue(torch.allclose(out, 2 * K @ b))
+
+        with self.assertRaises(ValueError):
+            my_routine(x.requires_grad_(), y, b, out=out)
+
 
 if __name__ == "__main__":
     """
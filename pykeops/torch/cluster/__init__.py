@@ -6,6 +6,7 @@ from .utils import (
     cluster_centroids,
     cluster_ranges_centroids,
     swap_axes,
+    batch_ranges,
 )
 
 # N.B.: the order is important for the autodoc in sphinx!
@@ -18,5 +19,6 @@ __all__ = sorted(
         "cluster_centroids",
         "cluster_ranges_centroids",
         "swap_axes",
+        "batch_ranges",
     ]
 )
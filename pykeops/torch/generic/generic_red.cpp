@@ -32,6 +32,11 @@ bool is_contiguous(at::Tensor obj_ptri) {
   return obj_ptri.is_contiguous();
 }
 
+template <>
+int get_stride(at::Tensor obj_ptri, int l) {
+  return obj_ptri.stride(l);
+}
+
 #if USE_DOUBLE
   #define AT_kTYPE at::kDouble
   #define AT_TYPE double
@@ -91,10 +96,12 @@ void keops_error(std::basic_string< char > msg) {
 /////////////////////////////////////////////////////////////////////////////////
 
 
-PYBIND11_MODULE(VALUE_OF(MODULE_NAME), m) {
+static void define_module(pybind11::module &m) {
 m.doc() = "pyKeOps: KeOps for pytorch through pybind11 (pytorch flavour).";
 
 m.def("genred_pytorch", &generic_red <at::Tensor, at::Tensor>, "Entry point to keops - pytorch version.");
+m.def("genred_pytorch_out", &generic_red_out <at::Tensor, at::Tensor>, "Entry point to keops, with an output array - pytorch version.");
+m.def("set_cpu_options", &set_cpu_options, "Set the number of threads and the schedule of the Cpu engine.");
 
 m.attr("tagIJ") = keops_binders::keops_tagIJ;
 m.attr("dimout") = keops_binders::keops_dimout;
@@ -102,4 +109,14 @@ m.attr("formula") = keops_binders::keops_formula_string;
 
 }
 
-
+#ifdef KEOPS_BUNDLE_ENTRY
+// The formula is a member of a bundle (see pykeops.build_bundle): its functions are defined in a submodule
+// of the bundle, by the entry point KEOPS_BUNDLE_ENTRY.
+extern "C" void KEOPS_BUNDLE_ENTRY(pybind11::module &m) {
+define_module(m);
+}
+#else
+PYBIND11_MODULE(VALUE_OF(MODULE_NAME), m) {
+define_module(m);
+}
+#endif
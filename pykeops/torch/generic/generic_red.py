@@ -1,17 +1,256 @@
+import functools
+import types
+
 import torch
+from torch.autograd.function import once_differentiable
 
+import pykeops.config
+from pykeops.common.cpu_options import CpuOptions, with_cpu_options
+from pykeops.common.dense_reduction import get_dense_reduction
 from pykeops.common.get_options import get_tag_backend
-from pykeops.common.keops_io import LoadKeOps
-from pykeops.common.operations import preprocess, postprocess
+from pykeops.common.keops_io import kernel_registry, load_keops_module
+from pykeops.common.operations import (
+    check_output_reduction,
+    preprocess,
+    postprocess,
+)
+from pykeops.common.parse_formula import (
+    parse_formula,
+    reduction_synonyms,
+    validate_formula,
+)
 from pykeops.torch.half2_convert import preprocess_half2, postprocess_half2
 from pykeops.common.parse_type import (
     get_type,
-    get_sizes,
+    AliasSignature,
     complete_aliases,
     get_optional_flags,
 )
-from pykeops.common.utils import axis2cat
+from pykeops.common.utils import (
+    axis2cat,
+    check_batch_offsets,
+    check_full_reduction,
+    full_reduction_flag,
+    plain_cpu_engine,
+)
 from pykeops.torch import default_dtype, include_dirs
+from pykeops.torch.cluster import batch_ranges
+
+
+@functools.lru_cache(maxsize=None)
+def reduction_of(formula):
+    """
+    Return the name of the reduction of a formula, e.g. "Sum_Reduction".
+    """
+    op = parse_formula(formula).op
+    return reduction_synonyms.get(op, op)
+
+
+@functools.lru_cache(maxsize=None)
+def gradient_formula(formula, aliases, var_ind, nargs, dimout, tagIJ):
+    """
+    Return the formula and aliases of the gradient of a reduction with respect to its variable of index var_ind,
+    and the category and position of this variable. The gradients are memoized, so that the backward passes
+    (and the higher order derivatives, which are gradients of gradients) do not build them again.
+
+    :param nargs: number of variables of the reduction.
+    :param dimout, tagIJ: dimension and category of the output of the reduction.
+    """
+
+    # If formula takes 5 variables (numbered from 0 to 4), then the gradient
+    # wrt. the output, G, should be given as a 6-th variable (numbered 5),
+    # with the same dim-cat as the formula's output.
+    eta = "Var(" + str(nargs) + "," + str(dimout) + "," + str(tagIJ) + ")"
+
+    # there is also a new variable for the formula's output
+    resvar = "Var(" + str(nargs + 1) + "," + str(dimout) + "," + str(tagIJ) + ")"
+
+    # Adding new aliases is way too dangerous if we want to compute
+    # second derivatives, etc. So we make explicit references to Var<ind,dim,cat> instead.
+    # New here (Joan) : we still add the new variables to the list of "aliases" (without
+    # giving new aliases for them) these will not be used in the C++ code,
+    # but are useful to keep track of the actual variables used in the formula
+    _, cat, dim, pos = get_type(aliases[var_ind], position_in_list=var_ind)
+    var = "Var(" + str(pos) + "," + str(dim) + "," + str(cat) + ")"  # V
+    formula_g = (
+        "Grad_WithSavedForward("
+        + formula
+        + ", "
+        + var
+        + ", "
+        + eta
+        + ", "
+        + resvar
+        + ")"
+    )  # Grad<F,V,G,R>
+    aliases_g = list(aliases) + [eta, resvar]
+    return formula_g, aliases_g, cat, pos
+
+
+@functools.lru_cache(maxsize=None)
+def gradient_groups(
+    formula, aliases, var_inds, rec_multVar_highdim, nargs, dimout, tagIJ
+):
+    """
+    Group the gradients of a Sum reduction with respect to the variables of index var_inds by the category of their
+    output, as in the DiffT of Sum_Reduction: the gradients with respect to the Vi variables and the parameters are
+    reductions wrt. j, and the gradients with respect to the Vj variables are reductions wrt. i. The gradients of a
+    group of several variables are computed by a single reduction of the concatenation of their formulas, so that
+    the sub-expressions shared by these formulas are computed once.
+
+    :return: a list of (formula, aliases, var_inds, cats, dims) for the groups of at least two variables. The other
+        gradients (and the gradients of the other reductions) are computed separately, with gradient_formula.
+    """
+    if reduction_of(formula) != "Sum_Reduction":
+        return []
+    tree = parse_formula(formula)
+
+    # the gradient wrt. the output, with the same dim-cat as the formula's output (see gradient_formula)
+    eta = "Var(" + str(nargs) + "," + str(dimout) + "," + str(tagIJ) + ")"
+
+    groups = {}
+    for var_ind in var_inds:
+        _, cat, dim, pos = get_type(aliases[var_ind], position_in_list=var_ind)
+        if pos == rec_multVar_highdim:
+            continue  # this gradient is computed separately, with the MULT_VAR_HIGHDIM option
+        groups.setdefault(cat % 2, []).append((var_ind, cat, dim, pos))
+
+    res = []
+    for tag, members in sorted(groups.items()):
+        if len(members) < 2:
+            continue
+        formula_g = None
+        for (_, cat, dim, pos) in members:
+            var = "Var(" + str(pos) + "," + str(dim) + "," + str(cat) + ")"
+            grad = "Grad(" + str(tree.args[0]) + "," + var + "," + eta + ")"
+            formula_g = (
+                grad if formula_g is None else "Concat(" + formula_g + "," + grad + ")"
+            )
+        res.append(
+            (
+                "Sum_Reduction(" + formula_g + "," + str(tag) + ")",
+                list(aliases) + [eta],
+                tuple(member[0] for member in members),
+                tuple(member[1] for member in members),
+                [member[2] for member in members],
+            )
+        )
+    return res
+
+
+@functools.lru_cache(maxsize=None)
+def value_and_grad_formula(formula, aliases, var_inds):
+    """
+    Return the formula of a Sum reduction wrt. j of a scalar formula, concatenated with the gradients of this formula
+    with respect to its Vi variables of index var_inds, and the dimensions of these gradients. Since the output of
+    the formula is a scalar g_i, the gradient of the reduction wrt. x_i is simply g_i times the reduction wrt. j
+    of Grad(F, x, 1): it is computed together with the value of the reduction, in the same map-reduce pass.
+    """
+    tree = parse_formula(formula)
+    f = str(tree.args[0])
+    formula_vg, dims = f, []
+    for var_ind in var_inds:
+        _, cat, dim, pos = get_type(aliases[var_ind], position_in_list=var_ind)
+        var = "Var(" + str(pos) + "," + str(dim) + "," + str(cat) + ")"
+        formula_vg = "Concat(" + formula_vg + ",Grad(" + f + "," + var + ",IntCst(1)))"
+        dims.append(dim)
+    return "Sum_Reduction(" + formula_vg + ",0)", dims
+
+
+def collapse_gradient(grad, arg, cat):
+    """
+    Return the gradient with respect to the variable arg, of category cat, from the output of its gradient reduction.
+    """
+    if cat == 2:
+        # we're referring to a parameter, so we'll have to sum both wrt 'i' and 'j'
+        # WARNING !! : here we rely on the implementation of DiffT in files in folder keops/core/formulas/reductions
+        # if tagI==cat of V is 2, then reduction is done wrt j, so we need to further sum output wrt i
+        # Then, sum 'grad' wrt 'i' :
+        # I think that '.sum''s backward introduces non-contiguous arrays,
+        # and is thus non-compatible with GenredAutograd: grad = grad.sum(0)
+        # We replace it with a 'handmade hack' :
+        # grad = torch.ones(1, grad.shape[0]).type_as(grad.data) @ grad
+        # grad = grad.view(-1)
+        grad = (1.0 * grad).sum(-2)
+        dims_to_collapse = tuple(
+            i
+            for (i, (x, y)) in enumerate(zip(arg.shape[:-1], grad.shape[:-1]))
+            if x < y
+        )
+    else:
+        # N.B.: 'grad' is always a full [A, .., B, M, D] or [A, .., B, N, D] or [A, .., B, D] tensor,
+        #       whereas 'arg' may have some broadcasted batched dimensions.
+        #       Before returning our gradient, we must collapse 'grad' with a .sum() operation,
+        #       which is the adjoint of the good old "repmat" that could have been used
+        #       to emulate the batch broadcasting.
+        dims_to_collapse = tuple(
+            i
+            for (i, (x, y)) in enumerate(zip(arg.shape[:-2], grad.shape[:-2]))
+            if x < y
+        )
+
+    if dims_to_collapse != ():
+        grad = (1.0 * grad).sum(dims_to_collapse, keepdim=True)
+    # The gradient should have the same shape as the input!
+    return grad.reshape(arg.shape)
+
+
+def launch_genred(
+    myconv, backend, device_id, ranges, nx, ny, args, out=None, accumulate=False
+):
+    """
+    Call the KeOps routine myconv on the tensors args. If out is given, the output is written in it,
+    or added to it if accumulate is True.
+    """
+    tagCPUGPU, tag1D2D, tagHostDevice = get_tag_backend(backend, args)
+
+    if tagCPUGPU == 1 & tagHostDevice == 1:
+        device_id = args[0].device.index
+        for i in range(1, len(args)):
+            if args[i].device.index != device_id:
+                raise ValueError(
+                    "[KeOps] Input arrays must be all located on the same device."
+                )
+
+    if ranges is None:
+        ranges = ()  # To keep the same type
+
+    # N.B.: KeOps C++ expects contiguous integer arrays as ranges
+    ranges = tuple(r.contiguous() for r in ranges)
+
+    CpuOptions.current().apply(myconv)
+    if out is None:
+        return myconv.genred_pytorch(
+            tagCPUGPU, tag1D2D, tagHostDevice, device_id, ranges, nx, ny, *args
+        )
+    if accumulate and tagCPUGPU != 0:
+        # the Cpu engine adds its output to out, and the output of the Gpu engines is added to out
+        # from a tensor local to the call
+        target = myconv.genred_pytorch_out(
+            tagCPUGPU,
+            tag1D2D,
+            tagHostDevice,
+            device_id,
+            ranges,
+            nx,
+            ny,
+            torch.empty_like(out),
+            False,
+            *args
+        )
+        return out.add_(target)
+    return myconv.genred_pytorch_out(
+        tagCPUGPU,
+        tag1D2D,
+        tagHostDevice,
+        device_id,
+        ranges,
+        nx,
+        ny,
+        out,
+        accumulate,
+        *args
+    )
 
 
 class GenredAutograd(torch.autograd.Function):
@@ -42,11 +281,11 @@ class GenredAutograd(torch.autograd.Function):
         # before adding the MULT_VAR_HIGHDIM compiler option.
         ctx.optional_flags = optional_flags.copy()
         if rec_multVar_highdim is not None:
-            optional_flags += ["-DMULT_VAR_HIGHDIM=1"]
+            optional_flags = optional_flags + ["-DMULT_VAR_HIGHDIM=1"]
 
-        myconv = LoadKeOps(
+        myconv = load_keops_module(
             formula, aliases, dtype, "torch", optional_flags, include_dirs
-        ).import_module()
+        )
 
         # Context variables: save everything to compute the gradient:
         ctx.formula = formula
@@ -56,29 +295,14 @@ class GenredAutograd(torch.autograd.Function):
         ctx.device_id = device_id
         ctx.ranges = ranges
         ctx.rec_multVar_highdim = rec_multVar_highdim
-        ctx.myconv = myconv
+        ctx.dimout = myconv.dimout
+        ctx.tagIJ = myconv.tagIJ
         ctx.nx = nx
         ctx.ny = ny
+        # the options of the Cpu engine are also those of the backward pass, which may run in another thread
+        ctx.cpu_options = CpuOptions.current()
 
-        tagCPUGPU, tag1D2D, tagHostDevice = get_tag_backend(backend, args)
-
-        if tagCPUGPU == 1 & tagHostDevice == 1:
-            device_id = args[0].device.index
-            for i in range(1, len(args)):
-                if args[i].device.index != device_id:
-                    raise ValueError(
-                        "[KeOps] Input arrays must be all located on the same device."
-                    )
-
-        if ranges is None:
-            ranges = ()  # To keep the same type
-
-        # N.B.: KeOps C++ expects contiguous integer arrays as ranges
-        ranges = tuple(r.contiguous() for r in ranges)
-
-        result = myconv.genred_pytorch(
-            tagCPUGPU, tag1D2D, tagHostDevice, device_id, ranges, nx, ny, *args
-        )
+        result = launch_genred(myconv, backend, device_id, ranges, nx, ny, args)
 
         # relying on the 'ctx.saved_variables' attribute is necessary  if you want to be able to differentiate the output
         #  of the backward once again. It helps pytorch to keep track of 'who is who'.
@@ -88,6 +312,11 @@ class GenredAutograd(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, G):
+        with ctx.cpu_options:
+            return GenredAutograd._backward(ctx, G)
+
+    @staticmethod
+    def _backward(ctx, G):
         formula = ctx.formula
         aliases = ctx.aliases
         backend = ctx.backend
@@ -95,13 +324,20 @@ class GenredAutograd(torch.autograd.Function):
         ranges = ctx.ranges
         optional_flags = ctx.optional_flags
         device_id = ctx.device_id
-        myconv = ctx.myconv
         nx = ctx.nx
         ny = ctx.ny
         args = ctx.saved_tensors[:-1]  # Unwrap the saved variables
         nargs = len(args)
         result = ctx.saved_tensors[-1].detach()
 
+        if full_reduction_flag in optional_flags:
+            # The lines of the reduction wrt. j were summed by the engine (see Genred with axis=None): this is the
+            # backward of the reduction wrt. j, whose lines all receive the same gradient G.
+            optional_flags = list(optional_flags)
+            optional_flags.remove(full_reduction_flag)
+            G = G.expand(nx, -1).contiguous()
+            result = result.expand(nx, -1).contiguous()
+
         not_supported = [
             "Min_ArgMin_Reduction",
             "Min_Reduction",
@@ -125,150 +361,230 @@ class GenredAutograd(torch.autograd.Function):
                     + "tensor containing the relevant 'minimal' values."
                 )
 
-        # If formula takes 5 variables (numbered from 0 to 4), then the gradient
-        # wrt. the output, G, should be given as a 6-th variable (numbered 5),
-        # with the same dim-cat as the formula's output.
-        eta = (
-            "Var("
-            + str(nargs)
-            + ","
-            + str(myconv.dimout)
-            + ","
-            + str(myconv.tagIJ)
-            + ")"
-        )
-
-        # there is also a new variable for the formula's output
-        resvar = (
-            "Var("
-            + str(nargs + 1)
-            + ","
-            + str(myconv.dimout)
-            + ","
-            + str(myconv.tagIJ)
-            + ")"
-        )
+        grads = [None] * nargs  # list of gradients wrt. args;
+
+        # If a gradient is to be discarded immediatly, don't waste time computing it.
+        needed = tuple(
+            var_ind for var_ind in range(nargs) if ctx.needs_input_grad[var_ind + 10]
+        )  # because of (formula, aliases, backend, dtype, device_id, ranges, optional_flags, rec_multVar_highdim, nx, ny)
+
+        # The gradients with respect to several variables of the same category are computed in a single
+        # map-reduce pass, with the concatenation of their formulas (see gradient_groups): the output is then split.
+        # With float16 inputs, the lines are interleaved by pairs (see preprocess_half2), and the output of a group
+        # cannot be split along its last dimension: the gradients are then computed one by one.
+        groups = ()
+        if dtype not in ("float16", "half"):
+            groups = gradient_groups(
+                formula,
+                tuple(aliases),
+                needed,
+                ctx.rec_multVar_highdim,
+                nargs,
+                ctx.dimout,
+                ctx.tagIJ,
+            )
+        for (formula_g, aliases_g, var_inds, cats, dims) in groups:
+            grad = GenredAutograd().apply(
+                formula_g,
+                aliases_g,
+                backend,
+                dtype,
+                device_id,
+                ranges,
+                optional_flags,
+                None,
+                nx,
+                ny,
+                *args,
+                G
+            )
+            for (var_ind, cat, grad_v) in zip(var_inds, cats, grad.split(dims, -1)):
+                grads[var_ind] = collapse_gradient(
+                    grad_v.contiguous(), args[var_ind], cat
+                )
 
-        grads = []  # list of gradients wrt. args;
+        for var_ind in needed:  # Run through the other arguments
+            if grads[var_ind] is not None:
+                continue
+
+            # The gradient formula is derived once per formula and variable (see gradient_formula), and its
+            # KeOps module is loaded once by the kernel registry.
+            formula_g, aliases_g, cat, pos = gradient_formula(
+                formula,
+                tuple(aliases),
+                var_ind,
+                nargs,
+                ctx.dimout,
+                ctx.tagIJ,
+            )
+            args_g = args + (G,) + (result,)  # Don't forget the gradient to backprop !
 
-        for (var_ind, (sig, arg_ind)) in enumerate(
-            zip(aliases, args)
-        ):  # Run through the arguments
-            # If the current gradient is to be discarded immediatly...
-            if not ctx.needs_input_grad[
-                var_ind + 10
-            ]:  # because of (formula, aliases, backend, dtype, device_id, ranges, optional_flags, rec_multVar_highdim, nx, ny)
-                grads.append(None)  # Don't waste time computing it.
+            # N.B.: if I understand PyTorch's doc, we should redefine this function every time we use it?
+            genconv = GenredAutograd().apply
 
+            # For a reduction of the type sum(F*b), with b a variable, and if we require the gradient
+            # with respect to b, the gradient will be of same type sum(F*eta). So we set again rec_multVar option
+            # in this case.
+            if pos == ctx.rec_multVar_highdim:
+                rec_multVar_highdim = nargs  # nargs is the position of variable eta.
             else:
-                # Otherwise, the current gradient is really needed by the user. Adding new aliases is way too dangerous if we want to compute
-                # second derivatives, etc. So we make explicit references to Var<ind,dim,cat> instead.
-                # New here (Joan) : we still add the new variables to the list of "aliases" (without
-                # giving new aliases for them) these will not be used in the C++ code,
-                # but are useful to keep track of the actual variables used in the formula
-                _, cat, dim, pos = get_type(sig, position_in_list=var_ind)
-                var = "Var(" + str(pos) + "," + str(dim) + "," + str(cat) + ")"  # V
-                formula_g = (
-                    "Grad_WithSavedForward("
-                    + formula
-                    + ", "
-                    + var
-                    + ", "
-                    + eta
-                    + ", "
-                    + resvar
-                    + ")"
-                )  # Grad<F,V,G,R>
-                aliases_g = aliases + [eta, resvar]
-                args_g = (
-                    args + (G,) + (result,)
-                )  # Don't forget the gradient to backprop !
-
-                # N.B.: if I understand PyTorch's doc, we should redefine this function every time we use it?
-                genconv = GenredAutograd().apply
-
-                # For a reduction of the type sum(F*b), with b a variable, and if we require the gradient
-                # with respect to b, the gradient will be of same type sum(F*eta). So we set again rec_multVar option
-                # in this case.
-                if pos == ctx.rec_multVar_highdim:
-                    rec_multVar_highdim = (
-                        nargs  # nargs is the position of variable eta.
-                    )
-                else:
-                    rec_multVar_highdim = None
-
-                if (
-                    cat == 2
-                ):  # we're referring to a parameter, so we'll have to sum both wrt 'i' and 'j'
-                    # WARNING !! : here we rely on the implementation of DiffT in files in folder keops/core/formulas/reductions
-                    # if tagI==cat of V is 2, then reduction is done wrt j, so we need to further sum output wrt i
-                    grad = genconv(
-                        formula_g,
-                        aliases_g,
-                        backend,
-                        dtype,
-                        device_id,
-                        ranges,
-                        optional_flags,
-                        rec_multVar_highdim,
-                        nx,
-                        ny,
-                        *args_g
-                    )
-                    # Then, sum 'grad' wrt 'i' :
-                    # I think that '.sum''s backward introduces non-contiguous arrays,
-                    # and is thus non-compatible with GenredAutograd: grad = grad.sum(0)
-                    # We replace it with a 'handmade hack' :
-                    # grad = torch.ones(1, grad.shape[0]).type_as(grad.data) @ grad
-                    # grad = grad.view(-1)
-                    grad = (1.0 * grad).sum(-2)
-                    dims_to_collapse = tuple(
-                        i
-                        for (i, (x, y)) in enumerate(
-                            zip(arg_ind.shape[:-1], grad.shape[:-1])
-                        )
-                        if x < y
-                    )
-
-                else:
-                    grad = genconv(
-                        formula_g,
-                        aliases_g,
-                        backend,
-                        dtype,
-                        device_id,
-                        ranges,
-                        optional_flags,
-                        rec_multVar_highdim,
-                        nx,
-                        ny,
-                        *args_g
-                    )
-
-                    # N.B.: 'grad' is always a full [A, .., B, M, D] or [A, .., B, N, D] or [A, .., B, D] tensor,
-                    #       whereas 'arg_ind' may have some broadcasted batched dimensions.
-                    #       Before returning our gradient, we must collapse 'grad' with a .sum() operation,
-                    #       which is the adjoint of the good old "repmat" that could have been used
-                    #       to emulate the batch broadcasting.
-                    dims_to_collapse = tuple(
-                        i
-                        for (i, (x, y)) in enumerate(
-                            zip(arg_ind.shape[:-2], grad.shape[:-2])
-                        )
-                        if x < y
-                    )
-
-                if dims_to_collapse != ():
-                    grad = (1.0 * grad).sum(dims_to_collapse, keepdim=True)
-                grad = grad.reshape(
-                    arg_ind.shape
-                )  # The gradient should have the same shape as the input!
-                grads.append(grad)
+                rec_multVar_highdim = None
+
+            if (
+                cat == 2
+                and not torch.is_grad_enabled()
+                and ranges is None
+                and G.dim() == 2
+                and reduction_of(formula) == "Sum_Reduction"
+                and get_tag_backend(backend, args)[0] == 0
+            ):
+                # The gradient wrt. a parameter is a reduction wrt. j whose output is then summed wrt. i. If it is not
+                # differentiated again, the Cpu engine performs both reductions, and returns a single line: the
+                # (M, D) array of the gradients of the lines is never allocated (see FULL_REDUCTION in keops_includes.h).
+                flags = optional_flags + [full_reduction_flag]
+                if rec_multVar_highdim is not None:
+                    flags += ["-DMULT_VAR_HIGHDIM=1"]
+                myconv_g = load_keops_module(
+                    formula_g, aliases_g, dtype, "torch", flags, include_dirs
+                )
+                grad = launch_genred(myconv_g, backend, device_id, None, nx, ny, args_g)
+                grads[var_ind] = grad.view(args[var_ind].shape)
+                continue
+
+            grad = genconv(
+                formula_g,
+                aliases_g,
+                backend,
+                dtype,
+                device_id,
+                ranges,
+                optional_flags,
+                rec_multVar_highdim,
+                nx,
+                ny,
+                *args_g
+            )
+            grads[var_ind] = collapse_gradient(grad, args[var_ind], cat)
 
         # Grads wrt. formula, aliases, backend, dtype, device_id, ranges, optional_flags, rec_multVar_highdim, nx, ny, *args
         return (None, None, None, None, None, None, None, None, None, None, *grads)
 
 
+class GenredValueAndGradAutograd(torch.autograd.Function):
+    """
+    Sum reduction wrt. j of a scalar formula, whose gradients with respect to the Vi variables of index var_inds
+    are computed in the forward pass (see value_and_grad_formula): the backward pass only scales them by
+    the gradient wrt. the output. The gradients wrt. the other variables are computed as in GenredAutograd.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        formula,
+        aliases,
+        backend,
+        dtype,
+        device_id,
+        ranges,
+        optional_flags,
+        rec_multVar_highdim,
+        var_inds,
+        nx,
+        ny,
+        *args
+    ):
+        formula_vg, dims = value_and_grad_formula(formula, tuple(aliases), var_inds)
+        out = GenredAutograd.apply(
+            formula_vg,
+            aliases,
+            backend,
+            dtype,
+            device_id,
+            ranges,
+            optional_flags,
+            None,
+            nx,
+            ny,
+            *args
+        )
+        value, *grads = out.split([1] + dims, -1)
+
+        # Context variables: save everything to compute the other gradients:
+        ctx.params = (
+            formula,
+            aliases,
+            backend,
+            dtype,
+            device_id,
+            ranges,
+            optional_flags,
+            rec_multVar_highdim,
+            nx,
+            ny,
+        )
+        ctx.var_inds = var_inds
+        ctx.cpu_options = CpuOptions.current()
+        ctx.save_for_backward(*args, value, *grads)
+
+        return value.contiguous()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, G):
+        nargs = len(ctx.saved_tensors) - len(ctx.var_inds) - 1
+        args = ctx.saved_tensors[:nargs]
+        value = ctx.saved_tensors[nargs]
+        grads = [None] * nargs  # list of gradients wrt. args;
+
+        for (var_ind, grad) in zip(ctx.var_inds, ctx.saved_tensors[nargs + 1 :]):
+            grads[var_ind] = collapse_gradient(G * grad, args[var_ind], 0)
+
+        # The other gradients are computed as in the backward pass of GenredAutograd, from the saved inputs and value,
+        # without computing the reduction once again:
+        # because of (formula, aliases, backend, dtype, device_id, ranges, optional_flags, rec_multVar_highdim, var_inds, nx, ny)
+        others = [
+            var_ind
+            for var_ind in range(nargs)
+            if ctx.needs_input_grad[var_ind + 11] and grads[var_ind] is None
+        ]
+        if others:
+            (
+                formula,
+                aliases,
+                backend,
+                dtype,
+                device_id,
+                ranges,
+                optional_flags,
+                rec_multVar_highdim,
+                nx,
+                ny,
+            ) = ctx.params
+            ctx_g = types.SimpleNamespace(
+                formula=formula,
+                aliases=aliases,
+                backend=backend,
+                dtype=dtype,
+                device_id=device_id,
+                ranges=ranges,
+                optional_flags=optional_flags,
+                rec_multVar_highdim=rec_multVar_highdim,
+                dimout=1,  # Sum reduction wrt. j of a scalar formula
+                tagIJ=0,
+                nx=nx,
+                ny=ny,
+                saved_tensors=args + (value,),
+                needs_input_grad=(False,) * 10
+                + tuple(var_ind in others for var_ind in range(nargs)),
+            )
+            with ctx.cpu_options:
+                grads_others = GenredAutograd._backward(ctx_g, G)[10:]
+            for var_ind in others:
+                grads[var_ind] = grads_others[var_ind]
+
+        return (None,) * 11 + tuple(grads)
+
+
 class Genred:
     r"""
     Creates a new generic operation.
@@ -321,6 +637,10 @@ class Genred:
         enable_chunks=True,
         optional_flags=[],
         rec_multVar_highdim=None,
+        background_compile=None,
+        value_and_grad=False,
+        num_threads=None,
+        schedule=None,
     ):
         r"""
         Instantiate a new generic operation.
@@ -360,6 +680,8 @@ class Genred:
 
                   - **axis** = 0: reduction with respect to :math:`i`, outputs a ``Vj`` or ":math:`j`" variable.
                   - **axis** = 1: reduction with respect to :math:`j`, outputs a ``Vi`` or ":math:`i`" variable.
+                  - **axis** = None: reduction with respect to both :math:`i` and :math:`j`, outputs a single vector.
+                    Only available for ``"Sum"`` reductions: on the CPU, both sums are performed by KeOps.
 
             dtype (string, default = ``"float32"``): Specifies the numerical ``dtype`` of the input and output arrays.
                 The supported values are:
@@ -397,11 +719,44 @@ class Genred:
 
                         optional_flags (list, default []): further optional flags passed to the compiler, in the form ['-D...=...','-D...=...']
 
+            background_compile (bool, default None): if True, the KeOps routine is compiled by a background thread
+                and, until it is ready, the reduction is computed with a (much slower) dense PyTorch implementation
+                of the formula, which supports autograd. See :meth:`ready`. Default value None uses
+                ``pykeops.config.background_compile``.
+
+            value_and_grad (bool or list of strings, default False): if True, the gradients of the reduction with
+                respect to its ``Vi`` variables that require grad are computed together with its value, in the same
+                map-reduce pass, so that each value of the formula is computed once. Their backward pass is then a
+                simple product with the gradient of the output, which is cheap when e.g. the output is summed into
+                a scalar energy before calling ``.backward()``. A list of aliases restricts these gradients to
+                the given ``Vi`` variables. This option requires a ``"Sum"`` reduction of a scalar formula with
+                **axis** = 1; the gradients wrt. the other variables are computed as usual, by the backward pass.
+                The output of a routine with this option cannot be differentiated twice.
+
+            num_threads (int, default None): number of threads used by the CPU engine, in the forward and backward
+                passes. Default value None uses ``pykeops.config.num_threads`` (see :func:`pykeops.set_num_threads`)
+                or, if it is None, the default number of threads of OpenMP. This option is given to the routine at
+                call time: it does not trigger a new compilation.
+
+            schedule (string, default None): schedule of the loops of the CPU engine over the lines of the output,
+                as in the ``OMP_SCHEDULE`` environment variable. The supported values are:
+
+                  - **schedule** = ``"static"``, ``"dynamic"`` or ``"guided"``, possibly followed by a chunk size,
+                    e.g. ``"dynamic,16"``.
+                  - **schedule** = ``"numa"``: static schedule with one contiguous block of lines per thread, and
+                    threads spread over the cores (``proc_bind(spread)``), so that each thread writes
+                    the block of the output that lies in the memory of its NUMA node.
+
+                Default value None keeps the default schedule of the engine. Like **num_threads**,
+                this option does not trigger a new compilation.
+
         """
         if cuda_type:
             # cuda_type is just old keyword for dtype, so this is just a trick to keep backward compatibility
             dtype = cuda_type
+        self.cpu_options = CpuOptions(num_threads, schedule)
         self.reduction_op = reduction_op
+        self.full_reduction = check_full_reduction(reduction_op, axis)
         reduction_op_internal, formula2 = preprocess(reduction_op, formula2)
 
         self.optional_flags = optional_flags + get_optional_flags(
@@ -412,6 +767,9 @@ class Genred:
             dtype,
             enable_chunks,
         )
+        if self.full_reduction:
+            # the lines of the reduction wrt. j are summed by the engine (see __call__)
+            self.optional_flags += [full_reduction_flag]
 
         str_opt_arg = "," + str(opt_arg) if opt_arg else ""
         str_formula2 = "," + formula2 if formula2 else ""
@@ -422,20 +780,68 @@ class Genred:
             + formula
             + str_opt_arg
             + ","
-            + str(axis2cat(axis))
+            + str(axis2cat(1 if self.full_reduction else axis))
             + str_formula2
             + ")"
         )
         self.aliases = complete_aliases(
             self.formula, list(aliases)
         )  # just in case the user provided a tuple
+        # the aliases are parsed once: the calls only read the sizes of the inputs
+        self.signature = AliasSignature(self.aliases)
         self.dtype = dtype
         self.axis = axis
         self.opt_arg = opt_arg
 
         self.rec_multVar_highdim = rec_multVar_highdim
 
-    def __call__(self, *args, backend="auto", device_id=-1, ranges=None):
+        self.value_and_grad = None
+        if value_and_grad:
+            if reduction_op != "Sum" or axis != 1:
+                raise ValueError(
+                    "[KeOps] value_and_grad is only available for Sum reductions with axis=1."
+                )
+            if validate_formula(self.formula, self.aliases) != 1:
+                raise ValueError(
+                    "[KeOps] value_and_grad is only available for scalar formulas."
+                )
+            # positions of the Vi variables wrt. which the gradients may be computed with the value:
+            names = [get_type(alias)[0] for alias in self.aliases]
+            self.value_and_grad = tuple(
+                pos
+                for (name, cat, pos) in zip(
+                    names, self.signature.categories, self.signature.positions
+                )
+                if cat == 0 and (value_and_grad is True or name in value_and_grad)
+            )
+            if value_and_grad is not True and len(self.value_and_grad) != len(
+                value_and_grad
+            ):
+                raise ValueError(
+                    "[KeOps] value_and_grad should be True or a list of aliases of Vi variables."
+                )
+
+        if background_compile is None:
+            background_compile = pykeops.config.background_compile
+        self._dense = None
+        if background_compile:
+            # the kernel is compiled in the background: until then, we use a dense implementation of the formula
+            self._future = self.ready()
+            if dtype not in ("float16", "half"):
+                self._dense = get_dense_reduction(self.formula, self.aliases, "torch")
+
+    @with_cpu_options
+    def __call__(
+        self,
+        *args,
+        backend="auto",
+        device_id=-1,
+        ranges=None,
+        out=None,
+        accumulate=False,
+        batch_offsets_i=None,
+        batch_offsets_j=None
+    ):
         r"""
         To apply the routine on arbitrary torch Tensors.
 
@@ -532,6 +938,24 @@ class Genred:
                 indices ``i in Union( range( redranges_i[l, 0], redranges_i[l, 1] ))``
                 for ``l in range( slices_j[k-1], slices_j[k] )``.
 
+            out ((M,D) or (N,D) Tensor, None by default): If given, the output of the reduction
+                is written in this tensor, which is returned: this avoids the allocation of a new tensor
+                at each call. It must have the shape of the output, the ``dtype`` and the device of the inputs
+                and be contiguous. This is not supported with autograd (use ``torch.no_grad()``),
+                with float16 inputs, with the reductions whose output is post-processed
+                (e.g. ``"LogSumExp"`` or ``"ArgMin"``), nor with **axis** = None.
+
+            accumulate (bool, default=False): If True, the output of the reduction is added
+                to the content of **out**, instead of overwriting it. On the CPU, the engine adds the output
+                of each line to **out** directly, without temporary array.
+
+            batch_offsets_i, batch_offsets_j ((B+1,) IntTensors, None by default): Offsets
+                :math:`[0, M_0, M_0+M_1, ..., M]` and :math:`[0, N_0, N_0+N_1, ..., N]` of a batch of :math:`B`
+                independent problems of different sizes, whose variables are stored one after the other in the
+                inputs: the reductions of all the problems are computed in a single call, with
+                block-diagonal **ranges** (see ``batch_ranges`` in the ``cluster`` module).
+                They cannot be used together with **ranges**.
+
         Returns:
             (M,D) or (N,D) Tensor:
 
@@ -539,12 +963,34 @@ class Genred:
             as the input Tensors. The output of a Genred call is always a
             **2d-tensor** with :math:`M` or :math:`N` lines (if **axis** = 1
             or **axis** = 0, respectively) and a number of columns
-            that is inferred from the **formula**.
+            that is inferred from the **formula**. If **axis** = None,
+            the output is a **1d-tensor** of size D.
 
         """
 
-        nx, ny = get_sizes(self.aliases, *args)
-        nout, nred = (nx, ny) if self.axis == 1 else (ny, nx)
+        if batch_offsets_i is not None or batch_offsets_j is not None:
+            # ragged batch of problems: block-diagonal ranges
+            if ranges is not None:
+                raise ValueError(
+                    "[KeOps] batch_offsets_i and batch_offsets_j cannot be used with ranges."
+                )
+            batch_offsets_i, batch_offsets_j = (
+                None
+                if offsets is None
+                else torch.as_tensor(offsets, device=args[0].device)
+                for offsets in (batch_offsets_i, batch_offsets_j)
+            )
+            nx, ny = self.signature.get_sizes(*args)
+            check_batch_offsets(batch_offsets_i, batch_offsets_j, nx, ny)
+            ranges = batch_ranges(batch_offsets_i, batch_offsets_j)
+
+        if out is not None:
+            return self._reduce_into(out, accumulate, backend, device_id, ranges, *args)
+        elif accumulate:
+            raise ValueError("[KeOps] accumulate=True requires an out tensor.")
+
+        nx, ny = self.signature.get_sizes(*args)
+        nout, nred = (ny, nx) if self.axis == 0 else (nx, ny)
 
         if "Arg" in self.reduction_op:
             # when using Arg type reductions,
@@ -560,9 +1006,62 @@ class Genred:
                     "size of input array is too large for Arg type reduction with float16 dtype.."
                 )
 
+        if self._dense is not None and ranges is None and not self._future.done():
+            try:
+                out = self._dense(nx, ny, *args)
+                if self.full_reduction:
+                    out = out.sum(-2)
+                return postprocess(
+                    out, "torch", self.reduction_op, nout, self.opt_arg, self.dtype
+                )
+            except NotImplementedError:
+                pass
+
+        if (
+            self.value_and_grad
+            and self.dtype not in ("float16", "half")
+            and torch.is_grad_enabled()
+        ):
+            # the gradients wrt. the Vi variables which require grad are computed with the value
+            var_inds = tuple(i for i in self.value_and_grad if args[i].requires_grad)
+            if var_inds:
+                out = GenredValueAndGradAutograd.apply(
+                    self.formula,
+                    self.aliases,
+                    backend,
+                    self.dtype,
+                    device_id,
+                    ranges,
+                    self.optional_flags,
+                    self.rec_multVar_highdim,
+                    var_inds,
+                    nx,
+                    ny,
+                    *args
+                )
+                return postprocess(
+                    out, "torch", self.reduction_op, nout, self.opt_arg, self.dtype
+                )
+
+        optional_flags = self.optional_flags
+        if self.full_reduction and (
+            self.dtype in ("float16", "half")
+            or not plain_cpu_engine(
+                get_tag_backend(backend, args)[0], ranges, self.signature, args
+            )
+        ):
+            # the lines of the reduction wrt. j are summed by PyTorch
+            optional_flags = list(optional_flags)
+            optional_flags.remove(full_reduction_flag)
+
         if self.dtype in ("float16", "half"):
             args, ranges, tag_dummy, N = preprocess_half2(
-                args, self.aliases, self.axis, ranges, nx, ny
+                args,
+                self.aliases,
+                1 if self.full_reduction else self.axis,
+                ranges,
+                nx,
+                ny,
             )
 
         out = GenredAutograd.apply(
@@ -572,7 +1071,7 @@ class Genred:
             self.dtype,
             device_id,
             ranges,
-            self.optional_flags,
+            optional_flags,
             self.rec_multVar_highdim,
             nx,
             ny,
@@ -582,6 +1081,86 @@ class Genred:
         if self.dtype in ("float16", "half"):
             out = postprocess_half2(out, tag_dummy, self.reduction_op, N)
 
+        if self.full_reduction:
+            # sum of the lines; if they were summed by the engine, its output is a single line
+            out = out.sum(-2)
+
         return postprocess(
             out, "torch", self.reduction_op, nout, self.opt_arg, self.dtype
         )
+
+    def _reduce_into(self, out, accumulate, backend, device_id, ranges, *args):
+        # implementation of __call__ when an out tensor is given
+        check_output_reduction(self.reduction_op, self.axis)
+        if self.dtype in ("float16", "half"):
+            raise ValueError(
+                "[KeOps] The out argument is not supported with float16 inputs."
+            )
+        if out.dtype != args[0].dtype or out.device != args[0].device:
+            raise ValueError(
+                "[KeOps] The out tensor should have the same dtype and device as the inputs."
+            )
+        if not out.is_contiguous():
+            raise ValueError("[KeOps] The out tensor should be contiguous.")
+        if torch.is_grad_enabled() and (
+            out.requires_grad or any(arg.requires_grad for arg in args)
+        ):
+            raise ValueError(
+                "[KeOps] The out argument is not supported with autograd: use torch.no_grad()."
+            )
+
+        nx, ny = self.signature.get_sizes(*args)
+
+        res = None
+        if self._dense is not None and ranges is None and not self._future.done():
+            try:
+                res = self._dense(nx, ny, *args)
+            except NotImplementedError:
+                pass
+        if res is not None:
+            if res.shape != out.shape:
+                raise ValueError(
+                    "[KeOps] Wrong shape for the output array: it should be "
+                    + str(tuple(res.shape))
+                    + "."
+                )
+            if accumulate:
+                out.add_(res)
+            else:
+                out.copy_(res)
+        else:
+            optional_flags = self.optional_flags
+            if self.rec_multVar_highdim is not None:
+                optional_flags = optional_flags + ["-DMULT_VAR_HIGHDIM=1"]
+            myconv = load_keops_module(
+                self.formula,
+                self.aliases,
+                self.dtype,
+                "torch",
+                optional_flags,
+                include_dirs,
+            )
+            launch_genred(
+                myconv, backend, device_id, ranges, nx, ny, args, out, accumulate
+            )
+        return out
+
+    def ready(self):
+        r"""
+        Return a :class:`concurrent.futures.Future` of the compiled KeOps routine, which is done when the routine
+        is compiled and loaded. If needed, the compilation is started in a background thread.
+
+        This is mostly useful with **background_compile** = True: ``my_conv.ready().result()`` waits for the
+        end of the compilation.
+        """
+        optional_flags = self.optional_flags
+        if self.rec_multVar_highdim is not None:
+            optional_flags = optional_flags + ["-DMULT_VAR_HIGHDIM=1"]
+        return kernel_registry.get_async(
+            self.formula,
+            self.aliases,
+            self.dtype,
+            "torch",
+            optional_flags,
+            include_dirs,
+        )
@@ -1,11 +1,12 @@
 import torch
 
+from pykeops.common.cpu_options import CpuOptions
 from pykeops.common.get_options import get_tag_backend
-from pykeops.common.keops_io import LoadKeOps
+from pykeops.common.keops_io import load_keops_module
 from pykeops.common.operations import ConjugateGradientSolver
 from pykeops.common.parse_type import (
     get_type,
-    get_sizes,
+    AliasSignature,
     complete_aliases,
     get_optional_flags,
 )
@@ -46,11 +47,11 @@ class KernelSolveAutograd(torch.autograd.Function):
         # before adding the MULT_VAR_HIGHDIM compiler option.
         ctx.optional_flags = optional_flags.copy()
         if rec_multVar_highdim is not None:
-            optional_flags += ["-DMULT_VAR_HIGHDIM=1"]
+            optional_flags = optional_flags + ["-DMULT_VAR_HIGHDIM=1"]
 
-        myconv = LoadKeOps(
+        myconv = load_keops_module(
             formula, aliases, dtype, "torch", optional_flags, include_dirs
-        ).import_module()
+        )
 
         # Context variables: save everything to compute the gradient:
         ctx.formula = formula
@@ -92,6 +93,7 @@ class KernelSolveAutograd(torch.autograd.Function):
                 res += alpha * var
             return res
 
+        CpuOptions.current().apply(myconv)
         global copy
         result = ConjugateGradientSolver("torch", linop, varinv.data, eps)
 
@@ -414,6 +416,7 @@ class KernelSolve:
         self.aliases = complete_aliases(
             formula, list(aliases)
         )  # just in case the user provided a tuple
+        self.signature = AliasSignature(self.aliases)
         if varinvalias[:4] == "Var(":
             # varinv is given directly as Var(*,*,*) so we just have to read the index
             varinvpos = int(varinvalias[4 : varinvalias.find(",")])
@@ -481,7 +484,7 @@ class KernelSolve:
 
         """
 
-        nx, ny = get_sizes(self.aliases, *args)
+        nx, ny = self.signature.get_sizes(*args)
 
         return KernelSolveAutograd.apply(
             self.formula,